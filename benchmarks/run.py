@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+Viki benchmarks
+~~~~~~~~~~~~~~~
+
+Times the daemon's run path and api against a throwaway viki home and
+prints the results as JSON, so runs from different releases can be
+compared.
+
+Usage:
+    make bench
+    python3 benchmarks/run.py [--quick] [--only spawn,run_throughput,...] [--output results.json]
+
+Benchmarks:
+    spawn            _run_shell_command latency for a trivial step
+    run_throughput   N concurrent POST /run requests until every run has finished
+    job_lookup       get_jobs / get_job_by_name latency with 10, 1k and 10k jobs
+    output           Output retrieval of 1MB and 100MB logs
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from typing import Any, Callable, Dict, List
+
+# The benchmarks always time this checkout, not an installed vikid
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+# --- Helpers
+
+
+def timings(samples: List[float]) -> Dict[str, Any]:
+    """ Summary statistics of latency samples, in seconds """
+    ordered = sorted(samples)
+
+    return {
+        "count": len(ordered),
+        "min": ordered[0],
+        "median": statistics.median(ordered),
+        "mean": statistics.mean(ordered),
+        "p95": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+        "max": ordered[-1],
+    }
+
+
+def measure(func: Callable[[], Any], repeat: int) -> Dict[str, Any]:
+    samples: List[float] = []
+
+    for _ in range(repeat):
+        began = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - began)
+
+    return timings(samples)
+
+
+def make_jobs(job, count: int, prefix: str) -> List[str]:
+    """ Write job configs straight to disk, far quicker than the api for 10k jobs """
+    from vikid import fs as filesystem
+
+    names = ['{}-{:05d}'.format(prefix, number) for number in range(count)]
+
+    for name in names:
+        os.makedirs(job.jobs_path + "/" + name, exist_ok=True)
+        filesystem.write_job_file(job.jobs_path + "/" + name + "/" + job.job_config_filename, {
+            "name": name, "description": "Benchmark job", "steps": ["true"],
+            "runNumber": 0, "lastSuccessfulRun": 0, "lastFailedRun": 0,
+        })
+
+    return names
+
+
+# --- Benchmarks
+
+
+def bench_spawn(api, quick: bool) -> Dict[str, Any]:
+    output_file = api.job.home + "/spawn-output.txt"
+
+    # Warm up the supervisor's reaper thread
+    api.job._run_shell_command('true', output_file)
+
+    return measure(lambda: api.job._run_shell_command('true', output_file), 50 if quick else 500)
+
+
+def bench_run_throughput(api, quick: bool) -> Dict[str, Any]:
+    client = api.bench_client
+    api.job.create_job('bench-run', {"description": "Benchmark job", "steps": ["true"], "concurrency": 64})
+
+    total = 50 if quick else 500
+    senders = 16
+    run_ids: List[str] = []
+    request_times: List[float] = []
+    lock = threading.Lock()
+
+    def send(count: int) -> None:
+        for _ in range(count):
+            began = time.perf_counter()
+            response = client.post('/api/v1/job/bench-run/run')
+            elapsed = time.perf_counter() - began
+            with lock:
+                request_times.append(elapsed)
+                run_ids.append(response.get_json()["run_id"])
+
+    began = time.perf_counter()
+    threads = [threading.Thread(target=send, args=(total // senders + (1 if number < total % senders else 0),))
+               for number in range(senders)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for run_id in run_ids:
+        run = api.run_queue.get(run_id)
+        while run.finished_at is None:
+            time.sleep(0.005)
+
+    elapsed = time.perf_counter() - began
+
+    return {
+        "runs": total,
+        "concurrent_senders": senders,
+        "workers": api.run_queue.workers,
+        "seconds": elapsed,
+        "runs_per_second": total / elapsed,
+        "request_latency": timings(request_times),
+    }
+
+
+def bench_job_lookup(api, quick: bool) -> Dict[str, Any]:
+    results: Dict[str, Any] = {}
+    existing = 0
+
+    for count in ([10, 1000] if quick else [10, 1000, 10000]):
+        # Job counts build on each other so 10k jobs are written once
+        make_jobs(api.job, count - existing, 'bench-lookup-{}'.format(count))
+        existing = count
+
+        began = time.perf_counter()
+        api.job.registry.load()
+        cold = time.perf_counter() - began
+
+        names = api.job.registry.names('bench-lookup')
+        middle = names[len(names) // 2]
+
+        results[str(count)] = {
+            "registry_load": cold,
+            "get_jobs": measure(api.job.get_jobs, 20 if quick else 100),
+            "get_jobs_page": measure(lambda: api.job.get_jobs('bench-lookup', 0, 50), 20 if quick else 100),
+            "get_job_by_name": measure(lambda: api.job.get_job_by_name(middle), 200 if quick else 2000),
+        }
+
+    return results
+
+
+def bench_output(api, quick: bool) -> Dict[str, Any]:
+    from vikid import builds
+
+    client = api.bench_client
+    results: Dict[str, Any] = {}
+    line = b'x' * 79 + b'\n'
+
+    for label, size in ([('1MB', 1 << 20)] if quick else [('1MB', 1 << 20), ('100MB', 100 << 20)]):
+        name = 'bench-output-' + label
+        api.job.create_job(name, {"description": "Benchmark job", "steps": ["true"]})
+        build_dir = builds.create_build(api.job.jobs_path + "/" + name, 1)
+        builds.write_meta(build_dir, {"run_number": 1, "state": "succeeded"})
+
+        with open(build_dir + "/" + api.job.job_output_file, 'wb') as output:
+            for _ in range(size // len(line)):
+                output.write(line)
+
+        repeat = 10 if size <= 1 << 20 else 3
+
+        def stream(url: str) -> None:
+            response = client.get(url)
+            for _ in response.response:
+                pass
+            response.close()
+
+        results[label] = {
+            "output_job": measure(lambda: api.job.output_job(name), repeat),
+            "log_stream": measure(lambda: stream('/api/v1/job/{}/log?offset=1'.format(name)), repeat),
+            "log_file": measure(lambda: stream('/api/v1/job/{}/log'.format(name)), repeat),
+            "log_tail_100": measure(lambda: stream('/api/v1/job/{}/log?tail=100'.format(name)), repeat),
+        }
+
+    return results
+
+
+benchmarks: Dict[str, Callable[[Any, bool], Dict[str, Any]]] = {
+    "spawn": bench_spawn,
+    "run_throughput": bench_run_throughput,
+    "job_lookup": bench_job_lookup,
+    "output": bench_output,
+}
+
+
+# --- Main
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Benchmark the viki daemon')
+    parser.add_argument('--quick', action='store_true', help='Smaller sizes and fewer repeats')
+    parser.add_argument('--only', default='', help='Comma separated benchmarks to run')
+    parser.add_argument('--output', help='Write the JSON results here instead of stdout')
+    args = parser.parse_args()
+
+    selected = [name for name in args.only.split(',') if name] or list(benchmarks)
+    unknown = set(selected) - set(benchmarks)
+    if unknown:
+        parser.error('unknown benchmark(s): {}'.format(', '.join(sorted(unknown))))
+
+    # Viki works out its home from $HOME when first imported, point it somewhere disposable
+    home = tempfile.mkdtemp(prefix='viki-bench-')
+    os.environ['HOME'] = home
+
+    try:
+        from vikid.application import app
+        with contextlib.redirect_stdout(sys.stderr):
+            app.create_system_setup()
+
+        from vikid._version import __version__
+        from vikid.application.factory import create_app
+        from vikid.blueprints import api_blueprint as api
+
+        api.bench_client = create_app(start_scheduler=False).test_client()
+
+        results: Dict[str, Any] = {
+            "version": __version__,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "quick": args.quick,
+            "started": time.time(),
+            "benchmarks": {},
+        }
+
+        for name in selected:
+            print('Running {}...'.format(name), file=sys.stderr)
+            results["benchmarks"][name] = benchmarks[name](api, args.quick)
+
+    finally:
+        shutil.rmtree(home, ignore_errors=True)
+
+    report = json.dumps(results, indent=2, sort_keys=True)
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(report + '\n')
+    else:
+        print(report)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
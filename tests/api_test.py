@@ -0,0 +1,165 @@
+"""
+Viki api tests
+~~~~~~~~~~~~~~
+
+Usage:
+    make test
+
+"""
+
+# --- Imports
+
+import os
+import threading
+import time
+
+from vikid import cli, logs
+from vikid.application.factory import create_app
+from vikid.blueprints import api_blueprint
+
+
+# --- Helpers
+
+
+client = create_app(start_scheduler=False, recover=False).test_client()
+
+job = api_blueprint.job
+
+
+def wait_for_run(run_id, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        run = api_blueprint.run_queue.get(run_id)
+        if run is None or run.finished_at is not None:
+            return run
+        time.sleep(0.02)
+
+
+# --- Tests
+
+
+class TestClass:
+
+    def test_run_args_must_be_a_list(self):
+
+        name = 'pytest-api-args'
+        job.create_job(name, {"description": "Api test", "steps": ['test "$1$2" = "a1"']})
+
+        try:
+            for body in ({"args": "abc"}, {"args": {"a": 1}}, {"args": [["a"]]}, {"args": [True]}):
+                response = client.post('/api/v1/job/{}/run'.format(name), json=body)
+                assert response.status_code == 400
+
+            response = client.post('/api/v1/job/{}/run'.format(name), json={"args": ["a", 1]})
+            assert response.status_code == 202
+            assert wait_for_run(response.get_json()["run_id"]).state == 'succeeded'
+        finally:
+            job.delete_job(name)
+
+
+    def test_log_offset_must_not_be_negative(self):
+
+        name = 'pytest-api-offset'
+        job.create_job(name, {"description": "Api test", "log_compression": 0, "steps": ['echo hello']})
+
+        try:
+            job.run_job(name)
+
+            assert client.get('/api/v1/job/{}/log?offset=-1'.format(name)).status_code == 400
+            assert client.get('/api/v1/job/{}/log?offset=2'.format(name)).data.endswith(b'llo\n')
+        finally:
+            job.delete_job(name)
+
+
+    def test_log_ranges(self):
+
+        names = ['pytest-api-range', 'pytest-api-range-plain']
+        job.create_job(names[0], {"description": "Api test", "steps": ['printf 0123456789']})
+        job.create_job(names[1], {"description": "Api test", "log_compression": 0, "steps": ['printf 0123456789']})
+
+        try:
+            for name in names:
+                job.run_job(name)
+                assert logs.is_compressed(job.output_file(name)[1]) == (name == names[0])
+
+                url = '/api/v1/job/{}/log'.format(name)
+                output = client.get(url).data
+                assert output.endswith(b'0123456789')
+
+                response = client.get(url, headers={"Range": "bytes=0-3"})
+                assert response.status_code == 206
+                assert response.data == output[:4]
+                assert response.headers["Content-Range"] == 'bytes 0-3/{}'.format(len(output))
+                assert response.headers["Accept-Ranges"] == 'bytes'
+
+                response = client.get(url, headers={"Range": "bytes=-4"})
+                assert response.status_code == 206
+                assert response.data == b'6789'
+
+                response = client.get(url, headers={"Range": "bytes={}-".format(len(output))})
+                assert response.status_code == 416
+        finally:
+            for name in names:
+                job.delete_job(name)
+
+
+    def test_runs_of_other_processes_are_found(self, tmp_path):
+
+        name = 'pytest-api-get-run'
+        gate = tmp_path / 'gate'
+        job.create_job(name, {"description": "Api test",
+                              "steps": ['while [ ! -e "{}" ]; do sleep 0.05; done'.format(gate)]})
+        url = '/api/v1/job/{}/runs/pytest-cli-run'.format(name)
+
+        # Run the way `vikid run` does, outside this process's queue
+        runner = threading.Thread(target=job.run_job, args=(name,),
+                                  kwargs={"trigger": "cli", "run_id": "pytest-cli-run"})
+        runner.start()
+
+        try:
+            deadline = time.time() + 5
+            while client.get(url).status_code == 404 and time.time() < deadline:
+                time.sleep(0.02)
+
+            run = client.get(url).get_json()["run"]
+            assert (run["state"], run["trigger"], run["run_number"]) == ("running", "cli", 1)
+
+            gate.touch()
+            runner.join()
+            job.history.flush()
+
+            assert client.get(url).get_json()["run"]["state"] == "succeeded"
+            assert client.get('/api/v1/job/other/runs/pytest-cli-run').status_code == 404
+        finally:
+            gate.touch()
+            runner.join()
+            job.delete_job(name)
+
+
+    def test_cancel_a_command_line_run(self):
+
+        name = 'pytest-api-cancel-cli'
+        job.create_job(name, {"description": "Api test", "kill_grace": 1, "steps": ['sleep 30']})
+
+        statuses = []
+        runner = threading.Thread(target=lambda: statuses.append(cli.main(['run', name])))
+        runner.start()
+
+        try:
+            # `vikid run` made up the run id, it is in the build's running marker
+            marker = '{}/{}.1'.format(job.running_path, name)
+            deadline = time.time() + 5
+            while not (os.path.exists(marker) and open(marker).read()) and time.time() < deadline:
+                time.sleep(0.02)
+            run_id = open(marker).read()
+
+            response = client.delete('/api/v1/job/{}/runs/{}'.format(name, run_id))
+            assert response.status_code == 202
+            assert response.get_json()["run"]["state"] == "running"
+
+            runner.join(10)
+            assert statuses == [130]
+            assert client.delete('/api/v1/job/{}/runs/{}'.format(name, run_id)).status_code == 409
+        finally:
+            runner.join()
+            job.delete_job(name)
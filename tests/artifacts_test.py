@@ -0,0 +1,93 @@
+"""
+Viki artifact tests
+~~~~~~~~~~~~~~~~~~~
+
+Usage:
+    make test
+
+"""
+
+# --- Imports
+
+import os
+
+import pytest
+
+from vikid import artifacts
+from vikid.artifacts import ArtifactStore
+
+
+# --- Helpers
+
+
+def make_build(tmp_path, name, files):
+    workspace = tmp_path / (name + '-workspace')
+    build_dir = tmp_path / (name + '-build')
+    build_dir.mkdir()
+
+    for path, contents in files.items():
+        (workspace / path).parent.mkdir(parents=True, exist_ok=True)
+        (workspace / path).write_bytes(contents)
+
+    return str(workspace), str(build_dir)
+
+
+# --- Tests
+
+
+class TestClass:
+
+    def test_patterns_stay_in_workspace(self):
+
+        assert artifacts.patterns(None) == []
+        assert artifacts.patterns(["dist/*.whl"]) == ["dist/*.whl"]
+
+        for config in (["/etc/*"], ["../secrets"], "dist/*", [1]):
+            with pytest.raises(ValueError):
+                artifacts.patterns(config)
+
+
+    def test_identical_files_are_stored_once(self, tmp_path):
+
+        store = ArtifactStore(str(tmp_path / 'store'))
+        first = make_build(tmp_path, 'first', {"dist/app.bin": b'same', "dist/notes.txt": b'one'})
+        second = make_build(tmp_path, 'second', {"dist/app.bin": b'same', "dist/notes.txt": b'two'})
+
+        manifest = store.collect(first[0], first[1], ["dist/*"])
+        store.collect(second[0], second[1], ["dist/*.bin"])
+
+        assert [artifact["path"] for artifact in manifest] == ["dist/app.bin", "dist/notes.txt"]
+        assert artifacts.read_manifest(second[1])[0]["sha256"] == manifest[0]["sha256"]
+
+        # The store's link plus one per build
+        path, digest = artifacts.find(second[1], "dist/app.bin")
+        assert digest == manifest[0]["sha256"]
+        assert os.stat(path).st_nlink == 3
+        assert open(path, 'rb').read() == b'same'
+
+
+    def test_symlinks_out_of_the_workspace_are_skipped(self, tmp_path):
+
+        store = ArtifactStore(str(tmp_path / 'store'))
+        workspace, build_dir = make_build(tmp_path, 'build', {"dist/real.txt": b'real'})
+        os.symlink('/etc/hostname', workspace + '/dist/escape.txt')
+
+        assert [artifact["path"] for artifact in store.collect(workspace, build_dir, ["dist/*"])] == ["dist/real.txt"]
+
+
+    def test_garbage_collection(self, tmp_path):
+
+        store = ArtifactStore(str(tmp_path / 'store'))
+        kept = make_build(tmp_path, 'kept', {"a.txt": b'kept'})
+        pruned = make_build(tmp_path, 'pruned', {"a.txt": b'pruned'})
+
+        store.collect(kept[0], kept[1], ["*.txt"])
+        store.collect(pruned[0], pruned[1], ["*.txt"])
+
+        # Too young to be collected
+        assert store.collect_garbage() == 0
+
+        os.remove(pruned[1] + '/artifacts/a.txt')
+
+        assert store.collect_garbage(min_age=0) == len(b'pruned')
+        assert open(artifacts.find(kept[1], "a.txt")[0], 'rb').read() == b'kept'
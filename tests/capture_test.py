@@ -0,0 +1,122 @@
+"""
+Viki output capture tests
+~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Usage:
+    make test
+
+"""
+
+# --- Imports
+
+import os
+import subprocess
+import time
+
+from vikid import logs
+from vikid.capture import Capture, replay
+from vikid.supervisor import Supervisor
+
+
+# --- Helpers
+
+
+supervisor = Supervisor()
+
+
+def run_step(capture, name, command):
+    stdout_r, stdout_w = os.pipe()
+    stderr_r, stderr_w = os.pipe()
+
+    process = supervisor.spawn(['/bin/sh', '-c', command], stdout=stdout_w, stderr=stderr_w,
+                               stdin=subprocess.DEVNULL)
+    os.close(stdout_w)
+    os.close(stderr_w)
+
+    capture.attach(name, stdout_r, stderr_r)
+
+    return process
+
+
+# --- Tests
+
+
+class TestClass:
+
+    def test_streams_are_kept_apart(self, tmp_path):
+
+        capture = Capture(str(tmp_path / 'output.txt'))
+        run_step(capture, 'build', 'echo one; echo two >&2; printf three').wait()
+        capture.close()
+
+        lines = [line for batch in replay(capture.output_file, capture.index_file) for line in batch]
+
+        assert sorted((line.stream, line.data) for line in lines) == [
+            ('stderr', b'two\n'), ('stdout', b'one\n'), ('stdout', b'three')]
+        assert [line.seq for line in lines] == [1, 2, 3]
+        assert all(line.step == 'build' for line in lines)
+        assert sorted(open(capture.output_file, 'rb').read().splitlines()) == [b'one', b'three', b'two']
+
+
+    def test_subscribers_see_every_line(self, tmp_path):
+
+        capture = Capture(str(tmp_path / 'output.txt'))
+        subscriber = capture.subscribe()
+
+        run_step(capture, 'build', 'for i in 1 2 3; do echo $i; sleep 0.05; done').wait()
+        capture.close()
+
+        assert [line.data for batch in subscriber for line in batch] == [b'1\n', b'2\n', b'3\n']
+
+
+    def test_slow_subscriber_catches_up_from_disk(self, tmp_path):
+
+        # A buffer far smaller than the output, the subscriber reads nothing until the step is done
+        capture = Capture(str(tmp_path / 'output.txt'), buffer_bytes=1024)
+        subscriber = capture.subscribe()
+
+        began = time.monotonic()
+        run_step(capture, 'build', 'seq 1 20000').wait()
+
+        assert time.monotonic() - began < 10
+
+        capture.close()
+        lines = [line for batch in subscriber for line in batch]
+
+        assert [line.seq for line in lines] == list(range(1, 20001))
+        assert lines[-1].data == b'20000\n'
+
+
+    def test_resume_after_line(self, tmp_path):
+
+        capture = Capture(str(tmp_path / 'output.txt'))
+        run_step(capture, 'build', 'seq 1 5').wait()
+        capture.close()
+
+        assert [line.data for batch in capture.subscribe(after=3) for line in batch] == [b'4\n', b'5\n']
+
+
+    def test_close_abandons_pipes_left_open(self, tmp_path):
+
+        capture = Capture(str(tmp_path / 'output.txt'))
+        process = run_step(capture, 'build', 'echo started; (sleep 30 &)')
+        process.wait()
+
+        began = time.monotonic()
+        capture.close(timeout=0.2)
+
+        assert time.monotonic() - began < 5
+        assert open(capture.output_file, 'rb').read() == b'started\n'
+
+
+    def test_compressed_output(self, tmp_path):
+
+        capture = Capture(str(tmp_path / 'output.txt'), buffer_bytes=1024, compression=6)
+        subscriber = capture.subscribe()
+
+        run_step(capture, 'build', 'seq 1 200000').wait()
+        capture.close()
+
+        assert logs.is_compressed(capture.output_file)
+        assert [line.seq for batch in subscriber for line in batch] == list(range(1, 200001))
+        assert b''.join(logs.read_chunks(capture.output_file)) == b''.join(b'%d\n' % n for n in range(1, 200001))
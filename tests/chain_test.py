@@ -0,0 +1,160 @@
+"""
+Viki job chaining tests
+~~~~~~~~~~~~~~~~~~~~~~~
+
+Usage:
+    make test
+
+"""
+
+# --- Imports
+
+import json
+import threading
+import time
+
+from vikid.chain import Chainer
+from vikid.run_queue import RunQueue
+
+
+# --- Helpers
+
+
+class FakeJob:
+    """ Stands in for vikid.job.Job, records every run and the env it got """
+
+    def __init__(self, configs, failing=()):
+        self.configs = configs
+        self.failing = failing
+        self.lock = threading.Lock()
+        self.runs = []
+
+    def get_job_config(self, job_name):
+        return self.configs.get(job_name)
+
+    def run_job(self, name, job_args=None, trigger='api', run_id=None, env=None, control=None, profile=False):
+        with self.lock:
+            self.runs.append((name, trigger, env or {}))
+        time.sleep(0.05)
+        success = 0 if name in self.failing else 1
+        return {"success": success, "message": "", "return_code": 1 - success,
+                "run_number": 1, "build_dir": "/builds/" + name}
+
+
+def chained_queue(job):
+    queue = RunQueue(job, workers=4)
+    queue.add_listener(Chainer(queue.submit, job.get_job_config, max_depth=5).run_finished)
+    return queue
+
+
+def wait_for_runs(job, count, timeout=10):
+    deadline = time.time() + timeout
+    while len(job.runs) < count and time.time() < deadline:
+        time.sleep(0.01)
+    time.sleep(0.2)
+    return [name for name, _, _ in job.runs]
+
+
+# --- Tests
+
+
+class TestClass:
+
+    def test_on_success_and_on_failure(self):
+
+        job = FakeJob({
+            "build": {"on_success": ["deploy"], "on_failure": ["notify"]},
+            "deploy": {},
+            "notify": {},
+        })
+        queue = chained_queue(job)
+
+        first = queue.submit('build')
+        names = wait_for_runs(job, 2)
+
+        assert names == ['build', 'deploy']
+        _, trigger, env = job.runs[1]
+        assert trigger == 'upstream'
+        assert env['VIKI_UPSTREAM_JOB'] == 'build'
+        assert env['VIKI_UPSTREAM_RUN_ID'] == first.id
+        assert env['VIKI_PIPELINE_ID'] == first.id
+        assert env['VIKI_UPSTREAM_BUILD_DIR'] == '/builds/build'
+
+        job.failing = ('build',)
+        queue.submit('build')
+
+        assert wait_for_runs(job, 4)[2:] == ['build', 'notify']
+
+
+    def test_fan_out_then_join(self):
+
+        job = FakeJob({
+            "build": {"fan_out": ["test-a", "test-b", "test-c"], "join": "release"},
+            "test-a": {}, "test-b": {}, "test-c": {}, "release": {},
+        })
+        queue = chained_queue(job)
+
+        queue.submit('build')
+        names = wait_for_runs(job, 5)
+
+        assert names[0] == 'build'
+        assert sorted(names[1:4]) == ['test-a', 'test-b', 'test-c']
+        assert names[4] == 'release'
+        upstreams = json.loads(job.runs[4][2]['VIKI_UPSTREAM'])
+        assert sorted(upstream['job'] for upstream in upstreams) == ['test-a', 'test-b', 'test-c']
+
+
+    def test_failed_branch_cancels_join(self):
+
+        job = FakeJob({
+            "build": {"fan_out": ["test-a", "test-b"], "join": "release"},
+            "test-a": {}, "test-b": {}, "release": {},
+        }, failing=('test-b',))
+        queue = chained_queue(job)
+
+        queue.submit('build')
+
+        assert 'release' not in wait_for_runs(job, 4, timeout=1)
+
+
+    def test_branch_cancelled_while_queued_cancels_join(self):
+
+        started = threading.Event()
+        release = threading.Event()
+
+        class BlockingJob(FakeJob):
+            def run_job(self, name, *args, **kwargs):
+                if name == 'test-a':
+                    started.set()
+                    release.wait(5)
+                return super().run_job(name, *args, **kwargs)
+
+        job = BlockingJob({
+            "build": {"fan_out": ["test-a", "test-b"], "join": "release"},
+            "test-a": {}, "test-b": {}, "release": {},
+        })
+
+        # One worker, busy with test-a, so test-b stays queued
+        queue = RunQueue(job, workers=1)
+        chainer = Chainer(queue.submit, job.get_job_config)
+        queue.add_listener(chainer.run_finished)
+
+        queue.submit('build')
+        assert started.wait(5)
+
+        queued = [run for run in list(queue._runs.values()) if run.job_name == 'test-b']
+        assert queue.cancel(queued[0].id).state == 'cancelled'
+        release.set()
+
+        assert wait_for_runs(job, 3, timeout=1) == ['build', 'test-a']
+        assert chainer._joins == {}
+
+
+    def test_chains_stop_at_max_depth(self):
+
+        job = FakeJob({"ping": {"on_success": "pong"}, "pong": {"on_success": "ping"}})
+        queue = chained_queue(job)
+
+        queue.submit('ping')
+
+        assert len(wait_for_runs(job, 10, timeout=2)) == 6
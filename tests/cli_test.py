@@ -0,0 +1,180 @@
+"""
+Viki command line tests
+~~~~~~~~~~~~~~~~~~~~~~~
+
+Usage:
+    make test
+
+"""
+
+# --- Imports
+
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from vikid import _conf, cli
+from vikid import fs as filesystem
+from vikid.application import app
+from vikid.job import Job
+
+
+# --- Helpers
+
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules only the daemon and the job engine need
+heavy_modules = ('flask', 'werkzeug', 'gunicorn', 'vikid.job', 'vikid.blueprints', 'sqlite3')
+
+# Seconds `vikid check` may spend importing viki's own modules, with plenty of room for slow machines
+check_import_budget = 0.5
+
+
+@pytest.fixture
+def job(tmp_path, monkeypatch):
+    """ A Job on a fresh viki home under tmp_path, made with `vikid setup` """
+    viki_home = str(tmp_path / '.viki')
+    monkeypatch.setenv('HOME', str(tmp_path))
+
+    # Paths under the home are worked out once, when these modules are imported
+    for module in (_conf, app):
+        monkeypatch.setattr(module, 'home_dir', viki_home)
+        monkeypatch.setattr(module, 'jobs_dir', viki_home + '/jobs')
+        monkeypatch.setattr(module, 'logs_dir', viki_home + '/logs')
+        monkeypatch.setattr(module, 'config_file_abs_path', viki_home + '/' + _conf.config_filename)
+    monkeypatch.setattr(filesystem, 'home', viki_home)
+    monkeypatch.setattr(filesystem, 'jobs_path', viki_home + '/jobs')
+
+    assert cli.main(['setup']) == 0
+
+    return Job()
+
+
+def cold_check():
+    """ Run `vikid check` in a fresh interpreter
+    Returns (exit status, modules loaded, seconds spent importing viki's modules)
+    """
+    script = ("import json, sys\n"
+              "from vikid import cli\n"
+              "status = cli.main(['check'])\n"
+              "print(json.dumps([status, sorted(sys.modules)]))\n")
+
+    finished = subprocess.run([sys.executable, '-X', 'importtime', '-c', script], cwd=root, check=True,
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=dict(os.environ, PYTHONPATH=root))
+    status, modules = json.loads(finished.stdout.splitlines()[-1])
+
+    # "import time: self [us] | cumulative | name", nested imports are indented under their importer
+    import_us = 0
+    for line in finished.stderr.decode().splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line.split('|')
+        if name.startswith(' vikid') and cumulative.strip().isdigit():
+            import_us += int(cumulative)
+
+    return status, modules, import_us / 1000000
+
+
+# --- Tests
+
+
+class TestClass:
+
+    def test_check_stays_light(self, job):
+
+        status, modules, import_time = cold_check()
+
+        assert status == 0
+        assert not [module for module in modules if module.startswith(heavy_modules)]
+
+        # Top level vikid imports only, the ones they import are in their cumulative time
+        assert import_time < check_import_budget
+
+
+    def test_run_exits_with_the_step_status(self, job):
+
+        name = 'pytest-cli-run'
+        job.create_job(name, {"description": "Cli test", "steps": ['test "$1" = pass || exit 3']})
+
+        try:
+            assert cli.main(['run', name, 'pass']) == 0
+            assert cli.main(['run', name, 'fail']) == 3
+            assert cli.main(['run', 'pytest-cli-missing']) == 1
+        finally:
+            job.delete_job(name)
+
+
+    def test_run_that_raises_fails(self, job, monkeypatch, capsys):
+
+        def broken(self, name, *args, **kwargs):
+            raise RuntimeError('engine broke')
+
+        monkeypatch.setattr(Job, 'run_job', broken)
+
+        assert cli.main(['run', '--parallel', 'pytest-cli-a', 'pytest-cli-b']) == 1
+        assert capsys.readouterr().err.count('Run failed: engine broke') == 2
+
+
+    def test_runs_are_recorded_in_the_history(self, job):
+
+        name = 'pytest-cli-history'
+        job.create_job(name, {"description": "Cli test", "steps": ['true']})
+
+        try:
+            assert cli.main(['run', name]) == 0
+
+            # Written by the time vikid exits, without waiting on the batching
+            runs, _ = job.history.query(job=name)
+            assert [(run["status"], run["trigger"]) for run in runs] == [("succeeded", "cli")]
+            assert runs[0]["run_id"]
+        finally:
+            job.delete_job(name)
+
+
+    def test_runs_share_slots_with_other_processes(self, job, tmp_path):
+
+        name = 'pytest-cli-slots'
+        busy = str(tmp_path / 'busy')
+        job.create_job(name, {"description": "Cli test", "concurrency": 1,
+                              "steps": ['mkdir "$1" || exit 9; sleep 0.5; rmdir "$1"']})
+
+        try:
+            other = subprocess.Popen([sys.executable, '-c', 'import sys; from vikid import cli; '
+                                      'sys.exit(cli.main(["run", "{}", "{}"]))'.format(name, busy)],
+                                     cwd=root, env=dict(os.environ, PYTHONPATH=root),
+                                     stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+            # Both runs would fail on finding the other's directory if they overlapped
+            result = job.run_job(name, [busy])
+
+            assert other.wait() == 0
+            assert result["success"] == 1
+        finally:
+            job.delete_job(name)
+
+
+    def test_parallel_runs_stream_their_output(self, job, capfd):
+
+        names = ['pytest-cli-first', 'pytest-cli-second']
+        for name in names:
+            job.create_job(name, {"description": "Cli test", "steps": ['echo "hello from $VIKI_JOB_NAME"']})
+
+        try:
+            assert cli.main(['run', '--parallel'] + names) == 0
+        finally:
+            for name in names:
+                job.delete_job(name)
+
+        output = capfd.readouterr().out.splitlines()
+        for name in names:
+            assert '[{}] hello from {}'.format(name, name) in output
+
+
+    def test_older_invocations(self, job):
+
+        assert cli.main(['--setup']) == 0
+        assert cli.parser().parse_args(['serve', '--workers', '3']).workers == 3
@@ -0,0 +1,98 @@
+"""
+Viki run history tests
+~~~~~~~~~~~~~~~~~~~~~~
+
+Usage:
+    make test
+
+"""
+
+# --- Imports
+
+import sqlite3
+
+import pytest
+
+from vikid.history import HistoryStore
+
+
+# --- Helpers
+
+
+def make_store(tmp_path):
+    store = HistoryStore(str(tmp_path / 'history.db'), flush_interval=0.01)
+
+    for number in range(1, 11):
+        store.record({
+            "job": 'job-a' if number % 2 else 'job-b',
+            "run_number": number,
+            "status": 'failed' if number % 3 == 0 else 'succeeded',
+            "trigger": 'api',
+            "started": 1000.0 + number,
+            "finished": 1000.5 + number,
+            "duration": 0.5,
+            "exit_code": 1 if number % 3 == 0 else 0,
+        })
+
+    assert store.flush(timeout=10)
+
+    return store
+
+
+# --- Tests
+
+
+class TestClass:
+
+    def test_filters(self, tmp_path):
+
+        store = make_store(tmp_path)
+
+        runs, _ = store.query(job='job-a')
+        assert [run["run_number"] for run in runs] == [9, 7, 5, 3, 1]
+
+        runs, _ = store.query(status='failed')
+        assert [run["run_number"] for run in runs] == [9, 6, 3]
+
+        runs, _ = store.query(since=1004, until=1007)
+        assert [run["run_number"] for run in runs] == [6, 5, 4]
+
+
+    def test_cursor_pagination(self, tmp_path):
+
+        store = make_store(tmp_path)
+        seen = []
+        cursor = None
+
+        while True:
+            runs, cursor = store.query(limit=4, cursor=cursor)
+            seen.extend(run["run_number"] for run in runs)
+            if cursor is None:
+                break
+
+        assert seen == list(range(10, 0, -1))
+
+
+    def test_bad_cursor(self, tmp_path):
+
+        store = make_store(tmp_path)
+
+        with pytest.raises(ValueError):
+            store.query(cursor='nonsense')
+
+
+    def test_adds_usage_columns_to_old_databases(self, tmp_path):
+
+        path = str(tmp_path / 'history.db')
+        connection = sqlite3.connect(path)
+        connection.execute('CREATE TABLE runs (id INTEGER PRIMARY KEY AUTOINCREMENT, run_id TEXT, job TEXT NOT NULL, '
+                           'run_number INTEGER, status TEXT NOT NULL, trigger TEXT, started REAL NOT NULL, '
+                           'finished REAL, duration REAL, exit_code INTEGER, message TEXT)')
+        connection.commit()
+        connection.close()
+
+        store = HistoryStore(path, flush_interval=0.01)
+        store.record({"run_id": 'r1', "job": 'job-a', "status": 'succeeded', "started": 1.0, "max_rss": 2048})
+        assert store.flush(timeout=10)
+
+        assert store.get('r1')['max_rss'] == 2048
@@ -9,11 +9,16 @@ Usage:
 
 # --- Imports
 
-from vikid.job.job import Job
-from vikid.fs import fs as filesystem
+from vikid.job import Job
+from vikid import builds
+from vikid import fs as filesystem
+from vikid.locks import FileLock
 
 import sys
 import os
+import threading
+
+import pytest
 
 # --- Vars
 
@@ -104,6 +109,165 @@ class TestClass:
         assert job.update_job(job_name)["message"] == "Job successfully updated"
 
 
+    def test_merge_patch(self):
+
+        config = {"description": "x", "env": {"A": "1", "B": "2"}, "steps": ["true"]}
+        patched = filesystem.merge_patch(config, {"env": {"A": None, "C": "3"}, "steps": ["false"]})
+
+        assert patched == {"description": "x", "env": {"B": "2", "C": "3"}, "steps": ["false"]}
+        assert config["env"] == {"A": "1", "B": "2"}
+
+
+    def test_update_job_merge_patch(self):
+
+        job_name = 'viki-pytest-job-00'
+
+        ret = job.update_job(job_name, {"description": "Updated", "env": {"A": "1"}})
+
+        assert ret["success"] == 1
+        assert job.get_job_config(job_name)["description"] == "Updated"
+        assert job.get_job_config(job_name)["env"] == {"A": "1"}
+        assert ret["etag"] == job.registry.get(job_name).etag()
+
+        assert job.update_job(job_name, {"steps": None})["success"] == 0
+        assert job.update_job(job_name, {"runNumber": 7})["success"] == 0
+
+
+    def test_update_job_stale_etag(self):
+
+        job_name = 'viki-pytest-job-00'
+        etag = job.registry.get(job_name).etag()
+
+        assert job.update_job(job_name, {"env": None}, etag=etag)["success"] == 1
+
+        with pytest.raises(filesystem.StaleConfig):
+            job.update_job(job_name, {"description": "Lost update"}, etag=etag)
+
+        assert job.get_job_config(job_name)["description"] == "Updated"
+
+
+    def test_unusable_configs_are_rejected(self):
+
+        job_name = 'viki-pytest-job-00'
+        config = job.get_job_config(job_name)
+        bad_fields = [
+            {"workspace": "yes"},
+            {"retention": "x"},
+            {"retention": {"keep_runs": "5"}},
+            {"retention": {"max_bytes": -1}},
+            {"trigger": {"cron": "not a cron"}},
+            {"trigger": {"cron": "@daily", "jitter": "soon"}},
+            {"trigger": {"cron": "@daily", "jitter": -1}},
+            {"trigger": {"cron": "@daily", "catchup": "some"}},
+            {"timeout": "10m"},
+            {"step_timeout": 0},
+            {"steps": [{"run": "true", "timeout": -5}]},
+            {"webhook": {"args": "ref"}},
+            {"webhook": {"env": {"GIT_SHA": ["head_commit", "id"]}}},
+            {"webhook": {"debounce": "30s"}},
+        ]
+
+        for fields in bad_fields:
+            created = job.create_job('viki-pytest-bad-config', dict({"description": "x", "steps": ["true"]}, **fields))
+            assert created["success"] == 0
+            assert job.update_job(job_name, fields)["success"] == 0
+
+        assert not filesystem.job_exists('viki-pytest-bad-config')
+        assert job.get_job_config(job_name) == config
+
+
+    def test_concurrent_counter_updates(self):
+
+        job_file = job.jobs_path + '/viki-pytest-job-00/' + job.job_config_filename
+
+        def bump(config):
+            config['runNumber'] += 1
+
+        threads = [threading.Thread(target=lambda: [filesystem.update_job_file(job_file, bump) for _ in range(20)])
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert job.get_job_config('viki-pytest-job-00')['runNumber'] == 80
+
+
+    def test_broken_config_frees_the_run(self):
+
+        job_name = 'viki-pytest-broken-run'
+        job_dir = job.jobs_path + '/' + job_name
+        job.create_job(job_name, {"description": "Broken run test", "steps": ['true']})
+
+        def corrupt(**fields):
+            filesystem.update_job_file(job_dir + '/' + job.job_config_filename, lambda config: config.update(fields))
+            job.registry.invalidate(job_name)
+
+        try:
+            corrupt(workspace='yes')
+            result = job.run_job(job_name)
+
+            assert result["status"] == "failed"
+            assert not os.path.exists('{}/{}.{}'.format(job.running_path, job_name, result["run_number"]))
+            assert builds.read_meta(result["build_dir"])["state"] == "failed"
+
+            slot = FileLock(job_dir + '/run.slot.0')
+            assert slot.acquire(blocking=False)
+            slot.release()
+
+            # Pruning fails after the build is written, the next run must not wait on the slot
+            corrupt(workspace=None, retention='x')
+            assert job.run_job(job_name)["status"] == "succeeded"
+            assert job.run_job(job_name)["run_number"] == 3
+
+            job.history.flush()
+            assert [row["status"] for row in job.history.query(job=job_name)[0]] == ["succeeded", "succeeded", "failed"]
+        finally:
+            job.delete_job(job_name)
+
+
+    def test_prune_keeps_builds_being_started(self, tmp_path):
+
+        job_dir = str(tmp_path)
+        for run_number in (1, 2, 3):
+            builds.write_meta(builds.create_build(job_dir, run_number), {"state": "succeeded"})
+
+        # Created by _start_build, its meta.json is not written yet
+        builds.create_build(job_dir, 4)
+
+        assert builds.prune(job_dir, keep_runs=1) == [2, 1]
+        assert builds.list_builds(job_dir) == [3, 4]
+
+
+    def test_failing_prune_listener(self, tmp_path):
+
+        pruner = builds.Pruner()
+        pruned = threading.Event()
+        seen = []
+
+        def broken(job_dir, removed):
+            raise OSError('listener broke')
+
+        def record(job_dir, removed):
+            seen.append((job_dir, removed))
+            pruned.set()
+
+        pruner.add_listener(broken)
+        pruner.add_listener(record)
+
+        for name in ('a', 'b'):
+            for run_number in (1, 2):
+                builds.write_meta(builds.create_build(str(tmp_path / name), run_number), {"state": "succeeded"})
+
+        # The pruner thread carries on with the next job after the listener fails
+        for name in ('a', 'b'):
+            pruned.clear()
+            pruner.schedule(str(tmp_path / name), keep_runs=1)
+            assert pruned.wait(5)
+
+        assert seen == [(str(tmp_path / 'a'), [1]), (str(tmp_path / 'b'), [1])]
+
+
     def test_delete_job_by_name(self):
 
         job_name = 'viki-pytest-job-00'
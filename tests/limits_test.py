@@ -0,0 +1,92 @@
+"""
+Viki resource limit tests
+~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Usage:
+    make test
+
+"""
+
+# --- Imports
+
+import subprocess
+
+import pytest
+
+from vikid import limits as limits_module
+from vikid.limits import Limits, usage_totals
+from vikid.supervisor import Supervisor
+
+
+# --- Helpers
+
+
+def spawn_limited(limits, command):
+    args, apply, cgroup = limits.prepare(['/bin/sh', '-c', command], 'test')
+    process = Supervisor().spawn(args, stdout=subprocess.PIPE)
+    if apply is not None:
+        apply(process.pid)
+    output = process.popen.stdout.read().decode().split()
+    process.wait(timeout=10)
+    return process, output
+
+
+# --- Tests
+
+
+class TestClass:
+
+    def test_rlimits_and_nice_apply_to_the_step(self):
+
+        limits = Limits({"open_files": 64, "file_size": 4096, "nice": 5})
+
+        process, output = spawn_limited(limits, 'ulimit -n; ulimit -f; nice')
+
+        assert process.return_code == 0
+        # ulimit -f counts 512 byte blocks
+        assert output[:2] == ['64', '8']
+        assert int(output[2]) >= 5
+
+
+    def test_limits_without_the_wrapper_tools(self, monkeypatch):
+
+        monkeypatch.setattr(limits_module.shutil, 'which', lambda name: None)
+        limits = Limits({"open_files": 64, "nice": 5})
+
+        args, apply, _ = limits.prepare(['true'], 'test')
+        assert args == ['true'] and apply is not None
+
+        # Set on the step's pid once it runs, it reads them after a moment
+        process, output = spawn_limited(limits, 'sleep 0.5; ulimit -n; nice')
+
+        assert process.return_code == 0
+        assert output[0] == '64'
+        assert int(output[1]) >= 5
+
+
+    def test_unknown_limits_are_rejected(self):
+
+        with pytest.raises(ValueError):
+            Limits({"gpus": 1})
+
+        with pytest.raises(ValueError):
+            Limits({"ionice": "fastest"})
+
+
+    def test_no_limits_spawns_plainly(self):
+
+        args, apply, cgroup = Limits(None).prepare(['true'], 'test')
+
+        assert (args, apply, cgroup) == (['true'], None, None)
+
+
+    def test_usage_totals(self):
+
+        totals = usage_totals([
+            {"user_time": 1.0, "system_time": 0.5, "max_rss": 100, "read_blocks": 2, "write_blocks": 3},
+            {"user_time": 2.0, "system_time": 0.25, "max_rss": 300, "read_blocks": None, "write_blocks": 1},
+            {"state": "skipped"},
+        ])
+
+        assert totals == {"user_time": 3.0, "system_time": 0.75, "max_rss": 300,
+                          "read_blocks": 2, "write_blocks": 4}
@@ -0,0 +1,99 @@
+"""
+Viki log tests
+~~~~~~~~~~~~~~
+
+Usage:
+    make test
+
+"""
+
+# --- Imports
+
+import gzip
+import time
+
+from vikid import logs
+
+
+# --- Tests
+
+
+class TestClass:
+
+    def test_tail_offset(self, tmp_path):
+
+        log_file = tmp_path / 'output.txt'
+        log_file.write_bytes(b'one\ntwo\nthree\n')
+
+        assert logs.tail_offset(str(log_file), 1) == len(b'one\ntwo\n')
+        assert logs.tail_offset(str(log_file), 2) == len(b'one\n')
+        assert logs.tail_offset(str(log_file), 10) == 0
+
+
+    def test_tail_offset_empty_file(self, tmp_path):
+
+        log_file = tmp_path / 'output.txt'
+        log_file.write_bytes(b'')
+
+        assert logs.tail_offset(str(log_file), 5) == 0
+
+
+    def test_read_chunks(self, tmp_path):
+
+        log_file = tmp_path / 'output.txt'
+        data = b'x' * (logs.chunk_size * 2 + 10)
+        log_file.write_bytes(data)
+
+        chunks = list(logs.read_chunks(str(log_file), 5))
+
+        assert b''.join(chunks) == data[5:]
+        assert max(len(chunk) for chunk in chunks) == logs.chunk_size
+        assert list(logs.read_chunks(str(log_file), len(data))) == []
+
+
+    def test_follow_stops_when_run_finishes(self, tmp_path):
+
+        log_file = tmp_path / 'output.txt'
+        log_file.write_bytes(b'hello\n')
+
+        assert b''.join(logs.follow(str(log_file), 0, lambda: False)) == b'hello\n'
+
+
+    def test_compressed_frames(self, tmp_path, monkeypatch):
+
+        monkeypatch.setattr(logs, 'frame_size', 1000)
+        log_file = str(tmp_path / 'output.txt')
+        data = b''.join(b'line %d\n' % number for number in range(2000))
+
+        writer = logs.open_writer(log_file, 6)
+        for position in range(0, len(data), 300):
+            writer.write(data[position:position + 300])
+        writer.close()
+
+        assert logs.is_compressed(log_file)
+        assert gzip.decompress(open(logs.compressed_file(log_file), 'rb').read()) == data
+
+        with logs.LogReader(log_file) as reader:
+            assert reader.size == len(data)
+            assert len(reader._frames) > 10
+            assert reader.read(995, 1010) == data[995:2005]
+
+        assert b''.join(logs.read_chunks(log_file, 7)) == data[7:]
+        assert logs.tail_offset(log_file, 2) == len(data) - len(b'line 1998\nline 1999\n')
+
+
+    def test_frames_sealed_after_interval(self, tmp_path, monkeypatch):
+
+        monkeypatch.setattr(logs, 'frame_interval', 0.05)
+        log_file = str(tmp_path / 'output.txt')
+
+        writer = logs.open_writer(log_file, 1)
+        writer.write(b'quiet step\n')
+
+        assert logs.size(log_file) == 0
+
+        time.sleep(0.1)
+        writer.flush()
+
+        assert logs.size(log_file) == len(b'quiet step\n')
+        writer.close()
@@ -0,0 +1,78 @@
+"""
+Viki metrics tests
+~~~~~~~~~~~~~~~~~~
+
+Usage:
+    make test
+
+"""
+
+# --- Imports
+
+import threading
+
+from vikid import metrics
+from vikid.profiling import breakdown
+
+
+# --- Tests
+
+
+class TestClass:
+
+    def test_counter_sums_thread_shards(self):
+
+        counter = metrics.Counter('test_total', 'Test counter', ('job',))
+
+        def work():
+            for _ in range(1000):
+                counter.inc('job-a')
+
+        threads = [threading.Thread(target=work) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        counter.inc('job-b', amount=5)
+
+        assert counter.values() == {('job-a',): 8000, ('job-b',): 5}
+        # Shards of the exited threads were folded into one
+        assert len(counter._shards) == 1
+
+
+    def test_histogram_render(self):
+
+        histogram = metrics.Histogram('test_seconds', 'Test histogram', ('job',), buckets=(0.1, 1.0))
+
+        histogram.observe(0.05, 'job-a')
+        histogram.observe(0.1, 'job-a')
+        histogram.observe(5.0, 'job-a')
+
+        assert histogram.render() == [
+            'test_seconds_bucket{job="job-a",le="0.1"} 2',
+            'test_seconds_bucket{job="job-a",le="1.0"} 2',
+            'test_seconds_bucket{job="job-a",le="+Inf"} 3',
+            'test_seconds_sum{job="job-a"} 5.15',
+            'test_seconds_count{job="job-a"} 3',
+        ]
+
+
+    def test_registry_render(self):
+
+        registry = metrics.Registry()
+        registry.register(metrics.Gauge('test_gauge', 'Test gauge', lambda: 3))
+
+        assert registry.render() == '# HELP test_gauge Test gauge\n# TYPE test_gauge gauge\ntest_gauge 3\n'
+
+
+    def test_profile_breakdown(self):
+
+        profile = breakdown([
+            {"name": "build", "state": "succeeded", "wall_time": 2.0, "user_time": 0.5, "system_time": 0.25,
+             "slot_wait": 0.01, "spawn_time": 0.002},
+            {"name": "deploy", "state": "skipped"},
+        ])
+
+        assert profile == [{"name": "build", "slot_wait": 0.01, "spawn": 0.002, "wall": 2.0,
+                            "user": 0.5, "system": 0.25, "off_cpu": 1.25}]
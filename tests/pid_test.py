@@ -0,0 +1,120 @@
+"""
+Viki pid lock and crash recovery tests
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Usage:
+    make test
+
+"""
+
+# --- Imports
+
+import os
+import subprocess
+import time
+
+from vikid import builds
+from vikid.job import Job
+from vikid.locks import FileLock
+from vikid.pid import Lock
+
+
+# --- Helpers
+
+
+job = Job()
+
+
+def crashed_build(name, run_number=1, orphan=True):
+    """ Leave a build behind the way a viki process killed mid run would
+    Returns (build directory, workspace, the orphaned step process)
+    """
+    build_dir = builds.create_build(job.jobs_path + "/" + name, run_number)
+    workspace = job.workspaces.acquire(name).path
+
+    builds.write_meta(build_dir, {"run_number": run_number, "run_id": None, "state": "running",
+                                  "trigger": "manual", "started": time.time(), "workspace": workspace})
+
+    os.makedirs(job.running_path, exist_ok=True)
+    open("{}/{}.{}".format(job.running_path, name, run_number), 'w').close()
+
+    step = None
+    if orphan:
+        step = subprocess.Popen(['sleep', '60'], start_new_session=True,
+                                env=dict(os.environ, VIKI_BUILD_DIR=build_dir))
+
+    return build_dir, workspace, step
+
+
+# --- Tests
+
+
+class TestClass:
+
+    def test_single_instance(self, tmp_path):
+
+        first = Lock(str(tmp_path))
+        second = Lock(str(tmp_path))
+
+        assert first.pid_file_match() == 0
+        assert first.acquire()
+        assert not second.acquire()
+        assert second.owner() == os.getpid()
+        assert first.pid_file_match() == 1
+
+        first.release()
+        assert second.acquire()
+        second.release()
+
+
+    def test_crashed_runs_are_recovered(self):
+
+        name = 'pytest-recover'
+        job.create_job(name, {"description": "Recovery test", "kill_grace": 0.5, "steps": ['true']})
+
+        try:
+            build_dir, workspace, step = crashed_build(name)
+
+            recovered = job.recover_interrupted_runs()
+
+            assert [(build["job"], build["run_number"]) for build in recovered] == [(name, 1)]
+            assert step.wait(timeout=5) < 0
+            assert not os.path.exists(workspace)
+
+            meta = builds.read_meta(build_dir)
+            assert meta["state"] == "interrupted"
+            assert meta["return_code"] == -1
+            assert job.get_job_config(name)["lastFailedRun"] == 1
+            assert not os.path.exists("{}/{}.1".format(job.running_path, name))
+
+            job.history.flush()
+            assert job.history.query(job=name)[0][0]["status"] == "interrupted"
+
+            # Runs carry on numbering after the recovered build
+            assert job.run_job(name)["run_number"] == 2
+        finally:
+            job.delete_job(name)
+
+
+    def test_live_runs_are_left_alone(self):
+
+        name = 'pytest-recover-live'
+        job.create_job(name, {"description": "Recovery test", "steps": ['true']})
+
+        try:
+            build_dir, workspace, _ = crashed_build(name, orphan=False)
+
+            # Held the way a running build's process holds it
+            marker = FileLock("{}/{}.1".format(job.running_path, name))
+            marker.acquire()
+
+            try:
+                assert job.recover_interrupted_runs() == []
+                assert builds.read_meta(build_dir)["state"] == "running"
+                assert os.path.exists(workspace)
+            finally:
+                marker.release()
+
+            assert len(job.recover_interrupted_runs()) == 1
+        finally:
+            job.delete_job(name)
@@ -0,0 +1,86 @@
+"""
+Viki registry tests
+~~~~~~~~~~~~~~~~~~~
+
+Usage:
+    make test
+
+"""
+
+# --- Imports
+
+import json
+
+from vikid.registry import JobRegistry
+
+
+# --- Helpers
+
+
+def make_job(jobs_path, name, config):
+    job_dir = jobs_path / name
+    job_dir.mkdir()
+    (job_dir / 'config.json').write_text(json.dumps(config))
+
+
+# --- Tests
+
+
+class TestClass:
+
+    def test_names_and_prefix(self, tmp_path):
+
+        for name in ['deploy-api', 'deploy-web', 'lint', 'test']:
+            make_job(tmp_path, name, {"steps": []})
+
+        registry = JobRegistry(str(tmp_path))
+
+        assert registry.names() == ['deploy-api', 'deploy-web', 'lint', 'test']
+        assert registry.names('deploy-') == ['deploy-api', 'deploy-web']
+        assert registry.names('nope') == []
+
+
+    def test_sees_added_and_removed_jobs(self, tmp_path):
+
+        make_job(tmp_path, 'a', {"steps": []})
+        registry = JobRegistry(str(tmp_path))
+        etag = registry.etag()
+
+        make_job(tmp_path, 'b', {"steps": []})
+
+        assert registry.names() == ['a', 'b']
+        assert registry.etag() != etag
+
+
+    def test_get_reloads_changed_config(self, tmp_path):
+
+        make_job(tmp_path, 'a', {"steps": ["one"]})
+        registry = JobRegistry(str(tmp_path))
+        seen = []
+        registry.add_listener(lambda name, config: seen.append((name, config)))
+
+        assert registry.get('a').config == {"steps": ["one"]}
+        assert registry.get('a') is registry.get('a')
+
+        (tmp_path / 'a' / 'config.json').write_text(json.dumps({"steps": ["one", "two"]}))
+        registry.invalidate('a')
+
+        assert registry.get('a').config == {"steps": ["one", "two"]}
+        assert seen[-1] == ('a', {"steps": ["one", "two"]})
+        assert registry.get('missing') is None
+
+
+    def test_failing_listener_does_not_stop_the_others(self, tmp_path):
+
+        make_job(tmp_path, 'a', {"steps": []})
+        registry = JobRegistry(str(tmp_path))
+        seen = []
+
+        def broken(name, config):
+            raise ValueError('bad trigger')
+
+        registry.add_listener(broken)
+        registry.add_listener(lambda name, config: seen.append(name))
+
+        assert registry.get('a').config == {"steps": []}
+        assert seen == ['a']
@@ -0,0 +1,244 @@
+"""
+Viki run queue tests
+~~~~~~~~~~~~~~~~~~~~
+
+Usage:
+    make test
+
+"""
+
+# --- Imports
+
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+from vikid.run_queue import QueueFull, RunQueue, request_cancel
+
+
+# --- Helpers
+
+
+class FakeJob:
+    """ Stands in for vikid.job.Job, records how many runs overlap """
+
+    def __init__(self, concurrency=1, duration=0.1, max_pending=0):
+        self.concurrency = concurrency
+        self.max_pending = max_pending
+        self.duration = duration
+        self.lock = threading.Lock()
+        self.active = 0
+        self.peak = 0
+
+    def get_job_config(self, job_name):
+        return {"concurrency": self.concurrency, "max_pending": self.max_pending}
+
+    def run_job(self, name, job_args=None, trigger='api', run_id=None, env=None, control=None, profile=False):
+        with self.lock:
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+        time.sleep(self.duration)
+        with self.lock:
+            self.active -= 1
+        return {"success": 1, "message": "Run successful", "return_code": 0}
+
+
+# A viki process whose queue holds a run that lasts until it is cancelled and one queued behind it
+other_process_script = """
+import sys, time
+from vikid.run_queue import RunQueue
+
+class BlockingJob:
+    def get_job_config(self, job_name):
+        return {}
+
+    def run_job(self, name, job_args=None, control=None, **kwargs):
+        while control.reason is None:
+            time.sleep(0.01)
+        return {"success": 0, "status": control.reason, "message": "", "return_code": -1}
+
+queue = RunQueue(BlockingJob(), workers=1, state_path=sys.argv[1])
+print(queue.submit('job-a').id, queue.submit('job-a').id, flush=True)
+sys.stdin.read()
+"""
+
+
+def other_process(queue, state_path):
+    """ Start other_process_script, returns (process, running run id, queued run id) once its run runs """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    other = subprocess.Popen([sys.executable, '-c', other_process_script, state_path], cwd=root,
+                             env=dict(os.environ, PYTHONPATH=root),
+                             stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    running_id, queued_id = other.stdout.readline().decode().split()
+
+    wait_for_state(queue, running_id, 'running')
+
+    return other, running_id, queued_id
+
+
+def wait_for_state(queue, run_id, state, timeout=5):
+    deadline = time.time() + timeout
+    while (queue.find(run_id) or {}).get("state") != state and time.time() < deadline:
+        time.sleep(0.01)
+    return queue.find(run_id)
+
+
+def wait_for(run, timeout=10):
+    deadline = time.time() + timeout
+    while run.finished_at is None and time.time() < deadline:
+        time.sleep(0.01)
+    return run
+
+
+# --- Tests
+
+
+class TestClass:
+
+    def test_submit_returns_before_run_finishes(self):
+
+        queue = RunQueue(FakeJob(duration=0.3), workers=2)
+
+        run = queue.submit('job-a')
+
+        assert run.state in ('queued', 'running')
+        assert wait_for(run).state == 'succeeded'
+        assert queue.get(run.id) is run
+
+
+    def test_job_concurrency_limit(self):
+
+        fake_job = FakeJob(concurrency=1)
+        queue = RunQueue(fake_job, workers=4)
+
+        runs = [queue.submit('job-a') for _ in range(4)]
+        for run in runs:
+            wait_for(run)
+
+        assert fake_job.peak == 1
+        assert queue.metrics()["completed"] == 4
+
+
+    def test_global_parallelism(self):
+
+        fake_job = FakeJob(concurrency=10)
+        queue = RunQueue(fake_job, workers=2)
+
+        runs = [queue.submit('job-a') for _ in range(6)]
+        for run in runs:
+            wait_for(run)
+
+        assert fake_job.peak == 2
+        assert queue.metrics()["wait_max"] > 0
+
+
+    def test_coalesce_folds_into_queued_run(self):
+
+        queue = RunQueue(FakeJob(duration=0.3), workers=1)
+
+        running = queue.submit('job-a', trigger='webhook', coalesce=True)
+        time.sleep(0.1)
+        queued = queue.submit('job-a', ['one'], trigger='webhook', coalesce=True)
+        latest = queue.submit('job-a', ['two'], trigger='webhook', coalesce=True)
+
+        assert latest is queued and queued is not running
+        assert queued.job_args == ['two'] and queued.coalesced == 1
+        assert queue.pending('job-a') == 2
+
+
+    def test_max_pending(self):
+
+        queue = RunQueue(FakeJob(duration=0.3, max_pending=2), workers=1)
+
+        queue.submit('job-a')
+        queue.submit('job-a')
+
+        with pytest.raises(QueueFull):
+            queue.submit('job-a')
+
+
+    def test_runs_of_other_processes(self, tmp_path):
+
+        queue = RunQueue(FakeJob(), workers=1, state_path=str(tmp_path))
+        other, running_id, queued_id = other_process(queue, str(tmp_path))
+
+        assert queue.find(running_id)["state"] == 'running'
+        assert queue.find(queued_id)["state"] == 'queued'
+        assert queue.find('unknown') is None
+
+        # Runs of a process that has gone are nobody's
+        other.stdin.close()
+        other.wait()
+        assert queue.find(running_id) is None
+
+        # The next queue to start clears its directory away
+        queue.submit('job-a')
+        pid = str(os.getpid())
+        assert sorted(os.listdir(str(tmp_path / 'queue'))) == sorted([pid, pid + '.lock'])
+
+
+    def test_cancel_runs_of_other_processes(self, tmp_path):
+
+        queue = RunQueue(FakeJob(), workers=1, state_path=str(tmp_path))
+        other, running_id, queued_id = other_process(queue, str(tmp_path))
+
+        try:
+            request_cancel(str(tmp_path), queued_id)
+            request_cancel(str(tmp_path), running_id)
+
+            assert wait_for_state(queue, queued_id, 'cancelled')["finished_at"] is not None
+            assert wait_for_state(queue, running_id, 'cancelled')["finished_at"] is not None
+            assert os.listdir(str(tmp_path / 'cancel')) == []
+        finally:
+            other.stdin.close()
+            other.wait()
+
+
+    def test_limits_hold_across_processes(self, tmp_path):
+
+        fake_job = FakeJob(max_pending=2)
+        queue = RunQueue(fake_job, workers=1, state_path=str(tmp_path))
+        other, running_id, queued_id = other_process(queue, str(tmp_path))
+
+        try:
+            # The other process already has both of the job's pending runs
+            with pytest.raises(QueueFull):
+                queue.submit('job-a')
+
+            # And the host's only run slot
+            run = queue.submit('job-b')
+            time.sleep(0.5)
+            assert run.state == 'running' and fake_job.peak == 0
+
+            request_cancel(str(tmp_path), queued_id)
+            request_cancel(str(tmp_path), running_id)
+            assert wait_for(run).state == 'succeeded'
+        finally:
+            other.stdin.close()
+            other.wait()
+
+
+    def test_coalesce_into_run_of_other_process(self, tmp_path):
+
+        queue = RunQueue(FakeJob(), workers=1, state_path=str(tmp_path))
+        other, running_id, queued_id = other_process(queue, str(tmp_path))
+
+        try:
+            assert queue.submit('job-a', ['one'], coalesce=True).id == queued_id
+            run = queue.submit('job-a', ['two'], coalesce=True)
+            assert (run.id, run.coalesced) == (queued_id, 2)
+
+            # Taken over by the other process as the run starts
+            request_cancel(str(tmp_path), running_id)
+            started = wait_for_state(queue, queued_id, 'running')
+            assert (started["args"], started["coalesced"]) == (['two'], 2)
+
+            request_cancel(str(tmp_path), queued_id)
+            wait_for_state(queue, queued_id, 'cancelled')
+        finally:
+            other.stdin.close()
+            other.wait()
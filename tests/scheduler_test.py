@@ -0,0 +1,164 @@
+"""
+Viki scheduler tests
+~~~~~~~~~~~~~~~~~~~~
+
+Usage:
+    make test
+
+"""
+
+# --- Imports
+
+import datetime
+import time
+
+import pytest
+
+from vikid.scheduler import CronExpression, Scheduler, trigger_options
+
+
+# --- Helpers
+
+
+def timestamp(*args):
+    return time.mktime(datetime.datetime(*args).timetuple())
+
+
+# --- Tests
+
+
+class TestClass:
+
+    def test_every_minute(self):
+
+        cron = CronExpression('* * * * *')
+
+        assert cron.next_after(timestamp(2024, 1, 1, 10, 0, 30)) == timestamp(2024, 1, 1, 10, 1)
+
+
+    def test_steps_ranges_and_names(self):
+
+        cron = CronExpression('*/15 9-17 * * mon-fri')
+
+        # Saturday evening rolls over to Monday morning
+        assert cron.next_after(timestamp(2024, 1, 6, 18, 0)) == timestamp(2024, 1, 8, 9, 0)
+        assert cron.next_after(timestamp(2024, 1, 8, 9, 0)) == timestamp(2024, 1, 8, 9, 15)
+        assert cron.next_after(timestamp(2024, 1, 8, 17, 45)) == timestamp(2024, 1, 9, 9, 0)
+
+
+    def test_aliases_and_month_rollover(self):
+
+        assert CronExpression('@monthly').next_after(timestamp(2024, 1, 31, 12, 0)) == timestamp(2024, 2, 1, 0, 0)
+        assert CronExpression('0 0 29 2 *').next_after(timestamp(2024, 3, 1)) == timestamp(2028, 2, 29)
+
+
+    def test_day_of_month_or_weekday(self):
+
+        # 13th of the month or any Friday
+        cron = CronExpression('0 0 13 * 5')
+
+        assert cron.next_after(timestamp(2024, 1, 1)) == timestamp(2024, 1, 5)
+        assert cron.next_after(timestamp(2024, 1, 12, 1)) == timestamp(2024, 1, 13)
+
+
+    def test_invalid_expressions(self):
+
+        for expression in ['* * * *', '60 * * * *', '* * * * mon-xyz', '*/0 * * * *']:
+            with pytest.raises(ValueError):
+                CronExpression(expression)
+
+        with pytest.raises(ValueError):
+            CronExpression('0 0 30 2 *').next_after(time.time())
+
+
+    def test_trigger_options(self):
+
+        assert trigger_options(None) == {}
+        assert trigger_options({"cron": "@daily", "jitter": 30, "catchup": "all"})["jitter"] == 30
+
+        for trigger in ["@daily", {"cron": 5}, {"cron": "0 0 30 2 *"}, {"cron": "@daily", "jitter": -1},
+                        {"cron": "@daily", "jitter": "30"}, {"cron": "@daily", "catchup": "never"}]:
+            with pytest.raises(ValueError):
+                trigger_options(trigger)
+
+        # Written by hand, the job is left unscheduled rather than failing the registry
+        scheduler = Scheduler(lambda name: None)
+        scheduler.update_job('job-a', {"trigger": {"cron": "@daily", "jitter": "soon"}})
+        assert scheduler.schedule() == []
+
+
+    def test_update_job_keeps_schedule_for_same_trigger(self):
+
+        scheduler = Scheduler(lambda name: None)
+        config = {"trigger": {"cron": "0 * * * *"}}
+
+        scheduler.update_job('job-a', config)
+        first = scheduler.schedule()
+
+        scheduler.update_job('job-a', dict(config, runNumber=2))
+        assert scheduler.schedule() == first
+
+        scheduler.update_job('job-a', None)
+        assert scheduler.schedule() == []
+
+
+    def test_due_entries_fire(self):
+
+        fired = []
+        scheduler = Scheduler(fired.append, misfire_grace=3600)
+        scheduler.update_job('job-a', {"trigger": {"cron": "* * * * *"}})
+
+        scheduler.start()
+
+        # Pretend the deadline has passed, without crossing a minute boundary
+        # so the entry's next fire is still in the future
+        with scheduler._cond:
+            entry = scheduler._entries['job-a']
+            scheduler._heap = [(0, entry.generation, 'job-a')]
+            now = time.time()
+            entry.scheduled = now - min(1, now % 60)
+            scheduler._cond.notify()
+
+        deadline = time.time() + 5
+        while not fired and time.time() < deadline:
+            time.sleep(0.01)
+        scheduler.stop()
+
+        assert fired == ['job-a']
+        assert scheduler.schedule()[0]["next_fire"] > time.time()
+
+
+    def test_missed_fires_catchup_policies(self):
+
+        for catchup, runs in [('skip', 0), ('once', 1), ('all', 10)]:
+            scheduler = Scheduler(lambda name: None, misfire_grace=1)
+            scheduler.update_job('job-a', {"trigger": {"cron": "* * * * *", "catchup": catchup}})
+
+            # Ten minutes worth of fires are overdue, the latest one is the current minute
+            now = time.time()
+            entry = scheduler._entries['job-a']
+            entry.scheduled = now - now % 60 - 9 * 60
+
+            with scheduler._cond:
+                assert scheduler._fire(entry, now) == runs
+
+
+    def test_start_reschedules_from_the_last_run(self):
+
+        dispatched = []
+        fired = {'job-a': time.time() - 3600}
+        scheduler = Scheduler(dispatched.append, last_fired=fired.get)
+        scheduler.update_job('job-a', {"trigger": {"cron": "* * * * *"}})
+
+        # Overdue while this process waited for the scheduler lock
+        assert scheduler._entries['job-a'].scheduled < time.time()
+
+        # The process leading the scheduler meanwhile ran it
+        fired['job-a'] = time.time()
+        scheduler.start()
+
+        try:
+            assert scheduler.schedule()[0]["next_fire"] > fired['job-a']
+            assert dispatched == []
+        finally:
+            scheduler.stop()
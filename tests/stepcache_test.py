@@ -0,0 +1,170 @@
+"""
+Viki step cache tests
+~~~~~~~~~~~~~~~~~~~~~
+
+Usage:
+    make test
+
+"""
+
+# --- Imports
+
+import os
+import time
+
+import pytest
+
+from vikid import logs, stepcache
+from vikid.artifacts import ArtifactStore
+from vikid.job import Job
+from vikid.stepcache import StepCache
+
+
+# --- Helpers
+
+
+job = Job()
+
+step = {"name": "deps", "run": "make deps",
+        "cache": stepcache.spec({"inputs": ["*.lock"], "env": ["TARGET"], "outputs": ["out/**"]}, "deps")}
+
+
+def make_cache(tmp_path, max_bytes=0):
+    return StepCache(str(tmp_path / 'stepcache'), ArtifactStore(str(tmp_path / 'artifacts')), max_bytes)
+
+
+def make_workspace(tmp_path, files):
+    workspace = tmp_path / 'workspace'
+
+    for path, contents in files.items():
+        (workspace / path).parent.mkdir(parents=True, exist_ok=True)
+        (workspace / path).write_bytes(contents)
+
+    return str(workspace)
+
+
+def store(cache, workspace, key, output=b''):
+    pending = cache.begin()
+    with open(pending + '/' + stepcache.log_filename, 'w') as record:
+        if output:
+            record.write('{"stream": "stdout", "data": "%s"}\n' % output.decode())
+    cache.store(key, pending, workspace, 'build', step)
+
+
+# --- Tests
+
+
+class TestClass:
+
+    def test_spec(self):
+
+        assert stepcache.spec(None, 'deps') is None
+        assert stepcache.spec({}, 'deps') == {"inputs": [], "env": [], "outputs": []}
+
+        for config in ([], {"inputs": ["../x"]}, {"env": "PATH"}, {"output": ["x"]}):
+            with pytest.raises(ValueError):
+                stepcache.spec(config, 'deps')
+
+
+    def test_key_follows_declared_inputs(self, tmp_path):
+
+        cache = make_cache(tmp_path)
+        workspace = make_workspace(tmp_path, {"deps.lock": b'one', "notes.txt": b'x'})
+
+        key = cache.key('build', step, ['a'], {"TARGET": "x86"}, workspace)
+
+        # Undeclared files and variables don't matter
+        (tmp_path / 'workspace' / 'notes.txt').write_bytes(b'y')
+        assert cache.key('build', step, ['a'], {"TARGET": "x86", "HOME": "/"}, workspace) == key
+
+        assert cache.key('build', step, ['b'], {"TARGET": "x86"}, workspace) != key
+        assert cache.key('build', step, ['a'], {"TARGET": "arm"}, workspace) != key
+        assert cache.key('other', step, ['a'], {"TARGET": "x86"}, workspace) != key
+
+        (tmp_path / 'workspace' / 'deps.lock').write_bytes(b'two')
+        assert cache.key('build', step, ['a'], {"TARGET": "x86"}, workspace) != key
+
+
+    def test_store_and_restore(self, tmp_path):
+
+        cache = make_cache(tmp_path)
+        workspace = make_workspace(tmp_path, {"out/tool": b'#!/bin/sh\n', "out/lib/data": b'data'})
+        os.chmod(workspace + '/out/tool', 0o755)
+
+        assert cache.restore('k1', workspace) is None
+        store(cache, workspace, 'k1', b'built\\n')
+
+        os.remove(workspace + '/out/tool')
+        with open(workspace + '/out/lib/data', 'wb') as changed:
+            changed.write(b'changed')
+
+        assert cache.restore('k1', workspace) == [("stdout", b'built\n')]
+        assert open(workspace + '/out/lib/data', 'rb').read() == b'data'
+        assert os.stat(workspace + '/out/tool').st_mode & 0o777 == 0o755
+        assert cache.usage('build') == {"entries": 1, "bytes": len(b'#!/bin/sh\n') + len(b'data') +
+                                        os.path.getsize(cache.entries_path + '/k1/' + stepcache.log_filename)}
+
+
+    def test_least_recently_used_are_evicted(self, tmp_path):
+
+        cache = make_cache(tmp_path, max_bytes=2500)
+
+        store(cache, make_workspace(tmp_path, {"out/blob": b'1' * 1000}), 'old')
+        store(cache, make_workspace(tmp_path, {"out/blob": b'2' * 1000}), 'used')
+        os.utime(cache.entries_path + '/old', (time.time() - 60, time.time() - 60))
+        os.utime(cache.entries_path + '/used', (time.time() - 120, time.time() - 120))
+
+        # Hitting an entry makes it the most recently used
+        assert cache.restore('used', make_workspace(tmp_path, {})) is not None
+
+        store(cache, make_workspace(tmp_path, {"out/blob": b'3' * 1000}), 'new')
+
+        assert sorted(os.listdir(cache.entries_path)) == ['new', 'used']
+
+
+    def test_stats(self, tmp_path):
+
+        cache = make_cache(tmp_path)
+        cache.count('build', 'deps', False)
+        cache.count('build', 'deps', True)
+        cache.count('build', 'deps', True)
+
+        assert cache.stats('build') == {"hits": 2, "misses": 1, "steps": {"deps": {"hits": 2, "misses": 1}}}
+        assert cache.stats('other')["hits"] == 0
+
+        cache.forget('build')
+        assert cache.stats('build')["hits"] == 0
+
+
+    def test_cached_steps_are_not_run_again(self, tmp_path):
+
+        counter = tmp_path / 'executions'
+        name = 'pytest-step-cache'
+        job.create_job(name, {"description": "Step cache test", "steps": [
+            {"name": "compile", "run": "echo compiling; echo x >> {}; mkdir -p out; echo \"$1\" > out/result".format(counter),
+             "cache": {"outputs": ["out/*"]}},
+            {"name": "check", "run": "cat out/result", "needs": ["compile"]},
+        ], "artifacts": ["out/result"]})
+
+        try:
+            first = job.run_job(name, ['v1'])
+            second = job.run_job(name, ['v1'])
+            third = job.run_job(name, ['v2'])
+
+            assert [run["status"] for run in (first, second, third)] == ["succeeded"] * 3
+            assert counter.read_text() == 'x\nx\n'
+
+            assert first["steps"][0]["cached"] is False
+            assert second["steps"][0]["cached"] is True
+            assert second["steps"][1]["cached"] is False
+
+            # The restored output reaches the next step, the replayed log reads as if the step ran
+            assert open(second["build_dir"] + '/artifacts/out/result').read() == 'v1\n'
+            replayed = b''.join(logs.read_chunks(second["build_dir"] + '/output.txt'))
+            assert b'compiling\n' in replayed and b'v1\n' in replayed
+
+            assert job.get_step_cache(name)["cache"]["steps"] == {"compile": {"hits": 1, "misses": 2}}
+        finally:
+            job.delete_job(name)
+
+        assert job.step_cache.stats(name)["misses"] == 0
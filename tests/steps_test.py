@@ -0,0 +1,136 @@
+"""
+Viki step graph tests
+~~~~~~~~~~~~~~~~~~~~~
+
+Usage:
+    make test
+
+"""
+
+# --- Imports
+
+import subprocess
+import threading
+import time
+
+import pytest
+
+from vikid.steps import RunControl, StepGraph
+from vikid.supervisor import Supervisor
+
+
+# --- Helpers
+
+
+supervisor = Supervisor()
+
+
+def start(step):
+    return supervisor.spawn(['/bin/sh', '-c', step['run']], command=step['run'],
+                            stdout=subprocess.DEVNULL, start_new_session=True)
+
+
+# --- Tests
+
+
+class TestClass:
+
+    def test_plain_steps_run_in_order(self):
+
+        graph = StepGraph(["echo one", "echo two", "echo three"])
+
+        assert graph.order == ['step-1', 'step-2', 'step-3']
+        assert graph.steps[2]['needs'] == ['step-2']
+
+
+    def test_rejects_unknown_needs_and_cycles(self):
+
+        with pytest.raises(ValueError):
+            StepGraph([{"name": "a", "run": "true", "needs": ["missing"]}])
+
+        with pytest.raises(ValueError):
+            StepGraph([{"name": "a", "run": "true", "needs": ["b"]},
+                       {"name": "b", "run": "true", "needs": ["a"]}])
+
+        # Caught before anything is spawned, not once the step is running
+        for timeout in ["10s", 0, True]:
+            with pytest.raises(ValueError):
+                StepGraph([{"name": "a", "run": "true", "timeout": timeout}])
+
+
+    def test_independent_steps_overlap(self):
+
+        graph = StepGraph([
+            {"name": "lint", "run": "sleep 0.4"},
+            {"name": "test", "run": "sleep 0.4"},
+            {"name": "deploy", "run": "true", "needs": ["lint", "test"]},
+        ])
+
+        began = time.monotonic()
+        results = graph.run(start, max_parallel=2)
+
+        assert time.monotonic() - began < 0.75
+        assert [result['state'] for result in results] == ['succeeded'] * 3
+
+
+    def test_failure_cancels_siblings(self):
+
+        graph = StepGraph([
+            {"name": "slow", "run": "sleep 30"},
+            {"name": "broken", "run": "sleep 0.2; exit 4"},
+            {"name": "after", "run": "true", "needs": ["slow", "broken"]},
+        ])
+
+        began = time.monotonic()
+        results = graph.run(start, max_parallel=2)
+
+        assert time.monotonic() - began < 10
+        assert [result['state'] for result in results] == ['cancelled', 'failed', 'skipped']
+        assert results[1]['return_code'] == 4
+
+
+    def test_critical_path(self):
+
+        graph = StepGraph([
+            {"name": "checkout", "run": "true"},
+            {"name": "lint", "run": "true", "needs": ["checkout"]},
+            {"name": "test", "run": "true", "needs": ["checkout"]},
+            {"name": "deploy", "run": "true", "needs": ["lint", "test"]},
+        ])
+
+        path = graph.critical_path({"checkout": 1.0, "lint": 2.0, "test": 5.0, "deploy": 1.0})
+
+        assert path == {"steps": ["checkout", "test", "deploy"], "duration": 7.0}
+
+
+    def test_step_timeout(self):
+
+        graph = StepGraph([{"name": "hang", "run": "sleep 30", "timeout": 0.2}, "true"])
+
+        began = time.monotonic()
+        results = graph.run(start, control=RunControl(grace=1))
+
+        assert time.monotonic() - began < 5
+        assert [result['state'] for result in results] == ['timed_out', 'skipped']
+
+
+    def test_run_timeout(self):
+
+        graph = StepGraph(["sleep 30", "true"])
+        control = RunControl(grace=1)
+
+        results = graph.run(start, control=control, timeout=0.2)
+
+        assert control.reason == 'timed_out'
+        assert [result['state'] for result in results] == ['timed_out', 'skipped']
+
+
+    def test_cancel_from_another_thread(self):
+
+        graph = StepGraph(["sleep 30", "true"])
+        control = RunControl(grace=1)
+
+        threading.Timer(0.2, control.stop, args=('cancelled',)).start()
+        results = graph.run(start, control=control)
+
+        assert [result['state'] for result in results] == ['cancelled', 'skipped']
@@ -0,0 +1,84 @@
+"""
+Viki supervisor tests
+~~~~~~~~~~~~~~~~~~~~~
+
+Usage:
+    make test
+
+"""
+
+# --- Imports
+
+import os
+import subprocess
+import time
+
+import pytest
+
+from vikid.supervisor import Supervisor
+
+
+# --- Tests
+
+
+class TestClass:
+
+    def test_spawn_reports_return_code(self):
+
+        supervisor = Supervisor()
+
+        process = supervisor.spawn(['/bin/sh', '-c', 'exit 3'], stdout=subprocess.DEVNULL)
+
+        assert process.wait(timeout=10) == 3
+        assert process.popen.returncode == 3
+
+
+    def test_spawn_records_timings(self):
+
+        supervisor = Supervisor()
+
+        process = supervisor.spawn(['/bin/sh', '-c', 'sleep 0.2'], command='sleep')
+
+        assert process.wait(timeout=10) == 0
+
+        stats = process.to_dict()
+        assert stats["running"] is False
+        assert stats["wall_time"] >= 0.2
+        assert stats["user_time"] is not None
+
+
+    def test_processes_tracks_live_children(self):
+
+        supervisor = Supervisor()
+
+        process = supervisor.spawn(['/bin/sh', '-c', 'sleep 5'])
+
+        assert process.pid in [p.pid for p in supervisor.processes()]
+        assert process.wait(timeout=0.05) is None
+
+        process.popen.kill()
+
+        assert process.wait(timeout=10) == -9
+        assert supervisor.processes() == []
+
+
+    def test_kill_takes_down_process_group(self):
+
+        supervisor = Supervisor()
+
+        # The shell ignores SIGTERM, so only SIGKILL after the grace period stops it
+        process = supervisor.spawn(['/bin/sh', '-c', 'trap "" TERM; sleep 30 & wait'],
+                                   start_new_session=True)
+        time.sleep(0.2)
+
+        began = time.monotonic()
+        process.kill(grace=0.3)
+
+        assert process.wait(timeout=10) is not None
+        assert time.monotonic() - began >= 0.3
+
+        # The orphaned sleep is killed too, give init a moment to reap it
+        with pytest.raises(ProcessLookupError):
+            for _ in range(50):
+                os.killpg(process.pid, 0)
+                time.sleep(0.1)
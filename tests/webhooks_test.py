@@ -0,0 +1,116 @@
+"""
+Viki webhook tests
+~~~~~~~~~~~~~~~~~~
+
+Usage:
+    make test
+
+"""
+
+# --- Imports
+
+import hashlib
+import hmac
+import json
+import time
+
+from vikid import webhooks
+
+
+# --- Helpers
+
+
+class FakeQueue:
+    """ Stands in for RunQueue.submit, records what was queued """
+
+    class Run:
+        id = 'run'
+        coalesced = 0
+
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, job_name, job_args=None, trigger='api', coalesce=False, **run_options):
+        self.submitted.append((job_name, job_args, trigger, run_options.get('env')))
+        return self.Run()
+
+
+# --- Tests
+
+
+class TestClass:
+
+    def test_verify_signature(self):
+
+        body = b'{"ref": "refs/heads/master"}'
+        signature = 'sha256=' + hmac.new(b'secret', body, hashlib.sha256).hexdigest()
+
+        assert webhooks.verify_signature('secret', body, signature)
+        assert not webhooks.verify_signature('other', body, signature)
+        assert not webhooks.verify_signature('secret', body, None)
+
+
+    def test_payload_to_args_and_env(self):
+
+        payload = {"ref": "refs/heads/master", "commits": [{"id": "abc"}], "head_commit": {"id": "def"}}
+        config = {"args": ["ref", "commits.0.id", "missing.field"], "env": {"GIT_SHA": "head_commit.id"}}
+
+        assert webhooks.run_inputs(config, payload) == {
+            "job_args": ["refs/heads/master", "abc", ""],
+            "env": {"GIT_SHA": "def"},
+        }
+
+
+    def test_debounce_starts_one_run_with_latest_payload(self, tmp_path):
+
+        queue = FakeQueue()
+        receiver = webhooks.WebhookReceiver(queue.submit, str(tmp_path))
+        config = {"debounce": 0.3, "args": ["after"]}
+
+        for number in range(5):
+            assert receiver.receive('job-a', config, {"after": str(number)}) is None
+
+        time.sleep(0.6)
+
+        assert queue.submitted == [('job-a', ['4'], 'webhook', {})]
+
+
+    def test_no_debounce_queues_straight_away(self, tmp_path):
+
+        queue = FakeQueue()
+        receiver = webhooks.WebhookReceiver(queue.submit, str(tmp_path))
+
+        assert receiver.receive('job-a', {}, {}) is not None
+        assert len(queue.submitted) == 1
+
+
+    def test_debounce_window_is_shared_between_processes(self, tmp_path):
+
+        queue = FakeQueue()
+        config = {"debounce": 0.3, "args": ["after"]}
+
+        # Each receiver's locks are separate open files, the way another process's would be
+        first = webhooks.WebhookReceiver(queue.submit, str(tmp_path))
+        second = webhooks.WebhookReceiver(queue.submit, str(tmp_path))
+
+        assert first.receive('job-a', config, {"after": "1"}) is None
+        assert second.receive('job-a', config, {"after": "2"}) is None
+        time.sleep(0.6)
+
+        assert queue.submitted == [('job-a', ['2'], 'webhook', {})]
+
+
+    def test_window_of_a_dead_process_is_taken_over(self, tmp_path):
+
+        queue = FakeQueue()
+        receiver = webhooks.WebhookReceiver(queue.submit, str(tmp_path))
+
+        # Left behind by a process that died before its window closed, nobody holds job-a.window
+        (tmp_path / 'webhooks').mkdir()
+        (tmp_path / 'webhooks' / 'job-a.json').write_text(json.dumps(
+            {"deadline": time.time() - 1, "inputs": {"job_args": ["1"], "env": {}}, "deliveries": 3}))
+
+        assert receiver.receive('job-a', {"debounce": 30, "args": ["after"]}, {"after": "2"}) is None
+        time.sleep(0.3)
+
+        assert queue.submitted == [('job-a', ['2'], 'webhook', {})]
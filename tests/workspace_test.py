@@ -0,0 +1,70 @@
+"""
+Viki workspace tests
+~~~~~~~~~~~~~~~~~~~~
+
+Usage:
+    make test
+
+"""
+
+# --- Imports
+
+import os
+import time
+
+from vikid.workspace import WorkspacePool
+
+
+# --- Tests
+
+
+class TestClass:
+
+    def test_fresh_workspace_is_removed(self, tmp_path):
+
+        pool = WorkspacePool(str(tmp_path))
+
+        workspace = pool.acquire('job-a')
+        assert os.path.isdir(workspace.path)
+
+        pool.release(workspace)
+        assert not os.path.exists(workspace.path)
+
+
+    def test_persistent_workspace_is_reused(self, tmp_path):
+
+        pool = WorkspacePool(str(tmp_path))
+
+        workspace = pool.acquire('job-a', persistent=True)
+        open(workspace.path + '/artifact', 'w').close()
+        pool.release(workspace)
+
+        workspace = pool.acquire('job-a', persistent=True)
+        assert os.path.exists(workspace.path + '/artifact')
+
+        # A second run of the same job can't share it
+        other = pool.acquire('job-a', persistent=True)
+        assert other.path != workspace.path
+        assert not other.persistent
+
+        pool.release(other)
+        pool.release(workspace)
+
+
+    def test_least_recently_used_is_evicted(self, tmp_path):
+
+        pool = WorkspacePool(str(tmp_path))
+
+        for job_name in ['old', 'new']:
+            workspace = pool.acquire(job_name, persistent=True)
+            with open(workspace.path + '/blob', 'wb') as file_obj:
+                file_obj.write(b'x' * 1000)
+            pool.release(workspace)
+            os.utime(workspace.path, (time.time() - 100, time.time() - 100) if job_name == 'old' else None)
+
+        # Evict synchronously rather than on the background thread
+        pool.max_cache_bytes = 1500
+        pool._evict({'old', 'new'})
+
+        assert not os.path.exists(pool.cache_path + '/old')
+        assert os.path.exists(pool.cache_path + '/new/blob')
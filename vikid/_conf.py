@@ -19,10 +19,77 @@ logs_dir = home_dir + "/logs"
 config_filename = "viki.json"
 config_file_abs_path = home_dir + "/" + config_filename
 
+# Serving, `vikid serve` flags override these
+bind = "127.0.0.1:9898"
+workers = 2
+threads = 8
+keepalive = 5
+graceful_timeout = 30
+
+# Queued runs executed at once, across all of the daemon's worker processes
+max_parallel_runs = 4
+# Runs of a single job allowed at once, jobs override it with "concurrency"
+job_concurrency = 1
+# Queued plus running runs a single job may have, jobs override it with "max_pending"
+# Zero means unlimited
+job_max_pending = 0
+# Steps of one run allowed at once, jobs override it with "max_parallel_steps"
+max_parallel_steps = 4
+# Build retention, jobs override it with "retention": {"keep_runs", "max_bytes"}
+# Zero disables that limit
+build_keep_runs = 50
+build_max_bytes = 0
+# Cron triggers, jobs override jitter/catchup in their "trigger" block
+cron_jitter = 0
+cron_catchup = "once"
+cron_misfire_grace = 60
+# Disk budget for persistent job workspaces, least recently used are evicted first
+# Zero means unlimited
+workspace_cache_max_bytes = 10 * 1024 * 1024 * 1024
+# Seconds a stopped step gets between SIGTERM and SIGKILL, jobs override it with "kill_grace"
+kill_grace = 10
+# cgroup v2 directory viki may create step cgroups in, e.g. /sys/fs/cgroup/viki
+# Empty disables the "cgroup" job limits
+cgroup_root = ""
+# Longest chain of runs started by on_success/on_failure/fan_out/join
+chain_max_depth = 20
+# Recent step output kept in memory per run for live log subscribers
+capture_buffer_bytes = 1024 * 1024
+# zlib level build logs are compressed with, jobs override it with "log_compression"
+# Zero stores logs as plain text
+log_compression = 6
+# Disk budget for the step cache, least recently used entries are evicted first
+# Zero means unlimited
+step_cache_max_bytes = 5 * 1024 * 1024 * 1024
+# How often job configs are re-checked for changes made outside viki
+registry_rescan_interval = 60
+
 __all__ = [
     "home_dir",
     "jobs_dir",
     "config_filename",
     "config_file_abs_path",
-    "logs_dir"
+    "logs_dir",
+    "bind",
+    "workers",
+    "threads",
+    "keepalive",
+    "graceful_timeout",
+    "max_parallel_runs",
+    "job_concurrency",
+    "job_max_pending",
+    "max_parallel_steps",
+    "build_keep_runs",
+    "build_max_bytes",
+    "cron_jitter",
+    "cron_catchup",
+    "cron_misfire_grace",
+    "workspace_cache_max_bytes",
+    "kill_grace",
+    "cgroup_root",
+    "chain_max_depth",
+    "capture_buffer_bytes",
+    "log_compression",
+    "step_cache_max_bytes",
+    "registry_rescan_interval"
 ]
@@ -11,7 +11,6 @@ This module implements the App class for main application details and system che
 import os
 import vikid._version
 import vikid._conf
-import logging
 
 """
     "home_dir",
@@ -40,14 +39,63 @@ logging_config = dict(
         'h': {'class': 'logging.FileHandler',
         'formatter': 'f',
         'filename': logs_dir + '/viki.log',
-        'level': logging.DEBUG}
+        'level': 'DEBUG'}
     },
     root = {
         'handlers': ['h'],
-        'level': logging.DEBUG,
+        'level': 'DEBUG',
     },
 )
 
+# Parsed viki.json and the (path, inode, mtime, size) it was read at
+_config_cache = (None, {})
+
+
+def read_config():
+    """ Read the viki configuration file
+    Returns the parsed contents of viki.json, or an empty dict
+    if it is missing, empty or not valid json
+    The file is only parsed again once it changes, don't modify what is returned
+    """
+    global _config_cache
+
+    try:
+        stat = os.stat(config_file_abs_path)
+    except OSError:
+        return {}
+
+    version = (config_file_abs_path, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    if _config_cache[0] == version:
+        return _config_cache[1]
+
+    # Imported here so the cli can check the system setup without it
+    import json
+
+    try:
+        with open(config_file_abs_path, 'r') as file_obj:
+            config = json.loads(file_obj.read() or '{}')
+    except (OSError, ValueError):
+        config = {}
+
+    if not isinstance(config, dict):
+        config = {}
+
+    _config_cache = (version, config)
+
+    return config
+
+
+def get_setting(name, config=None):
+    """ Look up a single setting
+    Values in viki.json override the defaults in vikid._conf
+    config: viki.json as returned by read_config(), to look up several settings from one read
+    """
+    if config is None:
+        config = read_config()
+
+    return config.get(name, getattr(vikid._conf, name, None))
+
+
 def check_system_setup():
     """ This will be run every time viki starts up
     It will check to make sure the home directory exists,
@@ -0,0 +1,99 @@
+# coding: utf-8
+
+"""
+factory.py
+~~~~~~~~~~
+
+This module implements the Flask app factory for Viki.
+
+Every serving process builds its app through create_app(), whether it is
+the dev server or one of several gunicorn workers:
+
+    gunicorn 'vikid.application.factory:create_app()'
+
+Cron triggers must only fire once per host, so only the worker holding
+the scheduler lock runs the scheduler. If that worker dies the kernel
+drops its lock and another worker takes over, picking each trigger up
+from when its job last ran.
+
+Builds left running by a viki process that died are recovered in the
+background as each app starts. Every build's process holds a lock on it,
+so workers never take each other's builds for crashed ones.
+:license: Apache2, see LICENSE for more details
+"""
+
+import logging
+import os
+import threading
+from logging.config import dictConfig
+from typing import Optional
+
+from flask import Flask
+
+from vikid.application import app as viki_app
+from vikid.locks import FileLock
+
+scheduler_lock_filename = "scheduler.lock"
+
+# Held for the life of the process once this process leads the scheduler
+_scheduler_lock: Optional[FileLock] = None
+
+
+def _default_root_path() -> Optional[str]:
+    """ The UI's templates and static files ship in the bin package """
+    try:
+        import bin
+    except ImportError:
+        return None
+
+    return os.path.dirname(os.path.abspath(bin.__file__))
+
+
+def _lead_scheduler(scheduler) -> None:
+    """ Block until this process holds the scheduler lock, then start the scheduler """
+    global _scheduler_lock
+
+    lock = FileLock(viki_app.home_dir + "/" + scheduler_lock_filename)
+    lock.acquire()
+    _scheduler_lock = lock
+
+    logging.getLogger(__name__).info('Process %d is running the cron scheduler', os.getpid())
+    scheduler.start()
+
+
+def _recover_runs(job) -> None:
+    """ Stop and record the builds a crashed viki process left running """
+    try:
+        job.recover_interrupted_runs()
+    except Exception:
+        logging.getLogger(__name__).exception('Recovering interrupted runs failed')
+
+
+def create_app(root_path: Optional[str] = None, start_scheduler: bool = True, recover: bool = True) -> Flask:
+    """ Build the viki Flask app
+    root_path: Where the UI's templates/ and static/ live, defaults to the bin package
+    start_scheduler: Compete for the scheduler lock and fire cron triggers when we win it
+    recover: Recover builds left running by a viki process that died
+    """
+    # Imported here so importing the factory stays cheap
+    from vikid.blueprints import api_blueprint, ui_blueprint
+
+    dictConfig(viki_app.logging_config)
+
+    app = Flask('vikid', root_path=root_path or _default_root_path())
+
+    app.register_blueprint(ui_blueprint.ui_blueprint)
+    app.register_blueprint(api_blueprint.api_blueprint)
+
+    # Read every job config once up front, this also fills the cron schedule
+    api_blueprint.job.registry.load()
+
+    if recover:
+        threading.Thread(target=_recover_runs, args=(api_blueprint.job,),
+                         name='viki-recover-runs', daemon=True).start()
+
+    if start_scheduler:
+        threading.Thread(target=_lead_scheduler, args=(api_blueprint.scheduler,),
+                         name='viki-scheduler-lock', daemon=True).start()
+
+    return app
@@ -0,0 +1,49 @@
+# coding: utf-8
+
+"""
+server.py
+~~~~~~~~~
+
+This module runs Viki under gunicorn for production use.
+
+Workers are gthread workers so a slow client following a log doesn't
+hold up a whole process. Send the master SIGHUP for a graceful reload:
+new workers are started with the current config and old ones finish
+their in-flight requests before exiting.
+:license: Apache2, see LICENSE for more details
+"""
+
+from typing import Any, Dict, Optional
+
+
+def serve(bind: str, workers: int, threads: int, keepalive: int, graceful_timeout: int,
+          reload: bool = False, root_path: Optional[str] = None) -> None:
+    """ Serve the viki app with gunicorn until the master is stopped """
+    from gunicorn.app.base import BaseApplication
+
+    from vikid.application.factory import create_app
+
+    class VikiApplication(BaseApplication):
+        """ Embedded gunicorn application, each worker builds its own app """
+
+        def __init__(self, options: Dict[str, Any]):
+            self.options = options
+            super().__init__()
+
+        def load_config(self) -> None:
+            for key, value in self.options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return create_app(root_path=root_path)
+
+    VikiApplication({
+        'bind': bind,
+        'workers': workers,
+        'worker_class': 'gthread',
+        'threads': threads,
+        'keepalive': keepalive,
+        'graceful_timeout': graceful_timeout,
+        'reload': reload,
+        'proc_name': 'vikid',
+    }).run()
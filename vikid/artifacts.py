@@ -0,0 +1,269 @@
+# coding: utf-8
+
+"""
+artifacts.py
+~~~~~~~~~~~~
+
+Build artifact library - internal to Viki
+
+A job's "artifacts" lists globs, relative to its workspace, of files to
+keep once a run ends:
+
+    "artifacts": ["dist/*.tar.gz", "reports/**/*.xml"]
+
+Matching files are stored once in a content addressed store under
+artifacts/, named by their sha256, however many runs and jobs produce
+them. Each build gets hardlinks to its blobs under its artifacts/ directory
+and a manifest, artifacts.json, listing them. A blob's link count is its
+reference count: once the builds and step cache entries linking to it
+have been pruned or their job deleted, only the store's own link is left
+and garbage collection removes it. Files are copied into the store with
+a reflink where the filesystem supports it, so a large artifact costs no
+extra disk until it is changed.
+:license: Apache2, see LICENSE for more details
+"""
+
+import fcntl
+import glob
+import hashlib
+import json
+import logging
+import os
+import shutil
+import stat
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+artifacts_dir_name = "artifacts"
+manifest_filename = "artifacts.json"
+
+# Blobs younger than this are never collected, a run may be about to link them
+gc_min_age = 60.0
+
+# ioctl cloning a file's extents into another file on btrfs, xfs and friends
+_FICLONE = 0x40049409
+
+_hash_chunk = 1024 * 1024
+
+
+def patterns(config: Any, field: str = 'artifacts') -> List[str]:
+    """ Check a job's "artifacts" globs, or other workspace globs named field
+    Raises ValueError unless it is a list of relative globs that stay inside the workspace
+    """
+    if config is None:
+        return []
+
+    if not isinstance(config, list) or not all(isinstance(pattern, str) and pattern for pattern in config):
+        raise ValueError('{} must be a list of globs'.format(field))
+
+    for pattern in config:
+        if os.path.isabs(pattern) or '..' in pattern.split('/'):
+            raise ValueError('Glob {} in {} must stay inside the workspace'.format(pattern, field))
+
+    return config
+
+
+def file_hash(path: str) -> str:
+    """ sha256 of a file's contents """
+    digest = hashlib.sha256()
+
+    with open(path, 'rb') as file_obj:
+        for chunk in iter(lambda: file_obj.read(_hash_chunk), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def read_manifest(build_dir: str) -> List[Dict[str, Any]]:
+    """ Artifacts kept by a build, empty if it kept none """
+    try:
+        with open(build_dir + "/" + manifest_filename, 'r') as file_obj:
+            return json.loads(file_obj.read())
+    except (OSError, ValueError):
+        return []
+
+
+def find(build_dir: str, path: str) -> Optional[Tuple[str, str]]:
+    """ Look up one of a build's artifacts
+    Returns Tuple (file path, sha256), None if the build kept nothing at path
+    """
+    for artifact in read_manifest(build_dir):
+        if artifact["path"] == path:
+            return build_dir + "/" + artifacts_dir_name + "/" + path, artifact["sha256"]
+
+    return None
+
+
+def _clone(source: str, destination: str) -> None:
+    """ Copy a file, sharing its extents through a reflink when the filesystem can """
+    with open(source, 'rb') as source_obj, open(destination, 'wb') as destination_obj:
+        try:
+            fcntl.ioctl(destination_obj.fileno(), _FICLONE, source_obj.fileno())
+            return
+        except OSError:
+            pass
+
+        shutil.copyfileobj(source_obj, destination_obj, _hash_chunk)
+
+
+def restore(build_dir: str, workspace: str) -> List[Dict[str, Any]]:
+    """ Copy the artifacts kept in build_dir back into a workspace, replacing what is there
+    Returns the manifest, raises OSError if a file could not be restored
+    """
+    manifest = read_manifest(build_dir)
+
+    for artifact in manifest:
+        target = workspace + "/" + artifact["path"]
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        tmp_file = "{}.{}.tmp".format(target, uuid.uuid4().hex[:8])
+
+        # A copy, never the blob itself, steps are free to change what they are given
+        try:
+            _clone(build_dir + "/" + artifacts_dir_name + "/" + artifact["path"], tmp_file)
+            os.chmod(tmp_file, artifact.get("mode", 0o644))
+            os.replace(tmp_file, target)
+        except BaseException:
+            try:
+                os.remove(tmp_file)
+            except OSError:
+                pass
+            raise
+
+    return manifest
+
+
+class ArtifactStore:
+    """ Content addressed store of artifact blobs """
+
+    def __init__(self, root: str):
+        self.root: str = root
+
+
+    # --- Store internals
+
+
+    def _blob_path(self, digest: str) -> str:
+        return "{}/{}/{}".format(self.root, digest[:2], digest)
+
+
+    def _store(self, source: str, digest: str) -> str:
+        """ Add a file to the store unless an identical one is already there
+        Returns the blob's path
+        """
+        blob = self._blob_path(digest)
+        if os.path.exists(blob):
+            return blob
+
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        tmp_file = "{}.{}.tmp".format(blob, uuid.uuid4().hex[:8])
+
+        try:
+            _clone(source, tmp_file)
+
+            # The file may have changed since it was hashed, never store a blob under the wrong name
+            if file_hash(tmp_file) != digest:
+                raise OSError('{} changed while it was being stored'.format(source))
+
+            # Blobs are shared by every build linking to them, nobody may change one
+            os.chmod(tmp_file, 0o444)
+            os.replace(tmp_file, blob)
+        except BaseException:
+            try:
+                os.remove(tmp_file)
+            except OSError:
+                pass
+            raise
+
+        return blob
+
+
+    # --- Store functions
+
+
+    def collect(self, workspace: str, build_dir: str, globs: List[str]) -> List[Dict[str, Any]]:
+        """ Keep the files in workspace matching globs as artifacts of the build in build_dir
+        Returns the build's manifest
+        """
+        workspace = os.path.realpath(workspace)
+        manifest: List[Dict[str, Any]] = []
+        seen = set()
+
+        for pattern in globs:
+            for match in sorted(glob.glob(workspace + "/" + pattern, recursive=True)):
+                real = os.path.realpath(match)
+                path = os.path.relpath(match, workspace)
+
+                # Symlinks may point anywhere, only keep what is really in the workspace
+                if path in seen or not os.path.isfile(real) or not real.startswith(workspace + "/"):
+                    continue
+                seen.add(path)
+
+                digest = file_hash(real)
+                target = build_dir + "/" + artifacts_dir_name + "/" + path
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+
+                while True:
+                    blob = self._store(real, digest)
+                    try:
+                        os.link(blob, target)
+                    except FileNotFoundError:
+                        # Garbage collected between finding and linking it, store it again
+                        continue
+                    except OSError:
+                        # Store and build on different filesystems, or too many links
+                        shutil.copyfile(blob, target)
+                    break
+
+                manifest.append({"path": path, "size": os.path.getsize(blob), "sha256": digest,
+                                 "mode": stat.S_IMODE(os.stat(real).st_mode)})
+
+        with open(build_dir + "/" + manifest_filename, 'w') as file_obj:
+            file_obj.write(json.dumps(manifest))
+
+        return manifest
+
+
+    def collect_garbage(self, min_age: float = gc_min_age) -> int:
+        """ Remove blobs no build links to any more
+        Returns the number of bytes freed
+        """
+        freed = 0
+        cutoff = time.time() - min_age
+
+        try:
+            prefixes = os.listdir(self.root)
+        except OSError:
+            return 0
+
+        for prefix in prefixes:
+            try:
+                entries = os.scandir(self.root + "/" + prefix)
+            except OSError:
+                continue
+
+            with entries:
+                for entry in entries:
+                    try:
+                        blob = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+
+                    # A blob is only written once, a fresh one may be about to be linked.
+                    # Linking an old one that is collected first is retried by collect()
+                    if blob.st_mtime > cutoff:
+                        continue
+
+                    if blob.st_nlink <= 1 or entry.name.endswith('.tmp'):
+                        try:
+                            os.remove(entry.path)
+                            freed += blob.st_size
+                        except OSError:
+                            pass
+
+        if freed:
+            logger.info('Removed %d bytes of unreferenced artifacts', freed)
+
+        return freed
@@ -8,24 +8,117 @@ This module implements the main Job api for Viki.
 :license: Apache2, see LICENSE for more details. 
 """
 
-from flask import Blueprint, jsonify, request
+import json
+import os
+import time
+
+from flask import Blueprint, Response, g, jsonify, request, send_file
+from vikid import artifacts, builds, capture, logs, metrics
+from vikid.application import app
+from vikid.chain import Chainer
+from vikid.fs import StaleConfig
 from vikid.job import Job
+from vikid import webhooks
+from vikid.run_queue import QueueFull, RunQueue, request_cancel, run_args
+from vikid.scheduler import Scheduler
+from vikid.supervisor import supervisor
 
 blueprint_name = 'api_blueprint'
 template_folder_name = 'templates'
 
 job = Job()
+run_queue = RunQueue(job, state_path=job.running_path)
+scheduler = Scheduler(lambda name: run_queue.submit(name, trigger='cron'),
+                      last_fired=job.last_run_time,
+                      rescan=job.registry.load,
+                      rescan_interval=float(app.get_setting('registry_rescan_interval')),
+                      jitter=float(app.get_setting('cron_jitter')),
+                      catchup=app.get_setting('cron_catchup'),
+                      misfire_grace=float(app.get_setting('cron_misfire_grace')))
+job.registry.add_listener(scheduler.update_job)
+chainer = Chainer(run_queue.submit, job.get_job_config,
+                  max_depth=int(app.get_setting('chain_max_depth')))
+run_queue.add_listener(chainer.run_finished)
+webhook_receiver = webhooks.WebhookReceiver(run_queue.submit, job.running_path)
 
 api_blueprint = Blueprint(blueprint_name,
                           __name__,
                           template_folder=template_folder_name)
 
+metrics.registry.register(metrics.Gauge(
+    'viki_queue_queued', 'Runs waiting for a worker', lambda: run_queue.metrics()["queued"]))
+metrics.registry.register(metrics.Gauge(
+    'viki_queue_running', 'Runs being executed', lambda: run_queue.metrics()["running"]))
+metrics.registry.register(metrics.Gauge(
+    'viki_step_processes', 'Step processes currently running', lambda: len(supervisor.processes())))
+
+
+@api_blueprint.before_app_request
+def start_request_timer():
+    g.request_started = time.monotonic()
+
+
+@api_blueprint.after_app_request
+def record_request_time(response):
+    started = g.get('request_started')
+
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        metrics.request_duration.observe(time.monotonic() - started, route, request.method,
+                                         str(response.status_code))
+
+    return response
+
+
+# --- Api internals
+
+
+def _find_run(job_name, run_id):
+    """ Summary of a run of job_name, from whichever viki process knows it
+    Runs queued by any worker process come from the run queues, finished ones from the
+    run history and ones `vikid run` is running from the running builds
+    Returns None if the run isn't known
+    """
+    found = run_queue.find(run_id)
+
+    if found is None:
+        finished = job.history.get(run_id)
+        if finished is not None:
+            found = {"run_id": run_id, "name": finished["job"], "trigger": finished["trigger"],
+                     "state": finished["status"], "started_at": finished["started"],
+                     "finished_at": finished["finished"], "result": finished}
+
+    if found is None:
+        found = job.find_running(job_name, run_id)
+
+    if found is None or found["name"] != job_name:
+        return None
+
+    return found
+
+
 # --- Api endpoints
 
 @api_blueprint.route("/api/v1/jobs", methods=['GET'])
 def jobs():
-    """ List all jobs """
-    return jsonify(job.get_jobs())
+    """ List all jobs
+    prefix=<str>: Only list jobs whose name starts with prefix
+    offset=<int>, limit=<int>: Page through the sorted job names
+    Answers 304 when If-None-Match matches the current ETag
+    """
+    etag = job.registry.etag()
+
+    if request.if_none_match.contains(etag):
+        return '', 304
+
+    ret = job.get_jobs(request.args.get('prefix', ''),
+                       request.args.get('offset', 0, type=int),
+                       request.args.get('limit', type=int))
+
+    response = jsonify(ret)
+    response.set_etag(etag)
+
+    return response
 
 
 @api_blueprint.route("/api/v1/job/<string:job_name>", methods=['GET', 'POST', 'PUT', 'DELETE'])
@@ -40,21 +133,46 @@ def get_job(job_name):
     ret = None
 
     if request.method == 'GET':
-        # Retrieve a jobs details
-        ret = job.get_job_by_name(job_name)
+        # Retrieve a jobs details, answering 304 if the client's copy is current
+        entry = job.registry.get(job_name)
+
+        if entry is not None and request.if_none_match.contains(entry.etag()):
+            return '', 304
+
+        response = jsonify(job.get_job_by_name(job_name))
+        if entry is not None:
+            response.set_etag(entry.etag())
+
+        return response
 
     if request.method == 'POST':
         # Create job
         # Requires "application/json" mime type and valid JSON body
         # containing description, and steps
-        job_config = str(request.get_json())
+        job_config = request.get_json(silent=True)
         ret = job.create_job(job_name, job_config)
 
     if request.method == 'PUT':
         # Updated a job
-        # Requires "application/json" mime type and valid JSON body
-        # containing field/s to be updated
-        ret = job.update_job(job_name)
+        # Requires "application/json" mime type and a JSON merge patch body
+        # containing field/s to be updated, null removes a field
+        # With If-Match the update only happens if the job is still at that ETag
+        patch = request.get_json(silent=True)
+        etag = None if request.if_match.star_tag else next(iter(request.if_match.as_set()), None)
+
+        if patch is None and request.get_data():
+            return jsonify({"success": 0, "message": "Update must be a JSON object"}), 400
+
+        try:
+            ret = job.update_job(job_name, patch, etag=etag)
+        except StaleConfig as error:
+            return jsonify({"success": 0, "message": str(error)}), 412
+
+        response = jsonify(ret)
+        if ret["etag"] is not None:
+            response.set_etag(ret["etag"])
+
+        return response
 
     if request.method == 'DELETE':
         # Deletes a job from the repository
@@ -68,14 +186,315 @@ def get_job(job_name):
 
 @api_blueprint.route("/api/v1/job/<string:job_name>/run", methods=['POST'])
 def run_job(job_name):
-    """ Run specific job by name """
-    return jsonify(job.run_job(job_name))
+    """ Queue a run of a specific job by name
+    Returns 202 and the run id straight away, the run itself happens on the worker pool
+    An optional JSON body of {"args": [...]} is passed on to the job's steps, args must be
+    a list of strings or numbers
+    profile=1: Sample the run's steps, the result then holds a per step timing breakdown
+    """
+    body = request.get_json(silent=True) or {}
+
+    try:
+        job_args = run_args(body.get("args") if isinstance(body, dict) else None)
+    except ValueError as error:
+        return jsonify({"success": 0, "message": str(error)}), 400
+
+    try:
+        run = run_queue.submit(job_name, job_args, profile=request.args.get('profile') == '1')
+    except ValueError as error:
+        return jsonify({"success": 0, "message": str(error)}), 404
+    except QueueFull as error:
+        return jsonify({"success": 0, "message": str(error)}), 429
+
+    return jsonify({"success": 1, "message": "Run queued", "name": job_name, "run_id": run.id}), 202
+
+
+@api_blueprint.route("/api/v1/webhook/<string:job_name>", methods=['POST'])
+def webhook(job_name):
+    """ Trigger a job from a webhook delivery
+    Only jobs with a "webhook" block in their config accept deliveries, signed
+    with X-Hub-Signature-256 when the block has a secret
+    Returns 202 with the run id, or without one while the delivery is being debounced
+    """
+    config = job.get_job_config(job_name)
+    webhook_config = config.get("webhook") if config is not None else None
+
+    if not isinstance(webhook_config, dict):
+        return jsonify({"success": 0, "message": "Job {} has no webhook".format(job_name)}), 404
+
+    body = request.get_data()
+    key = webhooks.secret(webhook_config)
+
+    if key is not None and not webhooks.verify_signature(key, body, request.headers.get(webhooks.signature_header)):
+        return jsonify({"success": 0, "message": "Bad signature"}), 401
+
+    payload = request.get_json(force=True, silent=True)
+
+    try:
+        run = webhook_receiver.receive(job_name, webhook_config, payload if payload is not None else {})
+    except ValueError as error:
+        return jsonify({"success": 0, "message": str(error)}), 404
+    except QueueFull as error:
+        return jsonify({"success": 0, "message": str(error)}), 429
+
+    if run is None:
+        return jsonify({"success": 1, "message": "Webhook debounced", "name": job_name, "run_id": None}), 202
+
+    return jsonify({"success": 1, "message": "Run queued", "name": job_name, "run_id": run.id,
+                    "coalesced": run.coalesced}), 202
+
+
+@api_blueprint.route("/api/v1/job/<string:job_name>/runs/<string:run_id>", methods=['DELETE'])
+def cancel_run(job_name, run_id):
+    """ Cancel a queued or running run, whichever worker process or `vikid run` has it
+    Running steps get SIGTERM, then SIGKILL once the job's kill_grace has passed
+    A run of another process is cancelled by that process shortly after this answers
+    Answers 409 if the run has already finished
+    """
+    run = run_queue.get(run_id)
+
+    if run is not None and run.job_name == job_name:
+        if run.finished_at is not None:
+            return jsonify({"success": 0, "message": "Run already {}".format(run.state), "run": run.to_dict()}), 409
+
+        run_queue.cancel(run_id)
+
+        return jsonify({"success": 1, "message": "Run cancelled", "run": run.to_dict()}), 202
+
+    found = _find_run(job_name, run_id)
+
+    if found is None:
+        return jsonify({"success": 0, "message": "Run not found"}), 404
+
+    if found["finished_at"] is not None:
+        return jsonify({"success": 0, "message": "Run already {}".format(found["state"]), "run": found}), 409
+
+    request_cancel(job.running_path, run_id)
+
+    return jsonify({"success": 1, "message": "Run cancelled", "run": found}), 202
+
+
+@api_blueprint.route("/api/v1/job/<string:job_name>/runs/<string:run_id>", methods=['GET'])
+def get_run(job_name, run_id):
+    """ Get the state, and once finished the result, of a run
+    Any worker process can answer for runs queued by the others and for runs of `vikid run`
+    """
+    found = _find_run(job_name, run_id)
+
+    if found is None:
+        return jsonify({"success": 0, "message": "Run not found"}), 404
+
+    return jsonify({"success": 1, "message": "Ok", "run": found})
+
+
+@api_blueprint.route("/api/v1/runs", methods=['GET'])
+def list_runs():
+    """ Query the run history, newest first
+    job=<name>, status=<state>: Filter by job and outcome
+    since=<unix time>, until=<unix time>: Filter by start time
+    limit=<int>, cursor=<str>: Page through results, pass back the cursor of the previous page
+    """
+    try:
+        runs, cursor = job.history.query(
+            job=request.args.get('job'),
+            status=request.args.get('status'),
+            since=request.args.get('since', type=float),
+            until=request.args.get('until', type=float),
+            limit=min(request.args.get('limit', 50, type=int), 1000),
+            cursor=request.args.get('cursor')
+        )
+    except ValueError:
+        return jsonify({"success": 0, "message": "Invalid cursor"}), 400
+
+    return jsonify({"success": 1, "message": "Ok", "runs": runs, "cursor": cursor})
+
+
+@api_blueprint.route("/api/v1/queue", methods=['GET'])
+def queue_metrics():
+    """ Run queue depth and latency metrics """
+    return jsonify({"success": 1, "message": "Ok", "queue": run_queue.metrics()})
 
 
 @api_blueprint.route("/api/v1/job/<string:job_name>/output", methods=['GET'])
 def output_job(job_name):
-    """ Get the last run's output of a specific job """
-    return jsonify(job.output_job(job_name))
+    """ Get the last run's output of a specific job
+    Pass ?run=<runNumber> to get the output of an older build
+    """
+    return jsonify(job.output_job(job_name, request.args.get('run', type=int)))
+
+
+@api_blueprint.route("/api/v1/job/<string:job_name>/log", methods=['GET'])
+@api_blueprint.route("/api/v1/job/<string:job_name>/builds/<int:run_number>/log", methods=['GET'])
+def job_log(job_name, run_number=None):
+    """ Stream the output of a build, the latest one unless a run number is given
+    Plain requests and Range requests are served straight from the file. A compressed
+    log is sent as is to clients accepting gzip, everyone else gets it decompressed.
+    Ranges of a compressed log are of its decompressed output, read from the frames holding them
+    offset=<bytes>: Start streaming at this byte offset
+    tail=<lines>: Only stream the last N lines
+    follow=1: Keep streaming new output until the build finishes
+    stream=stdout|stderr: Only stream what the steps wrote to one stream
+    """
+    run_number, output_file = job.output_file(job_name, run_number)
+
+    if not logs.exists(output_file):
+        return jsonify({"success": 0, "message": "Output not found"}), 404
+
+    offset = request.args.get('offset', 0, type=int)
+    tail = request.args.get('tail', type=int)
+    follow = request.args.get('follow', 0, type=int)
+    stream = request.args.get('stream')
+
+    if offset < 0:
+        return jsonify({"success": 0, "message": "offset must not be negative"}), 400
+
+    if stream is not None:
+        index_file = capture.index_file(output_file)
+        if stream not in ('stdout', 'stderr') or not os.path.isfile(index_file):
+            return jsonify({"success": 0, "message": "Stream {} not found".format(stream)}), 404
+
+        running = (lambda: job.build_running(job_name, run_number)) if follow else None
+        lines = capture.replay(output_file, index_file, running=running)
+
+        return Response((b''.join(line.data for line in batch if line.stream == stream) for batch in lines),
+                        mimetype='text/plain')
+
+    if not offset and tail is None and not follow:
+        if not logs.is_compressed(output_file):
+            # Let werkzeug handle Range / conditional requests, under gunicorn this uses sendfile
+            return send_file(output_file, mimetype='text/plain', conditional=True)
+
+        if request.range is not None:
+            size = logs.size(output_file)
+            span = request.range.range_for_length(size)
+
+            if span is None:
+                return jsonify({"success": 0, "message": "Range not satisfiable"}), 416, \
+                    {"Content-Range": "bytes */{}".format(size)}
+
+            return Response(logs.read_chunks(output_file, span[0], span[1] - span[0]), status=206,
+                            mimetype='text/plain',
+                            headers={"Content-Range": request.range.to_content_range_header(size),
+                                     "Content-Length": str(span[1] - span[0]), "Accept-Ranges": "bytes"})
+
+        if 'gzip' in request.accept_encodings and request.range is None \
+                and not job.build_running(job_name, run_number):
+            # The frames make up a valid gzip file, let the client decompress it
+            response = send_file(logs.compressed_file(output_file), mimetype='text/plain', conditional=True)
+            response.headers['Content-Encoding'] = 'gzip'
+            response.headers['Vary'] = 'Accept-Encoding'
+            return response
+
+    if tail is not None:
+        offset = logs.tail_offset(output_file, tail)
+
+    if follow:
+        chunks = logs.follow(output_file, offset, lambda: job.build_running(job_name, run_number))
+    else:
+        chunks = logs.read_chunks(output_file, offset)
+
+    return Response(chunks, mimetype='text/plain', headers={"X-Log-Offset": str(offset)})
+
+
+@api_blueprint.route("/api/v1/job/<string:job_name>/events", methods=['GET'])
+@api_blueprint.route("/api/v1/job/<string:job_name>/builds/<int:run_number>/events", methods=['GET'])
+def job_events(job_name, run_number=None):
+    """ Stream the output of a build as server-sent events, one event per line
+    Events are named after the stream the line was written to and carry the
+    line's step and arrival time, their id is the line number so a client
+    reconnecting with Last-Event-ID carries on where it left off
+    stream=stdout|stderr: Only send lines written to one stream
+    after=<line>: Start after this line number
+    """
+    run_number, output_file = job.output_file(job_name, run_number)
+    index_file = capture.index_file(output_file)
+
+    stream = request.args.get('stream')
+    after = request.args.get('after', 0, type=int)
+    if request.headers.get('Last-Event-ID', '').isdigit():
+        after = int(request.headers['Last-Event-ID'])
+
+    live = capture.live(job_name, run_number)
+
+    if live is not None:
+        # Running in this process, lines come straight from memory
+        lines = live.subscribe(after)
+    elif os.path.isfile(index_file):
+        # Finished, or running in another worker process
+        lines = capture.replay(output_file, index_file, after=after,
+                               running=lambda: job.build_running(job_name, run_number))
+    else:
+        return jsonify({"success": 0, "message": "Output not found"}), 404
+
+    def events():
+        for batch in lines:
+            if not batch:
+                yield ': keepalive\n\n'
+                continue
+
+            yield ''.join('id: {}\nevent: {}\ndata: {}\n\n'.format(
+                line.seq, line.stream, json.dumps({"step": line.step, "time": line.time,
+                                                   "line": line.data.decode('utf-8', 'replace')}))
+                for line in batch if stream is None or line.stream == stream)
+
+    return Response(events(), mimetype='text/event-stream',
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@api_blueprint.route("/api/v1/job/<string:job_name>/builds", methods=['GET'])
+def job_builds(job_name):
+    """ List the builds of a specific job, newest first """
+    return jsonify(job.get_builds(job_name))
+
+
+@api_blueprint.route("/api/v1/job/<string:job_name>/builds/<int:run_number>/artifacts", methods=['GET'])
+def job_artifacts(job_name, run_number):
+    """ List the artifacts a build kept, with their sizes and sha256 """
+    ret = job.get_artifacts(job_name, run_number)
+
+    return jsonify(ret), 200 if ret["success"] else 404
+
+
+@api_blueprint.route("/api/v1/job/<string:job_name>/builds/<int:run_number>/artifacts/<path:artifact>",
+                     methods=['GET'])
+def job_artifact(job_name, run_number, artifact):
+    """ Download one artifact of a build
+    Artifacts never change, their sha256 is their ETag
+    """
+    found = artifacts.find(builds.build_path(job.jobs_path + "/" + job_name, run_number), artifact)
+
+    if found is None or not os.path.isfile(found[0]):
+        return jsonify({"success": 0, "message": "Artifact not found"}), 404
+
+    return send_file(found[0], as_attachment=True, download_name=os.path.basename(artifact),
+                     conditional=True, etag=found[1])
+
+
+@api_blueprint.route("/api/v1/job/<string:job_name>/cache", methods=['GET'])
+def job_step_cache(job_name):
+    """ Step cache hits and misses of a job, in total and by step, and what it has cached """
+    ret = job.get_step_cache(job_name)
+
+    return jsonify(ret), 200 if ret["success"] else 404
+
+
+@api_blueprint.route("/api/v1/schedule", methods=['GET'])
+def schedule():
+    """ List every cron triggered job with its next fire time, soonest first """
+    return jsonify({"success": 1, "message": "Ok", "schedule": scheduler.schedule()})
+
+
+@api_blueprint.route("/api/v1/processes", methods=['GET'])
+def processes():
+    """ List every step process that is currently running, with its timings """
+    live = [process.to_dict() for process in supervisor.processes()]
+    return jsonify({"success": 1, "message": "Ok", "processes": live})
+
+
+@api_blueprint.route("/metrics", methods=['GET'])
+def metrics_endpoint():
+    """ Counters and histograms in the Prometheus text format """
+    return Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
 
 
 @api_blueprint.route("/api/v1/3laws", methods=['GET'])
@@ -0,0 +1,214 @@
+# coding: utf-8
+
+"""
+builds.py
+~~~~~~~~~
+
+Build directory library - internal to Viki
+
+Every run of a job gets its own jobs/<name>/builds/<runNumber>/ directory
+holding the run's output and a meta.json with its state, exit code and
+timings. Old builds are pruned in the background according to the job's
+retention policy.
+:license: Apache2, see LICENSE for more details
+"""
+
+import json
+import logging
+import os
+import shutil
+import threading
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+builds_dir_name = "builds"
+build_meta_filename = "meta.json"
+build_profile_filename = "profile.json"
+
+
+# --- Main library
+
+def builds_path(job_dir: str) -> str:
+    """ Path of the directory holding all of a job's builds """
+    return job_dir + "/" + builds_dir_name
+
+
+def build_path(job_dir: str, run_number: int) -> str:
+    """ Path of a single build directory """
+    return "{}/{}".format(builds_path(job_dir), run_number)
+
+
+def create_build(job_dir: str, run_number: int) -> str:
+    """ Create the directory for build run_number and return its path
+    Raises FileExistsError if that build already exists
+    """
+    os.makedirs(builds_path(job_dir), exist_ok=True)
+
+    path = build_path(job_dir, run_number)
+    os.mkdir(path)
+
+    return path
+
+
+def list_builds(job_dir: str) -> List[int]:
+    """ Return the run numbers of every build of a job, oldest first """
+    try:
+        entries = os.listdir(builds_path(job_dir))
+    except OSError:
+        return []
+
+    return sorted(int(entry) for entry in entries if entry.isdigit())
+
+
+def write_meta(build_dir: str, meta: Dict[str, Any]) -> None:
+    """ Atomically replace a build's meta.json """
+    meta_file = build_dir + "/" + build_meta_filename
+    tmp_file = meta_file + ".tmp"
+
+    with open(tmp_file, 'w') as file_obj:
+        file_obj.write(json.dumps(meta))
+
+    os.replace(tmp_file, meta_file)
+
+
+def write_profile(build_dir: str, profile: List[Dict[str, Any]]) -> None:
+    """ Write the per step timing breakdown of a profiled build """
+    with open(build_dir + "/" + build_profile_filename, 'w') as file_obj:
+        file_obj.write(json.dumps(profile))
+
+
+def read_meta(build_dir: str) -> Optional[Dict[str, Any]]:
+    """ Read a build's meta.json, None if it is missing or unreadable """
+    try:
+        with open(build_dir + "/" + build_meta_filename, 'r') as file_obj:
+            return json.loads(file_obj.read())
+    except (OSError, ValueError):
+        return None
+
+
+def build_size(build_dir: str) -> int:
+    """ Total size in bytes of the files in a build directory """
+    total = 0
+
+    for root, _, files in os.walk(build_dir):
+        for filename in files:
+            try:
+                total += os.lstat(os.path.join(root, filename)).st_size
+            except OSError:
+                pass
+
+    return total
+
+
+def retention(config: Any) -> Dict[str, Any]:
+    """ Check a job's "retention" policy
+    Raises ValueError unless it is an object whose keep_runs and max_bytes, if set,
+    are numbers of zero or more. Returns {} if the job has none
+    """
+    if config is None:
+        return {}
+
+    if not isinstance(config, dict):
+        raise ValueError('retention must be an object')
+
+    for field in ('keep_runs', 'max_bytes'):
+        value = config.get(field, 0)
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+            raise ValueError('retention {} must be a number of zero or more'.format(field))
+
+    return config
+
+
+def prune(job_dir: str, keep_runs: int = 0, max_bytes: int = 0) -> List[int]:
+    """ Remove old builds of a job
+    Keeps at most keep_runs finished builds and at most max_bytes of them on disk,
+    newest first. Zero disables that limit. Builds still running, or just started
+    and without a meta.json yet, are never removed.
+    :returns list: run numbers that were removed
+    """
+    kept_runs = 0
+    kept_bytes = 0
+    removed = []
+
+    for run_number in reversed(list_builds(job_dir)):
+        path = build_path(job_dir, run_number)
+        meta = read_meta(path)
+
+        # No meta yet means the build is only just being started
+        if meta is None or meta.get("state") == "running":
+            continue
+
+        size = build_size(path)
+
+        if (keep_runs and kept_runs >= keep_runs) or (max_bytes and kept_bytes + size > max_bytes):
+            shutil.rmtree(path, ignore_errors=True)
+            removed.append(run_number)
+            continue
+
+        kept_runs += 1
+        kept_bytes += size
+
+    return removed
+
+
+class Pruner:
+    """ Background thread pruning builds so runs never wait on it """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._pending: Dict[str, Any] = {}
+        self._thread: Optional[threading.Thread] = None
+        self._listeners: List[Callable[[str, List[int]], Any]] = []
+
+
+    def add_listener(self, listener: Callable[[str, List[int]], Any]) -> None:
+        """ Call listener(job_dir, removed run numbers) on the pruner thread
+        after builds have been pruned
+        """
+        with self._cond:
+            self._listeners.append(listener)
+
+
+    def schedule(self, job_dir: str, keep_runs: int = 0, max_bytes: int = 0) -> None:
+        """ Ask for job_dir to be pruned soon
+        Repeated requests for the same job before it is pruned collapse into one
+        """
+        if not keep_runs and not max_bytes:
+            return
+
+        with self._cond:
+            self._pending[job_dir] = (keep_runs, max_bytes)
+
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name='viki-pruner', daemon=True)
+                self._thread.start()
+
+            self._cond.notify()
+
+
+    def _loop(self) -> None:
+        """ Pruner thread main loop """
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                job_dir, (keep_runs, max_bytes) = self._pending.popitem()
+
+            try:
+                removed = prune(job_dir, keep_runs, max_bytes)
+            except Exception:  # The thread must outlive one bad job
+                logger.exception('Pruning the builds of %s failed', job_dir)
+                continue
+
+            if removed:
+                with self._cond:
+                    listeners = list(self._listeners)
+                for listener in listeners:
+                    try:
+                        listener(job_dir, removed)
+                    except Exception:  # A broken listener must not stop the pruner or the other listeners
+                        logger.exception('Prune listener failed for %s', job_dir)
+
+
+pruner = Pruner()
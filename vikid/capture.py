@@ -0,0 +1,412 @@
+# coding: utf-8
+
+"""
+capture.py
+~~~~~~~~~~
+
+Step output capture library - internal to Viki
+
+A run's steps write their stdout and stderr into pipes. One reader thread
+per run drains every pipe, appends whole lines to the build's output.txt
+and notes each batch of lines in output.idx: the time it arrived, the
+stream and step it came from, its line numbers and where it sits in
+output.txt. The output itself goes through a logs writer, compressed
+unless the job turned that off. The most recent lines are also kept in
+memory so any number of live subscribers are fed without touching disk.
+
+Output may also be written without a process behind it: a step restored
+from the step cache has the output it printed last time injected, and a
+cacheable step's output is recorded on the side so it can be replayed.
+
+The reader never waits for a subscriber. A subscriber that falls further
+behind than the in-memory buffer reads the lines it missed from disk and
+then catches up, so a slow client can neither stall a step nor miss output.
+:license: Apache2, see LICENSE for more details
+"""
+
+import collections
+import itertools
+import json
+import os
+import selectors
+import threading
+import time
+from typing import IO, Any, Callable, Deque, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+from vikid import logs
+
+index_filename = "output.idx"
+
+# Largest read from a pipe, and longest line kept whole before it is cut
+chunk_size = 64 * 1024
+
+# How long a finished step's pipes may stay open, held by children it left behind
+drain_timeout = 1.0
+
+# How often subscribers are sent something, so dead clients are noticed
+heartbeat_interval = 15.0
+
+# How often a build being captured by another process is checked for new lines
+follow_interval = 0.25
+
+# Runs being captured in this process, by job name and run number
+_live: Dict[Tuple[str, int], 'Capture'] = {}
+_live_lock = threading.Lock()
+
+
+class Line(NamedTuple):
+    """ One line of step output """
+    seq: int
+    time: float
+    stream: str
+    step: str
+    data: bytes
+    # Where the line starts in the build's output
+    offset: int
+
+
+def _split_lines(data: bytes) -> List[bytes]:
+    """ Split data after each newline, an unterminated last line is kept as is """
+    lines = [part + b'\n' for part in data.split(b'\n')]
+    lines[-1] = lines[-1][:-1]
+
+    return lines if lines[-1] else lines[:-1]
+
+
+def index_file(output_file: str) -> str:
+    """ Path of the line index that belongs to a build's output file """
+    return os.path.dirname(output_file) + "/" + index_filename
+
+
+class Capture:
+    """ Collects the output of one run's steps """
+
+    def __init__(self, output_file: str, buffer_bytes: int = 1024 * 1024, compression: int = 0):
+        """ output_file: The build's output.txt, its index is written next to it
+        buffer_bytes: How much recent output is kept in memory for subscribers
+        compression: zlib level the output is compressed with, 0 leaves it plain
+        """
+        self.output_file: str = output_file
+        self.index_file: str = index_file(output_file)
+        self.buffer_bytes: int = buffer_bytes
+
+        self._output = logs.open_writer(output_file, compression)
+        self._index = open(self.index_file, 'ab')
+        self._offset: int = self._output.sealed
+
+        self._cond = threading.Condition()
+        self._ring: Deque[Line] = collections.deque()
+        self._ring_bytes: int = 0
+        self._seq: int = 0
+        self._closed: bool = False
+
+        # Pipes not yet at EOF, by step name
+        self._open: Dict[str, int] = collections.Counter()
+
+        # Files a step's output is also recorded in, by step name
+        self._records: Dict[str, IO[str]] = {}
+
+        # Output is written by the reader thread and by inject()
+        self._write_lock = threading.Lock()
+
+        # Reader thread state, the selector is only touched by the reader
+        self._thread: Optional[threading.Thread] = None
+        self._selector = selectors.DefaultSelector()
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ, None)
+        self._pending: List[Tuple[int, Tuple[str, str]]] = []
+        self._partial: Dict[int, bytes] = {}
+        self._stopping: bool = False
+        self._abandon: bool = False
+
+
+    # --- Capture internals
+
+
+    def _wake(self) -> None:
+        os.write(self._wakeup_w, b'\0')
+
+
+    def _read_loop(self) -> None:
+        """ Drain every pipe until the capture is closed """
+        while True:
+            # Wake up in time to seal output the writer is holding back
+            for key, _ in self._selector.select(self._output.seal_due()):
+
+                if key.data is not None:
+                    step, stream = key.data
+                    chunk = os.read(key.fd, chunk_size)
+                    self._feed(key.fd, step, stream, chunk)
+                    if not chunk:
+                        self._drop(key.fd, step)
+                    continue
+
+                # Handed new pipes or told to stop
+                os.read(self._wakeup_r, 4096)
+                with self._cond:
+                    pending, self._pending = self._pending, []
+                    stopping, abandon = self._stopping, self._abandon
+
+                for fd, data in pending:
+                    self._selector.register(fd, selectors.EVENT_READ, data)
+
+                if abandon:
+                    # Give up on pipes held open by processes the steps left behind
+                    for fd, registered in list(self._selector.get_map().items()):
+                        if registered.data is not None:
+                            self._feed(fd, registered.data[0], registered.data[1], b'')
+                            self._drop(fd, registered.data[0])
+
+                if stopping and len(self._selector.get_map()) == 1:
+                    return
+
+            with self._write_lock:
+                self._output.flush()
+
+
+    def _drop(self, fd: int, step: str) -> None:
+        """ A pipe reached EOF """
+        self._selector.unregister(fd)
+        os.close(fd)
+
+        with self._cond:
+            self._open[step] -= 1
+            self._cond.notify_all()
+
+
+    def _feed(self, fd: int, step: str, stream: str, chunk: bytes) -> None:
+        """ Take a chunk read from a pipe, only whole lines are written
+        An empty chunk means EOF and flushes an unterminated last line
+        """
+        data = self._partial.pop(fd, b'') + chunk
+
+        if chunk:
+            cut = data.rfind(b'\n') + 1
+            if not cut:
+                if len(data) < chunk_size:
+                    self._partial[fd] = data
+                    return
+                # Cut very long lines rather than buffering them forever
+                cut = len(data)
+            if cut < len(data):
+                self._partial[fd] = data[cut:]
+            data = data[:cut]
+
+        if data:
+            with self._write_lock:
+                self._write(step, stream, data)
+
+
+    def _write(self, step: str, stream: str, data: bytes) -> None:
+        """ Write a batch of lines out, then hand it to subscribers
+        Callers hold the write lock
+        """
+        now = time.time()
+        lines = _split_lines(data)
+
+        self._output.write(data)
+
+        self._index.write(json.dumps({"seq": self._seq + 1, "lines": len(lines), "time": now,
+                                      "stream": stream, "step": step,
+                                      "offset": self._offset, "length": len(data)}).encode('utf-8') + b'\n')
+        self._index.flush()
+
+        with self._cond:
+            record = self._records.get(step)
+            if record is not None:
+                # Undecodable bytes survive the round trip through json as lone surrogates
+                record.write(json.dumps({"stream": stream,
+                                         "data": data.decode('utf-8', 'surrogateescape')}) + '\n')
+
+            offset = self._offset
+            for line in lines:
+                self._seq += 1
+                self._ring.append(Line(self._seq, now, stream, step, line, offset))
+                self._ring_bytes += len(line)
+                offset += len(line)
+            self._offset = offset
+
+            # Lines only leave memory once readers can get them from disk
+            while self._ring_bytes > self.buffer_bytes and len(self._ring) > 1 \
+                    and self._ring[0].offset + len(self._ring[0].data) <= self._output.sealed:
+                self._ring_bytes -= len(self._ring.popleft().data)
+
+            self._cond.notify_all()
+
+
+    # --- Capture functions
+
+
+    def attach(self, step: str, stdout_fd: int, stderr_fd: int) -> None:
+        """ Start capturing a step's output, the capture closes the pipes' read ends """
+        with self._cond:
+            self._open[step] += 2
+            self._pending.append((stdout_fd, (step, 'stdout')))
+            self._pending.append((stderr_fd, (step, 'stderr')))
+
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._read_loop, name='viki-capture', daemon=True)
+                self._thread.start()
+
+        self._wake()
+
+
+    def inject(self, step: str, output: List[Tuple[str, bytes]]) -> None:
+        """ Write output for a step that has no process, as (stream, data) batches """
+        with self._write_lock:
+            for stream, data in output:
+                if data:
+                    self._write(step, stream, data)
+
+
+    def record(self, step: str, record_file: str) -> None:
+        """ Also write a step's output to record_file, as (stream, data) batches
+        one json object per line, until stop_recording() is called
+        """
+        with self._cond:
+            self._records[step] = open(record_file, 'w')
+
+
+    def stop_recording(self, step: str) -> None:
+        with self._cond:
+            record = self._records.pop(step, None)
+
+        if record is not None:
+            record.close()
+
+
+    def settle(self, steps: List[str], timeout: float = drain_timeout) -> None:
+        """ Wait for the output of finished steps to be drained
+        Keeps the output of a step ahead of the steps that need it
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: not any(self._open[step] for step in steps), timeout)
+
+
+    def close(self, timeout: float = drain_timeout) -> None:
+        """ Drain what the steps wrote and stop capturing
+        Pipes still open after timeout are abandoned
+        """
+        if self._thread is not None:
+            with self._cond:
+                self._stopping = True
+            self._wake()
+
+            with self._cond:
+                self._cond.wait_for(lambda: not any(self._open.values()), timeout)
+                self._abandon = True
+            self._wake()
+
+            self._thread.join()
+
+        self._selector.close()
+        os.close(self._wakeup_r)
+        os.close(self._wakeup_w)
+        self._output.close()
+        self._index.close()
+
+        with self._cond:
+            records, self._records = self._records, {}
+            self._closed = True
+            self._cond.notify_all()
+
+        for record in records.values():
+            record.close()
+
+
+    def subscribe(self, after: int = 0, heartbeat: float = heartbeat_interval) -> Iterator[List[Line]]:
+        """ Yield batches of lines after line number `after` as they are written
+        An empty batch is yielded every heartbeat seconds while nothing is written
+        Ends once the capture is closed and every line has been yielded
+        """
+        seq = after
+
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._seq > seq or self._closed, heartbeat)
+
+                oldest = self._ring[0].seq if self._ring else self._seq + 1
+                behind = seq + 1 < oldest
+                lines = [] if behind else list(itertools.islice(self._ring, seq + 1 - oldest, None))
+                done = self._closed and self._seq <= seq
+
+            if behind:
+                # Fell out of the in-memory buffer, catch up from disk
+                for batch in replay(self.output_file, self.index_file, after=seq, until=oldest - 1):
+                    seq = batch[-1].seq
+                    yield batch
+                continue
+
+            if done:
+                return
+
+            if lines:
+                seq = lines[-1].seq
+
+            yield lines
+
+
+def replay(output_file: str, index: str, after: int = 0, until: Optional[int] = None,
+           running: Optional[Callable[[], bool]] = None) -> Iterator[List[Line]]:
+    """ Yield batches of lines after line number `after` from a build's output and index
+    until: Stop after this line number
+    running: Keep following the index while running() is True, for builds
+    being captured by another process
+    """
+    finished = running is None
+
+    with open(index, 'rb') as index_obj, logs.LogReader(output_file) as output:
+        while True:
+            position = index_obj.tell()
+            entry = index_obj.readline()
+            record: Optional[Dict[str, Any]] = json.loads(entry) if entry.endswith(b'\n') else None
+
+            if record is not None and record["offset"] + record["length"] > output.size:
+                # Listed but still held back by a compressing writer
+                output.refresh()
+                if record["offset"] + record["length"] > output.size:
+                    record = None
+
+            if record is None:
+                # At the end of the index, or of what has been written out
+                index_obj.seek(position)
+                if finished:
+                    return
+                # Take one more pass after the build ends so its last lines aren't missed
+                finished = not running()
+                if not finished:
+                    time.sleep(follow_interval)
+                continue
+
+            if record["seq"] + record["lines"] - 1 <= after:
+                continue
+            if until is not None and record["seq"] > until:
+                return
+
+            batch: List[Line] = []
+            offset = record["offset"]
+
+            for seq, line in enumerate(_split_lines(output.read(offset, record["length"])), record["seq"]):
+                if seq > after and (until is None or seq <= until):
+                    batch.append(Line(seq, record["time"], record["stream"], record["step"], line, offset))
+                offset += len(line)
+
+            if batch:
+                yield batch
+
+
+def register(job_name: str, run_number: int, capture: Capture) -> None:
+    """ Let subscribers find a run's capture while it runs """
+    with _live_lock:
+        _live[(job_name, run_number)] = capture
+
+
+def unregister(job_name: str, run_number: int) -> None:
+    with _live_lock:
+        _live.pop((job_name, run_number), None)
+
+
+def live(job_name: str, run_number: Optional[int]) -> Optional[Capture]:
+    """ The capture of a run in progress in this process, None if there is none """
+    with _live_lock:
+        return _live.get((job_name, run_number))
@@ -0,0 +1,192 @@
+# coding: utf-8
+
+"""
+chain.py
+~~~~~~~~
+
+Job chaining library - internal to Viki
+
+Jobs start other jobs when they finish without a step having to call
+back into the api. In a job's config:
+
+    "on_success": ["deploy"],
+    "on_failure": ["notify"],
+    "fan_out": ["test-linux", "test-mac"],
+    "join": "release"
+
+on_success and on_failure runs start right after the run finishes,
+cancelled runs start nothing.
+fan_out runs start together after a successful run and once every one
+of them has succeeded the join job runs. A fan_out run that fails or
+is cancelled, even while it is still queued, cancels the join.
+
+Chained runs are submitted from the run queue's worker as soon as the
+upstream run finishes, and their steps see where they came from:
+
+    VIKI_PIPELINE_ID       Run id of the run that began the chain
+    VIKI_UPSTREAM_JOB      Job, run id, run number, status and build
+    VIKI_UPSTREAM_RUN_ID   directory of the run that triggered this one,
+    VIKI_UPSTREAM_...      the last one to finish for a join
+    VIKI_UPSTREAM          The same for every upstream run, as JSON
+:license: Apache2, see LICENSE for more details
+"""
+
+import json
+import logging
+import threading
+from typing import Any, Callable, Dict, List, Optional
+
+from vikid.run_queue import QueueFull
+
+logger = logging.getLogger(__name__)
+
+
+def _job_list(value: Any) -> List[str]:
+    """ Downstream jobs may be given as one name or a list of names """
+    if not value:
+        return []
+
+    if isinstance(value, str):
+        return [value]
+
+    return [str(name) for name in value]
+
+
+def _upstream(run: Any) -> Dict[str, Any]:
+    """ What a downstream run is told about a finished run """
+    result: Dict[str, Any] = run.result or {}
+
+    return {
+        "job": run.job_name,
+        "run_id": run.id,
+        "run_number": result.get("run_number"),
+        "status": run.state,
+        "build_dir": result.get("build_dir"),
+    }
+
+
+def _upstream_env(pipeline_id: str, upstreams: List[Dict[str, Any]]) -> Dict[str, str]:
+    """ Environment handed to a downstream run """
+    last: Dict[str, Any] = upstreams[-1]
+
+    return {
+        "VIKI_PIPELINE_ID": pipeline_id,
+        "VIKI_UPSTREAM_JOB": last["job"],
+        "VIKI_UPSTREAM_RUN_ID": last["run_id"],
+        "VIKI_UPSTREAM_RUN_NUMBER": str(last["run_number"] or ""),
+        "VIKI_UPSTREAM_STATUS": last["status"],
+        "VIKI_UPSTREAM_BUILD_DIR": last["build_dir"] or "",
+        "VIKI_UPSTREAM": json.dumps(upstreams),
+    }
+
+
+class Chainer:
+    """ Starts downstream runs when upstream runs finish """
+
+    def __init__(self, submit: Callable[..., Any], get_config: Callable[[str], Optional[Dict[str, Any]]],
+                 max_depth: int = 20):
+        """ Initialize the chainer
+        submit: RunQueue.submit
+        get_config: Look up a job's config, None if the job is gone
+        max_depth: Longest chain allowed, stops jobs that trigger each other forever
+        """
+        self.submit = submit
+        self.get_config = get_config
+        self.max_depth: int = max_depth
+
+        self._lock = threading.Lock()
+
+        # Fan outs waiting to join, keyed by the run id of the run that fanned out
+        self._joins: Dict[str, Dict[str, Any]] = {}
+
+
+    # --- Chainer internals
+
+
+    def _start(self, job_name: str, upstream: Any, upstreams: List[Dict[str, Any]],
+               join_group: Optional[str] = None) -> bool:
+        """ Queue a downstream run, returns False if it could not be queued """
+        if upstream.depth + 1 > self.max_depth:
+            logger.warning('Not starting %s after %s, chain is longer than %d runs',
+                           job_name, upstream.job_name, self.max_depth)
+            return False
+
+        try:
+            self.submit(job_name, trigger='upstream',
+                        env=_upstream_env(upstream.pipeline_id, upstreams),
+                        pipeline_id=upstream.pipeline_id,
+                        depth=upstream.depth + 1,
+                        join_group=join_group)
+        except (ValueError, QueueFull) as error:
+            logger.warning('Could not start %s after %s: %s', job_name, upstream.job_name, error)
+            return False
+
+        return True
+
+
+    def _joined(self, run: Any) -> None:
+        """ Count a finished fan out run towards its join """
+        with self._lock:
+            group = self._joins.get(run.join_group)
+            if group is None:
+                return
+
+            if run.state != 'succeeded':
+                del self._joins[run.join_group]
+                logger.info('Not starting %s, fanned out run %s of %s %s',
+                            group["join"], run.id, run.job_name, run.state)
+                return
+
+            group["upstreams"].append(_upstream(run))
+            group["remaining"] -= 1
+            if group["remaining"]:
+                return
+
+            del self._joins[run.join_group]
+
+        self._start(group["join"], run, group["upstreams"])
+
+
+    # --- Chainer functions
+
+
+    def run_finished(self, run: Any) -> None:
+        """ RunQueue listener, starts whatever the finished run's job asks for """
+        if run.join_group is not None:
+            self._joined(run)
+
+        config: Optional[Dict[str, Any]] = self.get_config(run.job_name)
+        if config is None:
+            return
+
+        upstreams: List[Dict[str, Any]] = [_upstream(run)]
+
+        if run.state == 'cancelled':
+            return
+
+        if run.state != 'succeeded':
+            for job_name in _job_list(config.get('on_failure')):
+                self._start(job_name, run, upstreams)
+            return
+
+        for job_name in _job_list(config.get('on_success')):
+            self._start(job_name, run, upstreams)
+
+        fan_out: List[str] = _job_list(config.get('fan_out'))
+        join: Optional[str] = config.get('join') or None
+
+        if join is not None and fan_out:
+            with self._lock:
+                self._joins[run.id] = {"join": join, "remaining": len(fan_out), "upstreams": []}
+
+        for job_name in fan_out:
+            if self._start(job_name, run, upstreams, join_group=run.id if join is not None else None):
+                continue
+
+            # One branch can never finish, neither can the join
+            with self._lock:
+                if self._joins.pop(run.id, None) is not None:
+                    logger.info('Not starting %s, %s could not be started', join, job_name)
+
+        if join is not None and not fan_out:
+            self._start(join, run, upstreams)
@@ -0,0 +1,287 @@
+# coding: utf-8
+
+"""
+cli.py
+~~~~~~
+
+Command line entry point for Viki
+
+    vikid setup                  Create the viki home directory
+    vikid check                  Check the viki home directory is set up
+    vikid [serve] [options]      Run the daemon, the default
+    vikid run <job> [args...]    Run a job in this process, without the daemon
+    vikid run --parallel <job>...
+
+vikid is restarted by supervisors and called from scripts, so each
+command only imports what it needs: setup and check never load Flask,
+the blueprints or the job engine, and the daemon's settings are only
+read when it is about to serve.
+
+`vikid run` drives the same engine as the daemon and shares its home:
+runs get build numbers, land in the run history and hold the job's run
+slots, so a job is never run more often at once than its concurrency
+allows, whether the daemon or the command line started it. The steps'
+output is streamed to the terminal and vikid exits with the status of
+the step that failed. The daemon's api can cancel these runs too. It
+finishes off the builds a crashed vikid left running before it starts
+its own.
+
+Only one daemon serves a home directory: `vikid serve` holds vikid.pid
+locked while it runs and refuses to start next to a live daemon.
+:license: Apache2, see LICENSE for more details
+"""
+
+import argparse
+import sys
+import threading
+import uuid
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+
+# --- Commands
+
+
+def setup(args: argparse.Namespace) -> int:
+    from vikid.application import app
+
+    app.create_system_setup()
+    print('System setup finished')
+
+    return 0
+
+
+def check(args: argparse.Namespace) -> int:
+    from vikid.application import app
+
+    if not app.check_system_setup():
+        print('System check failed. Please run `vikid setup`', file=sys.stderr)
+        return 1
+
+    return 0
+
+
+def serve(args: argparse.Namespace) -> int:
+    import os
+    import signal
+
+    from vikid.application import app
+    from vikid.pid import Lock
+
+    if check(args):
+        return 1
+
+    # The debug reloader's child runs under the parent, which holds the lock already
+    if os.environ.get('WERKZEUG_RUN_MAIN') != 'true':
+        pid_lock = Lock()
+        if not pid_lock.acquire():
+            print('vikid is already running with pid {}'.format(pid_lock.owner()), file=sys.stderr)
+            return 1
+
+    # Flags left out fall back to viki.json, then the defaults in _conf
+    for option, setting in (('bind', 'bind'), ('workers', 'workers'), ('threads', 'threads'),
+                            ('keep_alive', 'keepalive'), ('graceful_timeout', 'graceful_timeout')):
+        if getattr(args, option) is None:
+            setattr(args, option, app.get_setting(setting))
+
+    if args.dev:
+        from vikid.application.factory import create_app
+
+        # Grab a keyboard interrupt
+        def signal_handler(signal, frame):
+            print('Keyboard interrupt')
+            sys.exit(130)
+
+        signal.signal(signal.SIGINT, signal_handler)
+
+        host, _, port = args.bind.rpartition(':')
+
+        # The debug reloader runs this script twice, only fire cron triggers in the child
+        flask_app = create_app(root_path=args.root_path,
+                               start_scheduler=os.environ.get('WERKZEUG_RUN_MAIN') == 'true')
+        flask_app.run(host=host or None, port=int(port), debug=True)
+
+        return 0
+
+    from vikid.application.server import serve as serve_forever
+
+    serve_forever(args.bind, args.workers, args.threads, args.keep_alive, args.graceful_timeout,
+                  reload=args.reload, root_path=args.root_path)
+
+    return 0
+
+
+def _follow(capture: Any, prefix: bytes = b'') -> threading.Thread:
+    """ Copy a run's output to our stdout and stderr as its steps write it """
+    def pump() -> None:
+        for batch in capture.subscribe():
+            for line in batch:
+                data = line.data
+                if prefix:
+                    # Keep every line of interleaved runs on a line of its own
+                    data = prefix + (data if data.endswith(b'\n') else data + b'\n')
+                (sys.stdout if line.stream == 'stdout' else sys.stderr).buffer.write(data)
+
+            sys.stdout.flush()
+            sys.stderr.flush()
+
+    thread = threading.Thread(target=pump, name='viki-cli-output', daemon=True)
+    thread.start()
+
+    return thread
+
+
+def _run_all(job: Any, runs: List[Tuple[str, Optional[List[str]]]]) -> int:
+    """ Run each (job name, args) at once, returns the exit status of the first failure """
+    from vikid.run_queue import take_cancel_request
+    from vikid.steps import RunControl
+
+    results: Dict[int, Dict[str, Any]] = {}
+    controls = [RunControl() for _ in runs]
+
+    # Run ids like the daemon's, so the api can look these runs up too
+    run_ids = [uuid.uuid4().hex for _ in runs]
+
+    followers: List[threading.Thread] = []
+    followers_lock = threading.Lock()
+
+    # Set once every run has finished, waited on rather than joining the threads
+    # as an interrupted join can leave a thread looking finished while it runs
+    finished = threading.Event()
+    unfinished = [len(runs)]
+
+    def run_one(number: int) -> None:
+        job_name, job_args = runs[number]
+        prefix = '[{}] '.format(job_name).encode('utf-8') if len(runs) > 1 else b''
+
+        def watch(capture: Any) -> None:
+            with followers_lock:
+                followers.append(_follow(capture, prefix))
+
+        try:
+            results[number] = job.run_job(job_name, job_args, trigger='cli', run_id=run_ids[number],
+                                          control=controls[number], watch=watch)
+        except Exception as error:  # Reported with the others rather than lost with the thread
+            results[number] = {"success": 0, "status": "failed", "message": 'Run failed: {}'.format(error),
+                               "return_code": -1, "run_number": 0}
+        finally:
+            with followers_lock:
+                unfinished[0] -= 1
+                if not unfinished[0]:
+                    finished.set()
+
+    for number in range(len(runs)):
+        threading.Thread(target=run_one, args=(number,), name='viki-cli-run').start()
+
+    # Steps lead their own process groups so ^C never reaches them, stop them ourselves
+    try:
+        while not finished.wait(0.1):
+            # Cancels asked for through the daemon's api
+            for number, run_id in enumerate(run_ids):
+                if take_cancel_request(job.running_path, run_id):
+                    controls[number].stop('cancelled')
+    except KeyboardInterrupt:
+        for control in controls:
+            control.stop('cancelled')
+        finished.wait()
+
+    for thread in followers:
+        thread.join()
+
+    for run_id in run_ids:
+        take_cancel_request(job.running_path, run_id)
+
+    status = 0
+
+    for number, (job_name, _) in enumerate(runs):
+        result = results[number]
+        print('{} #{}: {}'.format(job_name, result["run_number"], result["message"]), file=sys.stderr)
+
+        if result["success"] or status:
+            continue
+
+        # The first failure decides, with the failed step's own exit status where there is one
+        if result["status"] == "cancelled":
+            status = 130
+        else:
+            status = result["return_code"] if 0 < result["return_code"] < 256 else 1
+
+    return status
+
+
+def run(args: argparse.Namespace) -> int:
+    if check(args):
+        return 1
+
+    from vikid.job import Job
+
+    # With --parallel every name given is a job, run without arguments
+    if args.parallel:
+        runs = [(job_name, None) for job_name in [args.job] + args.args]
+    else:
+        runs = [(args.job, args.args or None)]
+
+    job = Job()
+    job.recover_interrupted_runs()
+
+    try:
+        return _run_all(job, runs)
+    finally:
+        # The history is written in batches on a daemon thread, don't exit before it is
+        job.history.flush()
+
+
+# --- Main
+
+
+commands: Dict[str, Callable[[argparse.Namespace], int]] = {
+    "setup": setup,
+    "check": check,
+    "serve": serve,
+    "run": run,
+}
+
+
+def parser() -> argparse.ArgumentParser:
+    """ Argument parser for every command """
+    main_parser = argparse.ArgumentParser(prog='vikid', description='Viki job automation daemon')
+    subparsers = main_parser.add_subparsers(dest='command', metavar='command')
+
+    subparsers.add_parser('setup', help='Create the viki home directory and exit')
+    subparsers.add_parser('check', help='Exit non-zero unless the viki home directory is set up')
+
+    serve_parser = subparsers.add_parser('serve', help='Run the daemon, the default command')
+    serve_parser.add_argument('--bind', help='Address to listen on, host:port or unix:/path')
+    serve_parser.add_argument('--workers', type=int, help='Number of worker processes')
+    serve_parser.add_argument('--threads', type=int, help='Request threads per worker')
+    serve_parser.add_argument('--keep-alive', type=int, help='Seconds to hold idle keep-alive connections open')
+    serve_parser.add_argument('--graceful-timeout', type=int,
+                              help='Seconds workers get to finish requests on reload/shutdown')
+    serve_parser.add_argument('--reload', action='store_true', help='Restart workers when the code changes')
+    serve_parser.add_argument('--dev', action='store_true', help="Use Flask's debug server instead of gunicorn")
+
+    run_parser = subparsers.add_parser('run', help='Run a job in this process, without the daemon')
+    run_parser.add_argument('--parallel', action='store_true',
+                            help='Run every job named at once, instead of one job with arguments')
+    run_parser.add_argument('job', help='Name of the job to run')
+    run_parser.add_argument('args', nargs=argparse.REMAINDER, help='Arguments handed to the steps as $1, $2...')
+
+    return main_parser
+
+
+def main(argv: Optional[List[str]] = None, root_path: Optional[str] = None) -> int:
+    """ Run a vikid command
+    root_path: Where the UI's templates/ and static/ live, defaults to the bin package
+    Returns the exit status
+    """
+    argv = list(sys.argv[1:] if argv is None else argv)
+
+    # Older invocations: `vikid --setup`, and serve flags without a command
+    if not argv:
+        argv = ['serve']
+    elif argv[0] not in commands and argv[0] not in ('-h', '--help'):
+        argv = ['setup'] if '--setup' in argv else ['serve'] + argv
+
+    args = parser().parse_args(argv)
+    args.root_path = root_path
+
+    return commands[args.command](args)
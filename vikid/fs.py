@@ -5,20 +5,38 @@ fs.py
 ~~~~~
 
 Filesystem library - internal to Viki
+
+Job configs are written to a temporary file, fsynced and renamed over the
+old config so a crash or a concurrent reader never sees half a config.
+Read-modify-write cycles hold the job's lock, a thread lock within this
+process and a flock() on config.json.lock shared with every other viki
+process, so updates to different jobs never wait on each other.
 :license: Apache2, see LICENSE for more details
 """
 
-from vikid.application import app
+from vikid import _conf
+from vikid.locks import FileLock
 
+import collections
+import contextlib
 import os
-import subprocess
+import shutil
 import json
+import threading
 
-home = app.home_dir
+home = _conf.home_dir
 jobs_path = "{}/jobs".format(home)
 job_output_file = "output.txt"
 job_config_filename = "config.json"
 
+# One lock per job file so read-modify-write cycles don't interleave
+_job_file_locks = collections.defaultdict(threading.Lock)
+_job_file_locks_guard = threading.Lock()
+
+
+class StaleConfig(Exception):
+    """ A job's config changed since the version the caller read """
+
 
 # --- Main library
 
@@ -32,13 +50,88 @@ def write_job_file(job_file, text):
         return False
 
     # This will not work if the directory does not exist
-    with open(job_file, 'w') as file_obj:
+    # Write next to the real file and rename over it so readers
+    # never see a half written config
+    tmp_file = '{}.{}.{}.tmp'.format(job_file, os.getpid(), threading.get_ident())
+    with open(tmp_file, 'w') as file_obj:
         file_obj.write(json.dumps(text))
-        file_obj.close()
+        file_obj.flush()
+        os.fsync(file_obj.fileno())
+
+    os.replace(tmp_file, job_file)
+
+    # Make the rename itself survive a crash
+    dir_fd = os.open(os.path.dirname(job_file) or '.', os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
 
     return True
 
 
+@contextlib.contextmanager
+def job_file_lock(job_file):
+    """ job_file_lock
+    Hold a job file's lock for a read-modify-write cycle, against
+    other threads and other viki processes
+    :param job_file: abs path to a job's config.json
+    Raises FileNotFoundError if the job's directory is gone
+    """
+    with _job_file_locks_guard:
+        lock = _job_file_locks[job_file]
+
+    with lock:
+        with FileLock(job_file + '.lock'):
+            yield
+
+
+def update_job_file(job_file, update):
+    """ update_job_file
+    Read the json in job_file, hand the dict to update() to modify
+    in place and write it back atomically. Updates to the same file
+    are serialized so concurrent runs can't lose each others changes
+    :param job_file: abs path to a job's config.json
+    :param update: callable taking the parsed config dict
+    :returns dict: the updated config, or False if it could not be read
+    """
+    try:
+        with job_file_lock(job_file):
+            contents = read_job_file(job_file)
+            if contents is False:
+                return False
+
+            data = json.loads(contents)
+            update(data)
+            write_job_file(job_file, data)
+    except FileNotFoundError:
+        # The job was deleted underneath us
+        return False
+
+    return data
+
+
+def merge_patch(target, patch):
+    """ merge_patch
+    Apply a JSON merge patch (RFC 7396) to target
+    Objects are merged key by key, a null removes the key and
+    any other value replaces what was there
+    :returns: the patched value, target is not modified
+    """
+    if not isinstance(patch, dict):
+        return patch
+
+    merged = dict(target) if isinstance(target, dict) else {}
+
+    for key, value in patch.items():
+        if value is None:
+            merged.pop(key, None)
+        else:
+            merged[key] = merge_patch(merged.get(key), value)
+
+    return merged
+
+
 def read_job_file(job_file):
     """ _read_job_file
     Takes a job name (abs path) and returns the string version of .../jobs/job_name/config.json
@@ -59,16 +152,20 @@ def read_job_file(job_file):
 
 
 def dirty_rm_rf(directory_name):
-    """ Executes a quick and dirty `rm -rf directory_name'
-    Works on directories or files
-    Use subprocess because its easier to let bash do this than Python
+    """ Does the equivalent of `rm -rf directory_name'
+    Works on directories or files, missing paths are ignored
+    Done in-process so cleaning up never costs a fork/exec
     :param directory_name:
     :returns bool:
     """
 
-    subprocess.call(
-        [b'/bin/bash', b'-c', 'rm -rf ' + directory_name]
-    )
+    if os.path.isdir(directory_name) and not os.path.islink(directory_name):
+        shutil.rmtree(directory_name, ignore_errors=True)
+    else:
+        try:
+            os.remove(directory_name)
+        except FileNotFoundError:
+            pass
 
     return True
 
@@ -79,11 +176,7 @@ def job_exists(job_name):
     :param job_name:
     :returns bool:
     """
-    path = '{}/{}'.format(jobs_path, job_name)
-    print('jobs path: {}'.format(jobs_path))
-    print('job name: {}'.format(job_name))
-    print('path: {}'.format(path))
-    return os.path.exists(path)
+    return os.path.exists('{}/{}'.format(jobs_path, job_name))
 
 
 def read_last_run_output(output_file_path):
@@ -0,0 +1,240 @@
+# coding: utf-8
+
+"""
+history.py
+~~~~~~~~~~
+
+Run history store - internal to Viki
+
+Every finished run is recorded in a local SQLite database in WAL mode so
+it can be queried later by job, status and time range. Runs are handed
+to a writer thread and inserted in batches, so recording a run never
+waits on disk.
+:license: Apache2, see LICENSE for more details
+"""
+
+import collections
+import logging
+import sqlite3
+import threading
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+_columns = ['run_id', 'job', 'run_number', 'status', 'trigger', 'started',
+            'finished', 'duration', 'exit_code', 'message',
+            'user_time', 'system_time', 'max_rss', 'read_blocks', 'write_blocks']
+
+# Columns added after the first release, added to older databases on open
+_added_columns = [
+    ('user_time', 'REAL'),
+    ('system_time', 'REAL'),
+    ('max_rss', 'INTEGER'),
+    ('read_blocks', 'INTEGER'),
+    ('write_blocks', 'INTEGER'),
+]
+
+_schema = [
+    """
+    CREATE TABLE IF NOT EXISTS runs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        run_id TEXT,
+        job TEXT NOT NULL,
+        run_number INTEGER,
+        status TEXT NOT NULL,
+        trigger TEXT,
+        started REAL NOT NULL,
+        finished REAL,
+        duration REAL,
+        exit_code INTEGER,
+        message TEXT,
+        user_time REAL,
+        system_time REAL,
+        max_rss INTEGER,
+        read_blocks INTEGER,
+        write_blocks INTEGER
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS runs_job_started ON runs (job, started)",
+    "CREATE INDEX IF NOT EXISTS runs_status_started ON runs (status, started)",
+    "CREATE INDEX IF NOT EXISTS runs_started ON runs (started)",
+    "CREATE INDEX IF NOT EXISTS runs_run_id ON runs (run_id)",
+]
+
+
+def _encode_cursor(started: float, row_id: int) -> str:
+    return '{!r}:{}'.format(started, row_id)
+
+
+def _decode_cursor(cursor: str) -> Tuple[float, int]:
+    """ Raises ValueError on a cursor we didn't hand out """
+    started, row_id = cursor.split(':', 1)
+    return float(started), int(row_id)
+
+
+class HistoryStore:
+    """ SQLite backed log of finished runs """
+
+    def __init__(self, path: str, batch_size: int = 100, flush_interval: float = 0.5):
+        """ Initialize the store
+        path: SQLite database file, created on first use
+        batch_size: Most runs inserted in one transaction
+        flush_interval: Longest a recorded run waits before it is written
+        """
+        self.path: str = path
+        self.batch_size: int = batch_size
+        self.flush_interval: float = flush_interval
+
+        self._cond = threading.Condition()
+        self._pending: Deque[Dict[str, Any]] = collections.deque()
+        self._writing: int = 0
+        self._thread: Optional[threading.Thread] = None
+        self._local = threading.local()
+        self._schema_ready: bool = False
+        self._schema_lock = threading.Lock()
+
+
+    # --- Store internals
+
+
+    def _connect(self) -> sqlite3.Connection:
+        """ Per thread connection, sqlite3 connections can't be shared between threads """
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            return connection
+
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.row_factory = sqlite3.Row
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+
+        with self._schema_lock:
+            if not self._schema_ready:
+                with connection:
+                    for statement in _schema:
+                        connection.execute(statement)
+
+                    existing = set(row['name'] for row in connection.execute('PRAGMA table_info(runs)'))
+                    for column, column_type in _added_columns:
+                        if column not in existing:
+                            connection.execute('ALTER TABLE runs ADD COLUMN {} {}'.format(column, column_type))
+                self._schema_ready = True
+
+        self._local.connection = connection
+
+        return connection
+
+
+    def _write_loop(self) -> None:
+        """ Writer thread main loop, inserts pending runs in batches """
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+
+                # Give a burst of runs the chance to land in one transaction
+                if len(self._pending) < self.batch_size:
+                    self._cond.wait(self.flush_interval)
+
+                batch = [self._pending.popleft() for _ in range(min(self.batch_size, len(self._pending)))]
+                self._writing = len(batch)
+
+            try:
+                connection = self._connect()
+                with connection:
+                    connection.executemany(
+                        'INSERT INTO runs ({}) VALUES ({})'.format(', '.join(_columns), ', '.join('?' * len(_columns))),
+                        [[run.get(column) for column in _columns] for run in batch]
+                    )
+            except sqlite3.Error as error:
+                logger.error('Could not record %d run(s) in history: %s', len(batch), error)
+
+            with self._cond:
+                self._writing = 0
+                self._cond.notify_all()
+
+
+    # --- Store functions
+
+
+    def record(self, run: Dict[str, Any]) -> None:
+        """ Queue a finished run to be written
+        run holds any of: run_id, job, run_number, status, trigger,
+        started, finished, duration, exit_code, message, user_time,
+        system_time, max_rss, read_blocks, write_blocks
+        """
+        with self._cond:
+            self._pending.append(run)
+
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._write_loop, name='viki-history', daemon=True)
+                self._thread.start()
+
+            self._cond.notify_all()
+
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """ Wait until every recorded run has been written
+        Returns False if timeout expired first
+        """
+        with self._cond:
+            self._cond.notify_all()
+            return self._cond.wait_for(lambda: not self._pending and not self._writing, timeout)
+
+
+    def get(self, run_id: str) -> Optional[Dict[str, Any]]:
+        """ Look up a single finished run by its run id """
+        row = self._connect().execute(
+            'SELECT {} FROM runs WHERE run_id = ?'.format(', '.join(_columns)), [run_id]).fetchone()
+
+        return {column: row[column] for column in _columns} if row is not None else None
+
+
+    def query(self, job: Optional[str] = None, status: Optional[str] = None,
+              since: Optional[float] = None, until: Optional[float] = None,
+              limit: int = 50, cursor: Optional[str] = None) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """ Find runs, newest first
+        job, status: Only runs of this job / with this status
+        since, until: Only runs started in this time range (unix timestamps)
+        cursor: The cursor returned with the previous page
+        Returns Tuple (runs, cursor for the next page or None)
+        Raises ValueError on a malformed cursor
+        """
+        clauses: List[str] = []
+        params: List[Any] = []
+
+        if job is not None:
+            clauses.append('job = ?')
+            params.append(job)
+
+        if status is not None:
+            clauses.append('status = ?')
+            params.append(status)
+
+        if since is not None:
+            clauses.append('started >= ?')
+            params.append(since)
+
+        if until is not None:
+            clauses.append('started < ?')
+            params.append(until)
+
+        if cursor:
+            started, row_id = _decode_cursor(cursor)
+            clauses.append('(started < ? OR (started = ? AND id < ?))')
+            params.extend([started, started, row_id])
+
+        sql = 'SELECT id, {} FROM runs'.format(', '.join(_columns))
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        sql += ' ORDER BY started DESC, id DESC LIMIT ?'
+        params.append(limit + 1)
+
+        rows = self._connect().execute(sql, params).fetchall()
+
+        next_cursor: Optional[str] = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = _encode_cursor(rows[-1]['started'], rows[-1]['id'])
+
+        return [{column: row[column] for column in _columns} for row in rows], next_cursor
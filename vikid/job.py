@@ -8,14 +8,35 @@ This module implements the main Job api for Viki
 :license: Apache2, see LICENSE for more details
 """
 
-import ast
+import logging
 import os
 import subprocess
 import json
-import uuid
-from typing import Any, Dict, Tuple, List, IO, Optional, Union
+import time
+from typing import Any, Callable, Dict, Tuple, List, Optional, Union
 
+from vikid import artifacts, builds
+from vikid import capture as captures
 from vikid import fs as filesystem
+from vikid import logs, metrics, profiling, stepcache
+from vikid.application import app
+from vikid.artifacts import ArtifactStore
+from vikid.capture import Capture
+from vikid.history import HistoryStore
+from vikid.limits import Limits, remove_cgroup, usage_totals
+from vikid.locks import FileLock, acquire_slot
+from vikid.registry import JobRegistry, file_etag
+from vikid.scheduler import trigger_options
+from vikid.stepcache import CachedStep, StepCache
+from vikid.steps import RunControl, StepGraph, timeout_seconds
+from vikid.supervisor import StepProcess, kill_groups, orphaned_groups, supervisor
+from vikid.webhooks import webhook_options
+from vikid.workspace import Workspace, WorkspacePool, workspace_options
+
+logger = logging.getLogger(__name__)
+
+# Run slot lock files in each job's directory, run.slot.0, run.slot.1...
+run_slot_prefix = "run.slot"
 
 
 class Job:
@@ -45,6 +66,27 @@ class Job:
         # Name of job configuration file
         self.job_config_filename: str = "config.json"
 
+        # Parsed job configs, kept in memory and invalidated by mtime checks
+        self.registry: JobRegistry = JobRegistry(self.jobs_path, self.job_config_filename)
+
+        # Finished runs, queryable by job, status and time
+        self.history: HistoryStore = HistoryStore(self.home + "/" + "history.db")
+
+        # Artifacts kept by builds, stored once however many builds keep them
+        self.artifacts: ArtifactStore = ArtifactStore(self.home + "/" + "artifacts")
+        builds.pruner.add_listener(lambda job_dir, removed: self.artifacts.collect_garbage())
+
+        # Outputs of steps that opted into caching, their files are kept in the artifact store
+        self.step_cache: StepCache = StepCache(
+            self.home + "/" + "stepcache", self.artifacts, int(app.get_setting('step_cache_max_bytes')))
+
+        # Workspaces steps run in, persistent ones are cached under workspaces/cache
+        self.workspaces: WorkspacePool = WorkspacePool(
+            self.home + "/" + "workspaces", int(app.get_setting('workspace_cache_max_bytes')))
+
+        # One marker per unfinished build, locked by the process running it
+        self.running_path: str = self.home + "/" + "running"
+
 
     # --- Job internals
 
@@ -64,54 +106,174 @@ class Job:
         return quote + string + quote
 
 
-    def _run_shell_command(self, command: str, output_filename: str,
-                           job_arguments: Optional[List[str]] = None) -> Tuple[bool, int]:
-        """ _run_shell_command
+    def _start_step(self, command: str, output_filename: str,
+                    job_arguments: Optional[List[str]] = None, job_name: Optional[str] = None,
+                    cwd: Optional[str] = None, run_id: Optional[str] = None,
+                    env: Optional[Dict[str, str]] = None, limits: Optional[Limits] = None,
+                    capture: Optional[Capture] = None, step_name: Optional[str] = None) -> StepProcess:
+        """ _start_step
         string:command Shell command to run
         string:file path Where the command results (stdout) are stored
         array:arguments to be given to the command
-        Runs the given command and stores results in a file
-        Returns Tuple (True|False, Return code)
+        string:job_name Name of the job this step belongs to
+        string:cwd Workspace directory to run the command in
+        string:run_id Run this step belongs to
+        dict:env Variables added to viki's own environment
+        Limits:limits Resource limits applied to the step process
+        Capture:capture Reads stdout and stderr through pipes instead of appending them to the file
+        string:step_name Name the captured output is labelled with
+        Starts the given command under the process supervisor without waiting for it
+        Returns the running StepProcess
         """
-        output_file_obj: IO[Any]
-        sh_script_name: str
         child_process: List[str]
 
-        # Generate output file for run results
-        output_file_obj = open(output_filename, 'a')
-
-        # Generate a tmp sh file to run command from
-        sh_script_name = 'viki-' + str(uuid.uuid4())
-        with open(sh_script_name, 'w') as sh_script_obj:
-            sh_script_obj.write(command)
-            sh_script_obj.close()
-
-        # Create the bash command
-        child_process = [u'/bin/bash', u'-xe', sh_script_name]
+        # Create the bash command, the step is handed to bash as a string so
+        # there is no script file to write and clean up. The word after the
+        # script becomes $0 and job arguments become $1, $2...
+        child_process = [u'/bin/bash', u'-xe', u'-c', command, u'viki']
 
         # If the job was passed any args, send them into the child process as well
         if job_arguments is not None and len(job_arguments) > 0:
             for argument in job_arguments:
                 child_process.append(str(argument))
 
+        apply_limits: Optional[Callable[[int], None]] = None
+        cgroup: Optional[str] = None
+
+        if limits is not None:
+            child_process, apply_limits, cgroup = limits.prepare(child_process, job_name or 'step')
+
         # *!* DEBUG - show the list that is about to get piped into Popen
         if self.debug:
-            print('Func: _run_shell_command; Var: child_process: ' + str(child_process))
+            print('Func: _start_step; Var: child_process: ' + str(child_process))
+
+        # Captured steps write into pipes the capture drains, otherwise steps running
+        # side by side append to the same output file. The child keeps its own copy
+        # of the descriptors so ours can be closed right away.
+        # Each step leads a process group so it can be stopped with its children
+        stdout: Any
+        stderr: Any
+        read_fds: List[int] = []
+
+        if capture is not None:
+            stdout_r, stdout = os.pipe()
+            stderr_r, stderr = os.pipe()
+            read_fds = [stdout_r, stderr_r]
+        else:
+            stdout, stderr = open(output_filename, 'a'), subprocess.STDOUT
 
-        process = subprocess.Popen(
-            child_process,
-            stdout=output_file_obj,
-            stderr=subprocess.STDOUT
-        )
+        try:
+            process = supervisor.spawn(
+                child_process,
+                command=command,
+                job_name=job_name,
+                run_id=run_id,
+                cwd=cwd,
+                env=dict(os.environ, **env) if env else None,
+                stdout=stdout,
+                stderr=stderr,
+                start_new_session=True
+            )
+        except BaseException:
+            remove_cgroup(cgroup)
+            for fd in read_fds:
+                os.close(fd)
+            raise
+        finally:
+            if capture is not None:
+                os.close(stdout)
+                os.close(stderr)
+            else:
+                stdout.close()
 
-        while process.poll() is None:
-            # Not finished
-            pass
+        # Limits the wrapper tools could not set, and the step's cgroup
+        if apply_limits is not None:
+            apply_limits(process.pid)
 
-        return_code = process.poll()
+        if capture is not None:
+            capture.attach(step_name or command, read_fds[0], read_fds[1])
 
-        output_file_obj.close()
-        filesystem.dirty_rm_rf(sh_script_name)
+        if cgroup is not None:
+            process.on_exit(lambda _: remove_cgroup(cgroup))
+
+        return process
+
+
+    def _restore_step(self, job_name: str, step: Dict[str, Any], job_arguments: Optional[List[str]],
+                      env: Dict[str, str], workspace: str, capture: Capture,
+                      run_id: Optional[str] = None) -> Tuple[Optional[str], Optional[CachedStep]]:
+        """ _restore_step
+        Look a cacheable step up in the step cache, on a hit its outputs are copied
+        into the workspace and the output it printed is replayed into capture
+        Returns Tuple (cache key, CachedStep on a hit), the key is None if the
+        step's inputs could not be read and it runs uncached
+        """
+        began: float = time.monotonic()
+
+        try:
+            key: str = self.step_cache.key(job_name, step, job_arguments, dict(os.environ, **env), workspace)
+        except OSError as error:
+            logger.warning('Could not work out the cache key of step %s of %s: %s', step['name'], job_name, error)
+            return None, None
+
+        output = self.step_cache.restore(key, workspace)
+
+        self.step_cache.count(job_name, step['name'], output is not None)
+        metrics.step_cache.inc(job_name, 'hit' if output is not None else 'miss')
+
+        if output is None:
+            return key, None
+
+        capture.inject(step['name'], output)
+
+        return key, CachedStep(step['run'], key, job_name=job_name, run_id=run_id,
+                               wall_time=time.monotonic() - began)
+
+
+    def _acquire_run_slot(self, job_dir: str, job_json: Dict[str, Any], control: RunControl,
+                          settings: Optional[Dict[str, Any]] = None) -> Optional[FileLock]:
+        """ _acquire_run_slot
+        Wait for one of the job's "concurrency" run slots, flocks in the job's directory
+        settings: viki.json as already read by the caller
+        Returns the held slot, or None if the run was cancelled while it waited
+        """
+        concurrency: int = max(1, int(job_json.get('concurrency', app.get_setting('job_concurrency', settings))))
+        prefix: str = job_dir + "/" + run_slot_prefix
+
+        slot = acquire_slot(prefix, concurrency, stop=lambda: True)
+        if slot is not None:
+            return slot
+
+        logger.info('Waiting for a run slot of %s', os.path.basename(job_dir))
+
+        return acquire_slot(prefix, concurrency, stop=lambda: control.reason is not None)
+
+
+    def _run_step(self, command: str, output_filename: str,
+                  job_arguments: Optional[List[str]] = None,
+                  job_name: Optional[str] = None, cwd: Optional[str] = None) -> StepProcess:
+        """ _run_step
+        Runs the given command under the process supervisor and waits for it
+        Returns the finished StepProcess with its return code and timings
+        """
+        process = self._start_step(command, output_filename, job_arguments, job_name=job_name, cwd=cwd)
+
+        # Sleeps until the supervisor reaps the child, no polling
+        process.wait()
+
+        return process
+
+
+    def _run_shell_command(self, command: str, output_filename: str,
+                           job_arguments: Optional[List[str]] = None) -> Tuple[bool, int]:
+        """ _run_shell_command
+        string:command Shell command to run
+        string:file path Where the command results (stdout) are stored
+        array:arguments to be given to the command
+        Runs the given command and stores results in a file
+        Returns Tuple (True|False, Return code)
+        """
+        return_code: int = self._run_step(command, output_filename, job_arguments).return_code
 
         return (True, return_code) if return_code == 0 else (False, return_code)
 
@@ -119,28 +281,42 @@ class Job:
     # --- Job functions
 
 
-    def get_jobs(self) -> Dict[str, Any]:
+    def get_jobs(self, prefix: str = '', offset: int = 0, limit: Optional[int] = None) -> Dict[str, Any]:
         """
         List jobs in /usr/local/viki/jobs
-        Takes no parameters
+        string:prefix Only list jobs whose name starts with this
+        int:offset, int:limit Page through the sorted list of names
         """
         message: str = "Ok"
         success: int = 1
+        jobs_list: List[str] = []
+        total: int = 0
 
         try:
-            # Get all job dirs
-            jobs_dir_ls = next(os.walk(self.jobs_path))
-            jobs_list: List[str] = jobs_dir_ls[1]
+            # Get all job names from the registry
+            names: List[str] = self.registry.names(prefix)
+            total = len(names)
+            jobs_list = names[offset:] if limit is None else names[offset:offset + limit]
 
         except OSError as error:
             message = str(error)
             success = 0
 
-        ret: Dict[str, Any] = {"success": success, "message": message, "jobs": jobs_list}
+        ret: Dict[str, Any] = {"success": success, "message": message, "jobs": jobs_list, "total": total}
 
         return ret
 
 
+    def get_job_config(self, job_name: str) -> Optional[Dict[str, Any]]:
+        """
+        Get the parsed config of a single job, or None if it does not exist
+        The dict is shared with the registry, copy it before changing it
+        """
+        entry = self.registry.get(job_name)
+
+        return entry.config if entry is not None else None
+
+
     def get_job_by_name(self, job_name: str) -> Dict[str, Any]:
         """
         Get details of a single job by name
@@ -154,10 +330,10 @@ class Job:
             if job_name is None:
                 raise ValueError('Missing required field: job_name')
 
-            job_dir: str = self.jobs_path + "/" + job_name
+            entry = self.registry.get(job_name)
 
-            if os.path.isdir(job_dir) and os.path.exists(job_dir + "/" + self.job_config_filename):
-                contents = filesystem.read_job_file(job_dir + "/" + self.job_config_filename)
+            if entry is not None:
+                contents = entry.text
             else:
                 raise OSError('Job directory not found')
 
@@ -170,9 +346,52 @@ class Job:
         return ret
 
 
-    def output_job(self, name: str) -> Dict[str, Any]:
+    def output_file(self, name: str, run_number: Optional[int] = None) -> Tuple[Optional[int], str]:
+        """
+        Find the output file of a specific job
+        Defaults to the latest build, pass run_number for an older one
+        Returns Tuple (run number, abs path of the output file)
+        """
+        job_directory: str = self.jobs_path + "/" + name
+
+        if run_number is None:
+            job_builds: List[int] = builds.list_builds(job_directory)
+            run_number = job_builds[-1] if job_builds else None
+
+        # Jobs last run before build directories existed keep a single output file
+        if run_number is None:
+            return None, job_directory + "/" + self.job_output_file
+
+        return run_number, builds.build_path(job_directory, run_number) + "/" + self.job_output_file
+
+
+    def build_running(self, name: str, run_number: Optional[int]) -> bool:
+        """ True while build run_number of a job has not finished """
+        if run_number is None:
+            return False
+
+        meta = builds.read_meta(builds.build_path(self.jobs_path + "/" + name, run_number))
+
+        return meta is not None and meta.get("state") == "running"
+
+
+    def last_run_time(self, name: str) -> Optional[float]:
+        """ When the latest build of a job started, None if it never ran """
+        job_directory: str = self.jobs_path + "/" + name
+        job_builds: List[int] = builds.list_builds(job_directory)
+
+        if not job_builds:
+            return None
+
+        meta = builds.read_meta(builds.build_path(job_directory, job_builds[-1]))
+
+        return meta.get("started") if meta is not None else None
+
+
+    def output_job(self, name: str, run_number: Optional[int] = None) -> Dict[str, Any]:
         """
         Get the output file of a specific job and return the contents of the file
+        Defaults to the latest build, pass run_number to read an older one
         """
         message: str = "Ok"
         success: int = 1
@@ -184,10 +403,11 @@ class Job:
                 raise ValueError('Missing required field: job_name')
 
             job_directory: str = self.jobs_path + "/" + name
-            output_file: str = job_directory + "/" + self.job_output_file
+            run_number, output_file = self.output_file(name, run_number)
 
-            if os.path.isdir(job_directory) and os.path.exists(output_file):
-                contents = filesystem.read_last_run_output(output_file)
+            if os.path.isdir(job_directory) and logs.exists(output_file):
+                with logs.LogReader(output_file) as reader:
+                    contents = reader.read(0, reader.size).decode('utf-8', 'replace')
             else:
                 raise OSError('Job directory not found')
 
@@ -195,7 +415,93 @@ class Job:
             message = str(error)
             success = 0
 
-        return {"success": success, "message": message, "name": name, "output": contents}
+        return {"success": success, "message": message, "name": name, "run_number": run_number, "output": contents}
+
+
+    def get_builds(self, name: str) -> Dict[str, Any]:
+        """
+        List the builds of a specific job, newest first, with each build's meta.json
+        """
+        message: str = "Ok"
+        success: int = 1
+        job_builds: List[Dict[str, Any]] = []
+
+        try:
+            job_directory: str = self.jobs_path + "/" + name
+
+            if not os.path.isdir(job_directory):
+                raise OSError('Job directory not found')
+
+            for run_number in reversed(builds.list_builds(job_directory)):
+                meta = builds.read_meta(builds.build_path(job_directory, run_number))
+                job_builds.append(meta or {"run_number": run_number, "state": "unknown"})
+
+        except OSError as error:
+            message = str(error)
+            success = 0
+
+        return {"success": success, "message": message, "name": name, "builds": job_builds}
+
+
+    def get_artifacts(self, name: str, run_number: int) -> Dict[str, Any]:
+        """
+        List the artifacts a build of a specific job kept
+        """
+        message: str = "Ok"
+        success: int = 1
+        kept: List[Dict[str, Any]] = []
+
+        try:
+            build_dir: str = builds.build_path(self.jobs_path + "/" + name, run_number)
+
+            if not os.path.isdir(build_dir):
+                raise OSError('Build not found')
+
+            kept = artifacts.read_manifest(build_dir)
+
+        except OSError as error:
+            message = str(error)
+            success = 0
+
+        return {"success": success, "message": message, "name": name, "run_number": run_number, "artifacts": kept}
+
+
+    def get_step_cache(self, name: str) -> Dict[str, Any]:
+        """
+        Step cache hits and misses of a specific job, and the entries it has cached
+        """
+        message: str = "Ok"
+        success: int = 1
+        stats: Dict[str, Any] = {}
+
+        try:
+            if not os.path.isdir(self.jobs_path + "/" + name):
+                raise OSError('Job not found')
+
+            stats = self.step_cache.stats(name)
+            stats.update(self.step_cache.usage(name))
+
+        except OSError as error:
+            message = str(error)
+            success = 0
+
+        return {"success": success, "message": message, "name": name, "cache": stats}
+
+
+    @staticmethod
+    def _check_config(config: Dict[str, Any]) -> None:
+        """ Check the parts of a job's config a run relies on
+        Raises ValueError on the first one that is not usable
+        """
+        StepGraph(config['steps'])
+        artifacts.patterns(config.get('artifacts'))
+        workspace_options(config.get('workspace'))
+        builds.retention(config.get('retention'))
+        trigger_options(config.get('trigger'))
+        webhook_options(config.get('webhook'))
+
+        for field in ('timeout', 'step_timeout'):
+            timeout_seconds(config.get(field), field)
 
 
     def create_job(self, new_name: str, data: Dict[str, Union[str, int]]) -> Dict[str, Any]:
@@ -209,11 +515,8 @@ class Job:
             job_dir: str = self.jobs_path + "/" + new_name
             job_filename: str = job_dir + "/" + self.job_config_filename
 
-            # Bail if
-            if os.path.exists(job_dir):
-                raise SystemError('Job directory already exists')
-            else:
-                os.mkdir(job_dir)
+            if not isinstance(data, dict):
+                raise ValueError('Job config must be a JSON object')
 
             if 'description' not in  data.keys():
                 raise ValueError('Missing description')
@@ -221,6 +524,15 @@ class Job:
             if 'steps' not in  data.keys():
                 raise ValueError('Missing steps')
 
+            # Reject configs that could never run
+            self._check_config(data)
+
+            # Bail if
+            if os.path.exists(job_dir):
+                raise SystemError('Job directory already exists')
+            else:
+                os.mkdir(job_dir)
+
             data['runNumber'] = 0
             data['lastSuccessfulRun'] = 0
             data['lastFailedRun'] = 0
@@ -228,6 +540,7 @@ class Job:
 
             # Create job file
             filesystem.write_job_file(job_filename, data)
+            self.registry.invalidate(new_name)
 
         except (ValueError, SystemError) as error:
             message = str(error)
@@ -238,46 +551,235 @@ class Job:
         return ret
 
 
-    def update_job(self, name: str, data: Dict[str, Any]) -> Dict[str, Any]:
-        """ Update an existing job """
+    def update_job(self, name: str, data: Optional[Dict[str, Any]] = None,
+                   etag: Optional[str] = None) -> Dict[str, Any]:
+        """ Update an existing job
+        data: JSON merge patch applied to the job's config, a null removes a field
+        etag: Only update the job if its config is still at this version
+        Raises filesystem.StaleConfig if the config changed since etag
+        """
         message: str = "Job successfully updated"
         success: int = 1
+        new_etag: Optional[str] = None
 
         try:
 
-            # Check required fields first
-            #     description
-            #     steps
-
             # Find job
             if not filesystem.job_exists(name):
                 raise ValueError('Job {} not found'.format(name))
 
-            # Prep new config
+            if data is not None and not isinstance(data, dict):
+                raise ValueError('Update must be a JSON object')
+
+            # Counters and the name belong to viki
+            managed = set(data or {}) & {'name', 'runNumber', 'lastSuccessfulRun', 'lastFailedRun'}
+            if managed:
+                raise ValueError('Can not update {}'.format(', '.join(sorted(managed))))
+
+            job_filename: str = self.jobs_path + "/" + name + "/" + self.job_config_filename
+
+            try:
+                with filesystem.job_file_lock(job_filename):
+                    contents = filesystem.read_job_file(job_filename)
+                    if contents is False:
+                        raise ValueError('Job {} not found'.format(name))
+
+                    if etag is not None and file_etag(job_filename) != etag:
+                        raise filesystem.StaleConfig('Job config changed since version {}'.format(etag))
+
+                    if data:
+                        config: Dict[str, Any] = filesystem.merge_patch(json.loads(contents), data)
+
+                        # Check required fields are still there
+                        for field in ('description', 'steps'):
+                            if field not in config:
+                                raise ValueError('Missing {}'.format(field))
+
+                        self._check_config(config)
+
+                        filesystem.write_job_file(job_filename, config)
+
+                    # Taken under the lock so it is the version this update wrote
+                    new_etag = file_etag(job_filename)
+            except FileNotFoundError:
+                raise ValueError('Job {} not found'.format(name))
+
+            self.registry.invalidate(name)
 
         except ValueError as error:
             message = str(error)
             success = 0
 
-        return {"success": success, "message": message}
+        return {"success": success, "message": message, "etag": new_etag}
 
 
-    def run_job(self, name: str, job_args: Optional[List[str]] = None):
-        """ Run a specific job """
+    def _start_build(self, job_dir: str, job_config_json_file: str) -> Tuple[int, str]:
+        """ Allocate the next run number and create its build directory
+        Returns Tuple (run number, build directory)
+        """
+
+        def bump_run_number(config: Dict[str, Any]) -> None:
+            config['runNumber'] = int(config.get('runNumber', 0)) + 1
+
+        while True:
+            config = filesystem.update_job_file(job_config_json_file, bump_run_number)
+            self.registry.invalidate(os.path.basename(job_dir))
+            if config is False:
+                raise OSError('Job file could not be read')
+
+            try:
+                return config['runNumber'], builds.create_build(job_dir, config['runNumber'])
+            except FileExistsError:
+                # Left behind by a run that never updated the counter, skip past it
+                continue
+
+
+    def _mark_running(self, name: str, run_number: int, run_id: Optional[str] = None) -> FileLock:
+        """ Lock a marker for a build this process is running, holding the run's id
+        A marker nobody holds belongs to a build whose viki process died
+        """
+        os.makedirs(self.running_path, exist_ok=True)
+
+        marker = FileLock("{}/{}.{}".format(self.running_path, name, run_number))
+        marker.acquire()
+
+        if run_id:
+            os.pwrite(marker.fileno(), run_id.encode('utf-8'), 0)
+
+        return marker
+
+
+    def _unmark_running(self, marker: FileLock) -> None:
+        """ Remove a build's marker once it has finished """
+        # Removed before it is released so it can never be found unlocked by recovery
+        try:
+            os.remove(marker.path)
+        except OSError:
+            pass
+
+        marker.release()
+
+
+    def _recover_build(self, name: str, run_number: int) -> Optional[Dict[str, Any]]:
+        """ Stop what is left of a build whose viki process died and record it as interrupted
+        Returns None if the build had finished after all
+        """
+        job_dir: str = self.jobs_path + "/" + name
+        build_dir: str = builds.build_path(job_dir, run_number)
+
+        meta = builds.read_meta(build_dir)
+        if meta is None or meta.get("state") != "running":
+            return None
+
+        job_json: Dict[str, Any] = self.get_job_config(name) or {}
+
+        # Its steps lead their own process groups and outlived it, find them by their environment
+        groups = orphaned_groups("VIKI_BUILD_DIR", build_dir)
+        if groups:
+            logger.warning('Stopping %d leftover process groups of %s #%s', len(groups), name, run_number)
+            kill_groups(groups, grace=float(job_json.get('kill_grace', app.get_setting('kill_grace'))))
+
+        # Fresh workspaces are removed, a cached one is kept for the next run as usual
+        workspace_path: Optional[str] = meta.get("workspace")
+        if workspace_path and os.path.dirname(workspace_path) == self.workspaces.runs_path:
+            self.workspaces.release(Workspace(workspace_path, name))
+
+        finished: float = time.time()
+        started: float = meta.get("started") or finished
+        message: str = "Run interrupted, the viki process running it stopped"
+
+        meta.update({"state": "interrupted", "message": message, "return_code": -1,
+                     "finished": finished, "duration": finished - started})
+        self._finish_build(job_dir, job_dir + "/" + self.job_config_filename, build_dir, meta, job_json)
+
+        metrics.runs_finished.inc(name, "interrupted")
+
+        self.history.record({
+            "run_id": meta.get("run_id"),
+            "job": name,
+            "run_number": run_number,
+            "status": "interrupted",
+            "trigger": meta.get("trigger"),
+            "started": started,
+            "finished": finished,
+            "duration": finished - started,
+            "exit_code": -1,
+            "message": message,
+        })
+
+        return {"job": name, "run_number": run_number, "build_dir": build_dir, "stopped_groups": len(groups)}
+
+
+    def _finish_build(self, job_dir: str, job_config_json_file: str, build_dir: str,
+                      meta: Dict[str, Any], job_json: Dict[str, Any],
+                      settings: Optional[Dict[str, Any]] = None) -> None:
+        """ Record the outcome of a build, update the job's counters
+        and queue the job's old builds for pruning
+        settings: viki.json as already read by the caller
+        """
+        builds.write_meta(build_dir, meta)
+
+        counter: str = 'lastSuccessfulRun' if meta['state'] == 'succeeded' else 'lastFailedRun'
+
+        def record_run(config: Dict[str, Any]) -> None:
+            config[counter] = max(int(config.get(counter, 0)), meta['run_number'])
+
+        filesystem.update_job_file(job_config_json_file, record_run)
+        self.registry.invalidate(os.path.basename(job_dir))
+
+        retention: Dict[str, Any] = builds.retention(job_json.get('retention'))
+        builds.pruner.schedule(
+            job_dir,
+            keep_runs=int(retention.get('keep_runs', app.get_setting('build_keep_runs', settings))),
+            max_bytes=int(retention.get('max_bytes', app.get_setting('build_max_bytes', settings)))
+        )
+
+
+    def run_job(self, name: str, job_args: Optional[List[str]] = None, trigger: str = 'manual',
+                run_id: Optional[str] = None, env: Optional[Dict[str, str]] = None,
+                control: Optional[RunControl] = None, profile: bool = False,
+                watch: Optional[Callable[[Capture], Any]] = None):
+        """ Run a specific job
+        Each run gets its own build directory holding its output and meta.json
+        and is recorded in the run history
+        env: Extra environment for the steps, on top of the VIKI_* run variables
+        control: Lets another thread cancel the run
+        profile: Sample the steps and write a per step timing breakdown to profile.json
+        watch: Called with the run's Capture once its build has started, to follow its output
+        A job runs at most "concurrency" times at once across every viki process on the
+        host, a run waits here for one of the job's run slots
+        The run ends up succeeded, failed, timed_out or cancelled, or interrupted
+        if this process dies before it finishes, see recover_interrupted_runs()
+        """
         message: str = "Run successful"
         success: int = 1
+        status: str = "succeeded"
         return_code: int = 0
+        steps: List[Dict[str, Any]] = []
+        critical_path: Dict[str, Any] = {"steps": [], "duration": 0.0}
+        run_number: int = 0
+        build_dir: Optional[str] = None
+        job_json: Dict[str, Any] = {}
+        started: float = time.time()
 
         # Construct job directory and file path names
         job_dir: str = self.jobs_path + "/" + name
         job_config_json_file: str = job_dir + "/" + "config.json"
 
-        # Generate a tmp directory to work in
-        # Use uuid4() because it creates a truly random uuid
-        # and doesnt require any arguments and uuid1 uses
-        # the system network addr.
-        tmp_cwd: str = "/tmp/viki-" + str(uuid.uuid4())
-        os.mkdir(tmp_cwd)
+        workspace: Optional[Workspace] = None
+        artifact_globs: List[str] = []
+        kept: List[Dict[str, Any]] = []
+        capture: Optional[Capture] = None
+        sampler: Optional[profiling.Sampler] = profiling.Sampler() if profile else None
+        run_profile: Optional[List[Dict[str, Any]]] = None
+        slot: Optional[FileLock] = None
+        marker: Optional[FileLock] = None
+
+        # viki.json is read once for the whole run
+        settings: Dict[str, Any] = app.read_config()
+
+        if control is None:
+            control = RunControl()
 
         try:
 
@@ -286,44 +788,299 @@ class Job:
             if not os.path.isdir(job_dir):
                 raise OSError('Job not found')
 
-            # Check config json file exists
+            # Look up the job's config, the registry only re-reads it if it changed
             # Otherwise raise OSError
-            if not os.path.isfile(job_config_json_file):
+            job_json = self.get_job_config(name)
+            if job_json is None:
                 raise OSError('Job file not found')
 
-            # Read the file and load the json inside it
-            # Otherwise raise OSError
-            job_json = json.loads(filesystem.read_job_file(job_config_json_file))
-            if job_json is False or job_json is None:
-                raise OSError('Job file could not be read')
+            # Grab the json array "steps" from jobs/<jobName>/config.json
+            # and work out which steps may run side by side
+            graph: StepGraph = StepGraph(job_json['steps'])
+            limits: Limits = Limits(job_json.get('limits'), app.get_setting('cgroup_root', settings))
+            artifact_globs = artifacts.patterns(job_json.get('artifacts'))
 
-            # Create filename path for output file
-            # todo: Move this to store the output in each individual build dir
-            filename: str = job_dir + "/" + "output.txt"
+            # Hold one of the job's run slots, shared with the daemon's workers and `vikid run`
+            slot = self._acquire_run_slot(job_dir, job_json, control, settings)
+            if slot is None:
+                status = "cancelled"
+                raise SystemError('Run cancelled')
 
-            # Grab the json array "steps" from jobs/<jobName>/config.json
-            job_steps: str = job_json['steps']
+            # Allocate a run number and give this run its own build directory
+            run_number, build_dir = self._start_build(job_dir, job_config_json_file)
+            marker = self._mark_running(name, run_number, run_id)
 
-            # Execute them individually
-            # If any of these steps fail then we stop execution
-            for step in job_steps:
-                success_bool, return_code = self._run_shell_command(step, filename, job_args)
+            # Steps run in a fresh workspace, or the job's cached one if it asks for that
+            workspace_config: Dict[str, Any] = workspace_options(job_json.get('workspace'))
+            workspace = self.workspaces.acquire(name, persistent=bool(workspace_config.get('persistent')))
 
-                # If unsuccessful stop execution
-                if not success_bool:
-                    raise SystemError('Build step failed')
+            builds.write_meta(build_dir, {"run_number": run_number, "run_id": run_id, "state": "running",
+                                          "trigger": trigger, "started": started,
+                                          "workspace": workspace.path})
 
-        except (OSError, subprocess.CalledProcessError, SystemError) as error:
+            # Create filename path for output file
+            filename: str = build_dir + "/" + self.job_output_file
+
+            # Let steps know which run they belong to
+            step_env: Dict[str, str] = dict(env or {})
+            step_env.update({
+                "VIKI_JOB_NAME": name,
+                "VIKI_RUN_ID": run_id or "",
+                "VIKI_RUN_NUMBER": str(run_number),
+                "VIKI_BUILD_DIR": build_dir,
+            })
+
+            # Steps write into pipes, their output is fanned out to live subscribers
+            capture = Capture(filename, int(app.get_setting('capture_buffer_bytes', settings)),
+                              int(job_json.get('log_compression', app.get_setting('log_compression', settings))))
+            captures.register(name, run_number, capture)
+            if watch is not None:
+                watch(capture)
+
+            # Cacheable steps that missed the cache: their key and the entry being put together
+            cache_pending: Dict[str, Tuple[str, str]] = {}
+
+            def start(step: Dict[str, Any]) -> Union[StepProcess, CachedStep]:
+                # Keep the output of the steps this one needs ahead of its own
+                capture.settle(step['needs'])
+
+                if step.get('cache') is not None:
+                    key, cached = self._restore_step(name, step, job_args, step_env, workspace.path, capture, run_id)
+                    if cached is not None:
+                        return cached
+                    if key is not None:
+                        cache_pending[step['name']] = (key, self.step_cache.begin())
+                        capture.record(step['name'], cache_pending[step['name']][1] + "/" + stepcache.log_filename)
+
+                try:
+                    process = self._start_step(step['run'], filename, job_args, job_name=name,
+                                               cwd=workspace.path, run_id=run_id, env=step_env, limits=limits,
+                                               capture=capture, step_name=step['name'])
+                except BaseException:
+                    if step['name'] in cache_pending:
+                        capture.stop_recording(step['name'])
+                        self.step_cache.discard(cache_pending.pop(step['name'])[1])
+                    raise
+
+                if sampler is not None:
+                    sampler.watch(step['name'], process.pid)
+                    process.on_exit(lambda exited: sampler.forget(exited.pid))
+                return process
+
+            def finish(step: Dict[str, Any], process: StepProcess) -> None:
+                # Keep what a cacheable step produced before the steps that need it can change it
+                if step['name'] not in cache_pending:
+                    return
+
+                key, pending = cache_pending.pop(step['name'])
+                capture.settle([step['name']])
+                capture.stop_recording(step['name'])
+
+                if process.return_code != 0 or process in control.stopped:
+                    self.step_cache.discard(pending)
+                    return
+
+                try:
+                    self.step_cache.store(key, pending, workspace.path, name, step)
+                except OSError as error:
+                    logger.warning('Could not cache step %s of %s: %s', step['name'], name, error)
+
+            metrics.runs_started.inc(name)
+
+            control.grace = float(job_json.get('kill_grace', app.get_setting('kill_grace', settings)))
+
+            # Execute each step once the steps it needs have succeeded
+            # If any of these steps fail, time out or the run is cancelled we stop execution
+            steps = graph.run(start,
+                              max_parallel=int(job_json.get('max_parallel_steps',
+                                                            app.get_setting('max_parallel_steps', settings))),
+                              control=control,
+                              timeout=job_json.get('timeout'),
+                              step_timeout=job_json.get('step_timeout'),
+                              finish=finish)
+
+            critical_path = graph.critical_path(
+                {step['name']: step['wall_time'] for step in steps if step['state'] != 'skipped'})
+
+            # If unsuccessful report the step that stopped the run
+            for step in steps:
+                if step['state'] in ('failed', 'timed_out'):
+                    return_code = step['return_code']
+                    status = step['state']
+                    raise SystemError('Build step {} {}'.format(
+                        step['name'], 'timed out' if status == 'timed_out' else 'failed'))
+
+            if control.reason in ('cancelled', 'timed_out'):
+                status = control.reason
+                return_code = next((step['return_code'] for step in steps if step['state'] == status), -1)
+                raise SystemError('Run cancelled' if status == 'cancelled' else 'Run timed out')
+
+        except (OSError, subprocess.CalledProcessError, SystemError, ValueError) as error:
             message = str(error)
             success = 0
         except KeyError:
             message = 'Job has no steps'
             success = 0
+        except Exception as error:  # A broken config or a bug must still free the slot and record the run
+            logger.exception('Run of %s failed unexpectedly', name)
+            message = 'Run failed: {}'.format(error)
+            success = 0
 
-        # Clean up tmp workdir
-        filesystem.dirty_rm_rf(tmp_cwd)
+        try:
+            if not success and status == "succeeded":
+                status = "failed"
+
+            if capture is not None:
+                capture.close()
+                captures.unregister(name, run_number)
+
+            if sampler is not None:
+                sampler.stop()
+                run_profile = profiling.breakdown(steps, sampler)
+
+            # Keep the files the job asked for before the workspace goes
+            if workspace is not None and build_dir is not None and artifact_globs:
+                try:
+                    kept = self.artifacts.collect(workspace.path, build_dir, artifact_globs)
+                except OSError as error:
+                    logger.warning('Could not keep the artifacts of %s #%s: %s', name, run_number, error)
+
+            # Clean up the workspace, cached ones are kept for the next run
+            if workspace is not None:
+                self.workspaces.release(workspace)
+
+            if build_dir is not None:
+                finished: float = time.time()
+
+                metrics.runs_finished.inc(name, status)
+                for step in steps:
+                    if step['state'] != 'skipped':
+                        metrics.step_duration.observe(step['wall_time'], name)
+                try:
+                    metrics.output_bytes.inc(name, amount=logs.size(build_dir + "/" + self.job_output_file))
+                except OSError:
+                    pass
+
+                if run_profile is not None:
+                    builds.write_profile(build_dir, run_profile)
+
+                try:
+                    self._finish_build(job_dir, job_config_json_file, build_dir, {
+                        "run_number": run_number,
+                        "run_id": run_id,
+                        "state": status,
+                        "trigger": trigger,
+                        "message": message,
+                        "return_code": return_code,
+                        "started": started,
+                        "finished": finished,
+                        "duration": finished - started,
+                        "steps": steps,
+                        "critical_path": critical_path,
+                        "usage": usage_totals(steps),
+                        "workspace": workspace.path if workspace is not None else None,
+                        "artifacts": len(kept),
+                    }, job_json, settings)
+                except Exception:  # The run still goes in the history
+                    logger.exception('Could not finish build %s #%s', name, run_number)
+
+                self.history.record({
+                    "run_id": run_id,
+                    "job": name,
+                    "run_number": run_number,
+                    "status": status,
+                    "trigger": trigger,
+                    "started": started,
+                    "finished": finished,
+                    "duration": finished - started,
+                    "exit_code": return_code,
+                    "message": message,
+                    **usage_totals(steps),
+                })
+        finally:
+            if marker is not None:
+                self._unmark_running(marker)
+
+            if slot is not None:
+                slot.release()
+
+        return {"success": success, "status": status, "message": message, "return_code": return_code,
+                "run_number": run_number, "build_dir": build_dir, "steps": steps,
+                "critical_path": critical_path, "usage": usage_totals(steps), "profile": run_profile,
+                "artifacts": kept}
+
+
+    def find_running(self, name: str, run_id: str) -> Optional[Dict[str, Any]]:
+        """ The build of job name that run run_id is running, in whichever viki process runs it
+        Returns a summary shaped like a queued run's, None if no such build is running
+        """
+        prefix: str = name + "."
+
+        try:
+            marker_names: List[str] = os.listdir(self.running_path)
+        except OSError:
+            return None
+
+        for marker_name in marker_names:
+            if not marker_name.startswith(prefix) or not marker_name[len(prefix):].isdigit():
+                continue
+
+            try:
+                with open(self.running_path + "/" + marker_name, 'r') as marker:
+                    if marker.read() != run_id:
+                        continue
+            except OSError:
+                continue
+
+            run_number: int = int(marker_name[len(prefix):])
+            meta = builds.read_meta(builds.build_path(self.jobs_path + "/" + name, run_number))
+
+            if meta is not None and meta.get("state") == "running":
+                return {"run_id": run_id, "name": name, "trigger": meta.get("trigger"), "state": "running",
+                        "run_number": run_number, "started_at": meta.get("started"), "finished_at": None,
+                        "result": None}
+
+        return None
+
+
+    def recover_interrupted_runs(self) -> List[Dict[str, Any]]:
+        """ Finish off builds left running by a viki process that died
+        Their leftover step processes are stopped, fresh workspaces removed and
+        the builds recorded as interrupted. Builds of live processes are left alone,
+        so this is safe to call from any viki process at any time
+        Returns a list of the recovered builds
+        """
+        recovered: List[Dict[str, Any]] = []
+
+        try:
+            marker_names: List[str] = os.listdir(self.running_path)
+        except OSError:
+            return recovered
+
+        for marker_name in marker_names:
+            # Markers are <job>.<run number>, the run queues keep their own state alongside
+            name, _, run_number = marker_name.rpartition(".")
+            if not name or not run_number.isdigit():
+                continue
+
+            # Still held means the build's process is alive
+            marker = FileLock(self.running_path + "/" + marker_name)
+            if not marker.acquire(blocking=False):
+                continue
 
-        return {"success": success, "message": message, "return_code": return_code}
+            try:
+                build = self._recover_build(name, int(run_number))
+            except OSError as error:
+                logger.warning('Could not recover %s #%s: %s', name, run_number, error)
+                build = None
+            finally:
+                self._unmark_running(marker)
+
+            if build is not None:
+                logger.warning('Recovered %s #%s, left running by a viki process that died', name, run_number)
+                recovered.append(build)
+
+        return recovered
 
 
     def delete_job(self, name: str) -> Dict[str, Any]:
@@ -344,6 +1101,11 @@ class Job:
 
             # Remove the job directory
             filesystem.dirty_rm_rf(job_dir)
+            self.registry.invalidate(name)
+
+            # Drop its cached steps and the artifacts only its builds kept
+            self.step_cache.forget(name)
+            self.artifacts.collect_garbage()
 
         except (OSError, ValueError) as error:
             message = str(error)
@@ -0,0 +1,198 @@
+# coding: utf-8
+
+"""
+limits.py
+~~~~~~~~~
+
+Step resource limit library - internal to Viki
+
+A job's "limits" block caps what each of its step processes may use:
+
+    "limits": {
+        "cpu_seconds": 600,
+        "memory_bytes": 4294967296,
+        "open_files": 1024,
+        "processes": 256,
+        "file_size": 1073741824,
+        "nice": 10,
+        "ionice": "idle",
+        "cgroup": {"memory.max": "4G", "cpu.max": "200000 100000", "pids.max": "512"}
+    }
+
+The step is wrapped with the prlimit, nice and ionice tools that set the
+rlimits, nice value and io class before it starts. Nothing runs in the
+child between fork and exec, which is not safe in a threaded daemon.
+If prlimit or nice is not installed, their limits are set on the step's
+pid right after it is spawned. Steps are placed in a cgroup v2 group of
+their own, written with the "cgroup" settings, when viki.json's
+cgroup_root points at a cgroup directory viki may write to. The step's
+pid is written to the group's cgroup.procs once it is spawned. Wall time
+is capped by the "timeout" settings instead.
+:license: Apache2, see LICENSE for more details
+"""
+
+import logging
+import os
+import resource
+import shutil
+import uuid
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+_rlimits: Dict[str, int] = {
+    "cpu_seconds": resource.RLIMIT_CPU,
+    "memory_bytes": resource.RLIMIT_AS,
+    "open_files": resource.RLIMIT_NOFILE,
+    "processes": resource.RLIMIT_NPROC,
+    "file_size": resource.RLIMIT_FSIZE,
+}
+
+# prlimit's option for each rlimit
+_prlimit_options: Dict[int, str] = {
+    resource.RLIMIT_CPU: "cpu",
+    resource.RLIMIT_AS: "as",
+    resource.RLIMIT_NOFILE: "nofile",
+    resource.RLIMIT_NPROC: "nproc",
+    resource.RLIMIT_FSIZE: "fsize",
+}
+
+_ionice_classes: Dict[str, str] = {"realtime": "1", "best-effort": "2", "idle": "3"}
+
+
+class Limits:
+    """ Resource limits for the steps of one job """
+
+    def __init__(self, config: Optional[Dict[str, Any]], cgroup_root: str = ''):
+        """ Parse a job's "limits" block
+        cgroup_root: Directory under which step cgroups are made, '' disables cgroups
+        Raises ValueError on an unknown limit or a bad value
+        """
+        config = config or {}
+
+        unknown = set(config) - set(_rlimits) - {"nice", "ionice", "cgroup"}
+        if unknown:
+            raise ValueError('Unknown limit(s): {}'.format(', '.join(sorted(unknown))))
+
+        self.rlimits: List[Tuple[int, int]] = [(_rlimits[name], int(value)) for name, value in config.items()
+                                               if name in _rlimits]
+        self.nice: int = int(config.get('nice', 0))
+        self.ionice: List[str] = self._ionice_args(config.get('ionice'))
+        self.cgroup: Dict[str, str] = {name: str(value) for name, value in (config.get('cgroup') or {}).items()}
+        self.cgroup_root: str = cgroup_root if self.cgroup else ''
+
+
+    # --- Limits internals
+
+
+    @staticmethod
+    def _ionice_args(value: Optional[str]) -> List[str]:
+        """ ionice "class" or "class:level" as ionice arguments """
+        if not value:
+            return []
+
+        io_class, _, level = str(value).partition(':')
+        if io_class not in _ionice_classes:
+            raise ValueError('Unknown ionice class {}'.format(io_class))
+
+        args = ['-c', _ionice_classes[io_class]]
+        if level:
+            args += ['-n', str(int(level))]
+
+        return args
+
+
+    def _make_cgroup(self, label: str) -> Optional[str]:
+        """ Create and configure a cgroup for one step, None if cgroups can't be used """
+        path = '{}/{}-{}'.format(self.cgroup_root, label, uuid.uuid4().hex[:8])
+
+        try:
+            os.makedirs(path)
+            for name, value in self.cgroup.items():
+                with open(path + '/' + name, 'w') as control_file:
+                    control_file.write(value)
+        except OSError as error:
+            logger.warning('Could not set up cgroup %s, running without it: %s', path, error)
+            remove_cgroup(path)
+            return None
+
+        return path
+
+
+    # --- Limits functions
+
+
+    def prepare(self, args: List[str], label: str) -> Tuple[List[str], Optional[Callable[[int], None]], Optional[str]]:
+        """ Get ready to spawn a limited step
+        label: Prefix of the step's cgroup name
+        Returns Tuple (args to spawn, function to call with the step's pid once it is spawned or None,
+        cgroup path or None)
+        The cgroup must be handed to remove_cgroup() once the step has exited
+        """
+        if self.ionice and shutil.which('ionice'):
+            args = ['ionice'] + self.ionice + args
+
+        # Without privileges a hard limit can only be lowered, steps inherit ours
+        rlimits: List[Tuple[int, int]] = []
+        for limit, value in self.rlimits:
+            _, hard = resource.getrlimit(limit)
+            rlimits.append((limit, min(value, hard) if hard != resource.RLIM_INFINITY else value))
+
+        if rlimits and shutil.which('prlimit'):
+            args = ['prlimit'] + ['--{}={}:{}'.format(_prlimit_options[limit], value, value)
+                                  for limit, value in rlimits] + ['--'] + args
+            rlimits = []
+
+        nice: int = self.nice
+        if nice and shutil.which('nice'):
+            args = ['nice', '-n', str(nice)] + args
+            nice = 0
+
+        cgroup: Optional[str] = self._make_cgroup(label) if self.cgroup_root else None
+
+        if not rlimits and not nice and cgroup is None:
+            return args, None, None
+
+        def apply(pid: int) -> None:
+            if cgroup is not None:
+                try:
+                    with open(cgroup + '/cgroup.procs', 'w') as procs:
+                        procs.write(str(pid))
+                except OSError as error:
+                    logger.warning('Could not move step process %d into cgroup %s: %s', pid, cgroup, error)
+
+            try:
+                for limit, value in rlimits:
+                    resource.prlimit(pid, limit, (value, value))
+                if nice:
+                    os.setpriority(os.PRIO_PROCESS, pid, os.getpriority(os.PRIO_PROCESS, pid) + nice)
+            except OSError as error:
+                logger.warning('Could not limit step process %d: %s', pid, error)
+
+        return args, apply, cgroup
+
+
+def remove_cgroup(path: Optional[str]) -> None:
+    """ Remove a step's cgroup, it must have no processes left """
+    if path is None:
+        return
+
+    try:
+        os.rmdir(path)
+    except OSError:
+        pass
+
+
+def usage_totals(steps: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """ Resources used by all of a run's steps together """
+    totals: Dict[str, Any] = {"user_time": 0.0, "system_time": 0.0, "max_rss": 0,
+                              "read_blocks": 0, "write_blocks": 0}
+
+    for step in steps:
+        totals["user_time"] += step.get("user_time") or 0.0
+        totals["system_time"] += step.get("system_time") or 0.0
+        totals["max_rss"] = max(totals["max_rss"], step.get("max_rss") or 0)
+        totals["read_blocks"] += step.get("read_blocks") or 0
+        totals["write_blocks"] += step.get("write_blocks") or 0
+
+    return totals
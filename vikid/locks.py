@@ -0,0 +1,96 @@
+# coding: utf-8
+
+"""
+locks.py
+~~~~~~~~
+
+Advisory file lock library - internal to Viki
+
+flock() based locks shared by every viki process on the host. The kernel
+drops them when the holder exits, so a crashed process never leaves a
+stale lock behind.
+:license: Apache2, see LICENSE for more details
+"""
+
+import fcntl
+import os
+import time
+from typing import Callable, Optional
+
+# How often a full set of slots is retried
+slot_interval = 0.2
+
+
+class FileLock:
+    """ Exclusive flock() on a lock file """
+
+    def __init__(self, path: str):
+        self.path: str = path
+        self._fd: Optional[int] = None
+
+
+    def acquire(self, blocking: bool = True) -> bool:
+        """ Take the lock
+        Returns False if blocking is off and someone else holds it
+        """
+        if self._fd is not None:
+            return True
+
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+
+        self._fd = fd
+
+        return True
+
+
+    def release(self) -> None:
+        """ Drop the lock if we hold it """
+        if self._fd is None:
+            return
+
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+        os.close(self._fd)
+        self._fd = None
+
+
+    def locked(self) -> bool:
+        """ True while this object holds the lock """
+        return self._fd is not None
+
+
+    def fileno(self) -> Optional[int]:
+        """ File descriptor of the held lock file, None when not held """
+        return self._fd
+
+
+    def __enter__(self) -> 'FileLock':
+        self.acquire()
+        return self
+
+
+    def __exit__(self, *args) -> None:
+        self.release()
+
+
+def acquire_slot(prefix: str, slots: int, stop: Optional[Callable[[], bool]] = None,
+                 interval: float = slot_interval) -> Optional[FileLock]:
+    """ Take one of `slots` locks, prefix.0 to prefix.<slots - 1>, so at most
+    that many holders run at once across every viki process
+    Blocks until a slot frees up, returns None if stop() turns True first
+    """
+    while True:
+        for number in range(max(1, slots)):
+            lock = FileLock("{}.{}".format(prefix, number))
+            if lock.acquire(blocking=False):
+                return lock
+
+        if stop is not None and stop():
+            return None
+
+        time.sleep(interval)
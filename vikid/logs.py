@@ -0,0 +1,333 @@
+# coding: utf-8
+
+"""
+logs.py
+~~~~~~~
+
+Build log library - internal to Viki
+
+Logs can be hundreds of megabytes so they are never read into memory
+whole: they are handed out in chunks, live logs are followed from an
+offset as they grow.
+
+Logs are stored compressed unless the job's log_compression level is 0.
+A compressed log is a series of gzip frames, each holding about a
+megabyte of output compressed on its own, in output.txt.gz. Together the
+frames form a valid gzip file, so zcat reads it as usual. Where each frame
+starts, both in the output and in the compressed file, is kept in
+output.txt.frames, so reading from an offset or the tail of a log only
+decompresses the frames that hold it. Frames are written as the steps
+produce output, a quiet step's output is sealed into a frame after
+frame_interval seconds so readers in other processes see it.
+:license: Apache2, see LICENSE for more details
+"""
+
+import bisect
+import os
+import struct
+import time
+import zlib
+from typing import Callable, Iterator, List, Optional, Tuple
+
+# Size of each chunk handed to the client
+chunk_size = 64 * 1024
+
+# How often a followed log is checked for new output
+follow_interval = 0.25
+
+# Output compressed into each frame, and the longest unsealed output is held back
+frame_size = 1024 * 1024
+frame_interval = 1.0
+
+compressed_suffix = ".gz"
+frames_suffix = ".frames"
+
+# Output offset, compressed offset, output length and compressed length of a frame
+_frame_entry = struct.Struct('<QQII')
+
+
+def compressed_file(log_file: str) -> str:
+    return log_file + compressed_suffix
+
+
+def frames_file(log_file: str) -> str:
+    return log_file + frames_suffix
+
+
+def exists(log_file: str) -> bool:
+    """ True if the log is there, plain or compressed """
+    return os.path.isfile(log_file) or os.path.isfile(compressed_file(log_file))
+
+
+def is_compressed(log_file: str) -> bool:
+    return not os.path.isfile(log_file) and os.path.isfile(compressed_file(log_file))
+
+
+class PlainWriter:
+    """ Appends to an uncompressed log """
+
+    def __init__(self, log_file: str):
+        self._file = open(log_file, 'ab')
+
+        # Output readers can already see
+        self.sealed: int = self._file.tell()
+
+
+    def write(self, data: bytes) -> None:
+        self._file.write(data)
+        self._file.flush()
+        self.sealed += len(data)
+
+
+    def seal_due(self) -> Optional[float]:
+        """ Seconds until held back output must be sealed, None when nothing is held back """
+        return None
+
+
+    def flush(self) -> None:
+        pass
+
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class FrameWriter:
+    """ Appends to a log as independently compressed gzip frames """
+
+    def __init__(self, log_file: str, level: int = 6):
+        self.level: int = level
+
+        self._data = open(compressed_file(log_file), 'ab')
+        self._frames = open(frames_file(log_file), 'ab')
+
+        # Carry on after the last whole frame of an existing log
+        self.sealed: int = 0
+        self._data_offset: int = self._data.tell()
+        frames_size = self._frames.tell()
+        if frames_size >= _frame_entry.size:
+            with open(frames_file(log_file), 'rb') as frames_obj:
+                frames_obj.seek(frames_size - frames_size % _frame_entry.size - _frame_entry.size)
+                offset, _, length, _ = _frame_entry.unpack(frames_obj.read(_frame_entry.size))
+                self.sealed = offset + length
+
+        self._pending: List[bytes] = []
+        self._pending_bytes: int = 0
+        self._pending_since: Optional[float] = None
+
+
+    def _seal(self) -> None:
+        """ Compress held back output into a frame and append it """
+        if not self._pending:
+            return
+
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+        frame = compressor.compress(b''.join(self._pending)) + compressor.flush()
+
+        # Frame data first, a reader only goes looking for frames the index lists
+        self._data.write(frame)
+        self._data.flush()
+        self._frames.write(_frame_entry.pack(self.sealed, self._data_offset, self._pending_bytes, len(frame)))
+        self._frames.flush()
+
+        self.sealed += self._pending_bytes
+        self._data_offset += len(frame)
+        self._pending, self._pending_bytes, self._pending_since = [], 0, None
+
+
+    def write(self, data: bytes) -> None:
+        if self._pending_since is None:
+            self._pending_since = time.monotonic()
+
+        self._pending.append(data)
+        self._pending_bytes += len(data)
+
+        if self._pending_bytes >= frame_size:
+            self._seal()
+
+
+    def seal_due(self) -> Optional[float]:
+        """ Seconds until held back output must be sealed, None when nothing is held back """
+        if self._pending_since is None:
+            return None
+
+        return max(0.0, self._pending_since + frame_interval - time.monotonic())
+
+
+    def flush(self) -> None:
+        """ Seal held back output once it has waited frame_interval """
+        if self._pending_since is not None and self.seal_due() == 0.0:
+            self._seal()
+
+
+    def close(self) -> None:
+        self._seal()
+        self._data.close()
+        self._frames.close()
+
+
+def open_writer(log_file: str, level: int = 6):
+    """ Writer appending to a log, compressed at zlib level 1-9 or plain for level 0 """
+    if level <= 0:
+        return PlainWriter(log_file)
+
+    return FrameWriter(log_file, min(int(level), 9))
+
+
+class LogReader:
+    """ Random access to a log's output, plain or compressed """
+
+    def __init__(self, log_file: str):
+        """ Raises OSError if the log does not exist """
+        self.compressed: bool = is_compressed(log_file)
+
+        self._offsets: List[int] = []
+        self._frames: List[Tuple[int, int, int, int]] = []
+        self._cache: Tuple[int, bytes] = (-1, b'')
+
+        if self.compressed:
+            self._file = open(compressed_file(log_file), 'rb')
+            self._index = open(frames_file(log_file), 'rb')
+        else:
+            self._file = open(log_file, 'rb')
+            self._index = None
+
+        self.refresh()
+
+
+    def refresh(self) -> None:
+        """ Pick up output written since the log was opened """
+        if self._index is None:
+            self.size = os.fstat(self._file.fileno()).st_size
+            return
+
+        while True:
+            entry = self._index.read(_frame_entry.size)
+            if len(entry) < _frame_entry.size:
+                # Leave a half written entry for the next refresh
+                self._index.seek(-len(entry), os.SEEK_CUR)
+                break
+
+            frame = _frame_entry.unpack(entry)
+            self._frames.append(frame)
+            self._offsets.append(frame[0])
+
+        self.size = self._frames[-1][0] + self._frames[-1][2] if self._frames else 0
+
+
+    def _frame(self, number: int) -> bytes:
+        """ The output of one frame, the last one used is kept decompressed """
+        if self._cache[0] != number:
+            _, data_offset, _, data_length = self._frames[number]
+            self._cache = (number, zlib.decompress(os.pread(self._file.fileno(), data_length, data_offset), 31))
+
+        return self._cache[1]
+
+
+    def read(self, offset: int, length: int) -> bytes:
+        """ Up to length bytes of output from offset """
+        end = min(offset + length, self.size)
+        if offset >= end:
+            return b''
+
+        if self._index is None:
+            return os.pread(self._file.fileno(), end - offset, offset)
+
+        parts: List[bytes] = []
+        number = bisect.bisect_right(self._offsets, offset) - 1
+
+        while offset < end:
+            start = self._frames[number][0]
+            data = self._frame(number)
+            parts.append(data[offset - start:end - start])
+            offset = start + len(data)
+            number += 1
+
+        return b''.join(parts)
+
+
+    def close(self) -> None:
+        self._file.close()
+        if self._index is not None:
+            self._index.close()
+
+
+    def __enter__(self) -> 'LogReader':
+        return self
+
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+# --- Main library
+
+def size(log_file: str) -> int:
+    """ Bytes of output in a log, however it is stored """
+    with LogReader(log_file) as reader:
+        return reader.size
+
+
+def tail_offset(log_file: str, lines: int) -> int:
+    """ Byte offset where the last `lines` lines of log_file begin
+    Searches backwards a chunk at a time so only the tail is read
+    """
+    with LogReader(log_file) as reader:
+        if lines <= 0 or reader.size == 0:
+            return reader.size
+
+        # A trailing newline ends the last line, it doesn't start a new one
+        end = reader.size - 1 if reader.read(reader.size - 1, 1) == b'\n' else reader.size
+
+        while end > 0:
+            start = max(0, end - chunk_size)
+            chunk = reader.read(start, end - start)
+            position = len(chunk)
+
+            while lines:
+                position = chunk.rfind(b'\n', 0, position)
+                if position < 0:
+                    break
+                lines -= 1
+
+            if not lines:
+                return start + position + 1
+
+            end = start
+
+        return 0
+
+
+def read_chunks(log_file: str, offset: int = 0, length: Optional[int] = None) -> Iterator[bytes]:
+    """ Yield log_file from offset in chunk_size pieces
+    Only one chunk at a time is read into Python
+    """
+    with LogReader(log_file) as reader:
+        end = reader.size if length is None else min(reader.size, offset + length)
+
+        for position in range(offset, end, chunk_size):
+            yield reader.read(position, min(chunk_size, end - position))
+
+
+def follow(log_file: str, offset: int, running: Callable[[], bool]) -> Iterator[bytes]:
+    """ Yield log_file from offset and keep yielding new output as it is written
+    Stops once running() returns False and everything written has been sent
+    """
+    finished = False
+
+    with LogReader(log_file) as reader:
+        while True:
+            chunk = reader.read(offset, chunk_size)
+            if chunk:
+                offset += len(chunk)
+                yield chunk
+                continue
+
+            if finished:
+                return
+
+            # Take one more pass after the run ends so its last write isn't missed
+            finished = not running()
+            if not finished:
+                time.sleep(follow_interval)
+            reader.refresh()
@@ -0,0 +1,246 @@
+# coding: utf-8
+
+"""
+metrics.py
+~~~~~~~~~~
+
+Metrics library - internal to Viki
+
+Counters and histograms served in the Prometheus text format on /metrics.
+Every thread updates its own shard of each metric, so recording a value
+never takes a lock and is cheap enough to leave on everywhere. Shards are
+only summed when the metrics are scraped. Each gunicorn worker keeps its
+own metrics.
+:license: Apache2, see LICENSE for more details
+"""
+
+import bisect
+import threading
+from typing import Any, Callable, Dict, List, Tuple
+
+# Seconds, from a fast api request up to a long build
+default_buckets: Tuple[float, ...] = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                                      1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0)
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = '') -> str:
+    pairs = ['{}="{}"'.format(name, _escape(str(value))) for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """ Shared bookkeeping of per thread shards """
+
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ()):
+        self.name: str = name
+        self.documentation: str = documentation
+        self.label_names: Tuple[str, ...] = labels
+
+        self._local = threading.local()
+        self._shards: List[Tuple[threading.Thread, Dict[Tuple[str, ...], Any]]] = []
+        self._shards_lock = threading.Lock()
+
+        # Shards of threads that have exited, folded together
+        self._retired: Dict[Tuple[str, ...], Any] = {}
+
+
+    def _shard(self) -> Dict[Tuple[str, ...], Any]:
+        """ This thread's shard, registered the first time the thread records a value """
+        shard = getattr(self._local, 'shard', None)
+
+        if shard is None:
+            shard = self._local.shard = {}
+            with self._shards_lock:
+                self._shards.append((threading.current_thread(), shard))
+
+        return shard
+
+
+    def _merge(self, into: Dict[Tuple[str, ...], Any], shard: Dict[Tuple[str, ...], Any]) -> None:
+        raise NotImplementedError
+
+
+    def _snapshot(self) -> List[Dict[Tuple[str, ...], Any]]:
+        """ Every shard, after folding those of exited threads into one
+        so short lived threads don't leave shards behind
+        """
+        with self._shards_lock:
+            live: List[Tuple[threading.Thread, Dict[Tuple[str, ...], Any]]] = []
+
+            for thread, shard in self._shards:
+                if thread.is_alive():
+                    live.append((thread, shard))
+                else:
+                    # The thread is gone, nothing writes to its shard any more
+                    self._merge(self._retired, shard)
+
+            self._shards = live
+
+            return [self._retired] + [shard for _, shard in live]
+
+
+class Counter(_Metric):
+    """ A count that only goes up """
+
+    kind = 'counter'
+
+    def _merge(self, into: Dict[Tuple[str, ...], Any], shard: Dict[Tuple[str, ...], Any]) -> None:
+        for labels, value in list(shard.items()):
+            into[labels] = into.get(labels, 0) + value
+
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        shard = self._shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+
+    def values(self) -> Dict[Tuple[str, ...], float]:
+        totals: Dict[Tuple[str, ...], float] = {}
+
+        for shard in self._snapshot():
+            self._merge(totals, shard)
+
+        return totals
+
+
+    def render(self) -> List[str]:
+        return ['{}{} {}'.format(self.name, _labels(self.label_names, labels), _number(value))
+                for labels, value in sorted(self.values().items())]
+
+
+class Histogram(_Metric):
+    """ Distribution of observed values over fixed buckets """
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = default_buckets):
+        super().__init__(name, documentation, labels)
+        self.buckets: Tuple[float, ...] = tuple(buckets)
+
+
+    def _merge(self, into: Dict[Tuple[str, ...], Any], shard: Dict[Tuple[str, ...], Any]) -> None:
+        for labels, counts in list(shard.items()):
+            total = into.setdefault(labels, [0] * (len(self.buckets) + 1) + [0.0, 0])
+            for index, count in enumerate(list(counts)):
+                total[index] += count
+
+
+    def observe(self, value: float, *labels: str) -> None:
+        shard = self._shard()
+        counts = shard.get(labels)
+
+        if counts is None:
+            # Per bucket counts, then the sum and count of observations
+            counts = shard[labels] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-2] += value
+        counts[-1] += 1
+
+
+    def values(self) -> Dict[Tuple[str, ...], List[Any]]:
+        totals: Dict[Tuple[str, ...], List[Any]] = {}
+
+        for shard in self._snapshot():
+            self._merge(totals, shard)
+
+        return totals
+
+
+    def render(self) -> List[str]:
+        lines: List[str] = []
+
+        for labels, counts in sorted(self.values().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(
+                    self.name, _labels(self.label_names, labels, 'le="{}"'.format(_number(bound))), cumulative))
+
+            lines.append('{}_sum{} {}'.format(self.name, _labels(self.label_names, labels), _number(counts[-2])))
+            lines.append('{}_count{} {}'.format(self.name, _labels(self.label_names, labels), counts[-1]))
+
+        return lines
+
+
+class Gauge:
+    """ A value read from a callback at scrape time """
+
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str, read: Callable[[], float]):
+        self.name: str = name
+        self.documentation: str = documentation
+        self.read = read
+
+
+    def render(self) -> List[str]:
+        return ['{} {}'.format(self.name, _number(self.read()))]
+
+
+class Registry:
+    """ Every metric served on /metrics """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics: Dict[str, Any] = {}
+
+
+    def register(self, metric: Any) -> Any:
+        """ Add a metric, replacing one of the same name """
+        with self._lock:
+            self._metrics[metric.name] = metric
+
+        return metric
+
+
+    def render(self) -> str:
+        """ All metrics in the Prometheus text exposition format """
+        with self._lock:
+            metrics = list(self._metrics.values())
+
+        lines: List[str] = []
+
+        for metric in metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.documentation))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            lines.extend(metric.render())
+
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+runs_started = registry.register(Counter(
+    'viki_runs_started_total', 'Runs that began executing', ('job',)))
+runs_finished = registry.register(Counter(
+    'viki_runs_finished_total', 'Runs that finished, by outcome', ('job', 'status')))
+step_duration = registry.register(Histogram(
+    'viki_step_duration_seconds', 'Wall time of step processes', ('job',)))
+queue_wait = registry.register(Histogram(
+    'viki_queue_wait_seconds', 'Time runs spent queued before a worker took them'))
+spawn_latency = registry.register(Histogram(
+    'viki_spawn_latency_seconds', 'Time taken to fork and exec a step process'))
+request_duration = registry.register(Histogram(
+    'viki_http_request_duration_seconds', 'Api request latency', ('route', 'method', 'status')))
+output_bytes = registry.register(Counter(
+    'viki_output_bytes_total', 'Bytes of step output written', ('job',)))
+step_cache = registry.register(Counter(
+    'viki_step_cache_total', 'Cacheable steps, by whether they were restored from the step cache', ('job', 'result')))
@@ -5,48 +5,82 @@ pid.py
 ~~~~~~
 
 ProcessId library - internal to Viki
+
+Only one viki daemon may serve a home directory at a time. The daemon
+holds an flock() on vikid.pid for as long as it runs and writes its pid
+into it, so a daemon that crashed never leaves a stale lock behind and
+a second one started next to a live one can say who is in the way.
 :license: Apache2, see LICENSE for more details
 """
 
 import os
-from vikid.application.app import App
+from typing import Optional
+
+from vikid import _conf
+from vikid.locks import FileLock
+
+pidfile_name = "vikid.pid"
+
 
-class Lock():
+class Lock:
     """ Lock/pid file library for viki """
 
 
-    def __init__(self):
+    def __init__(self, home: Optional[str] = None):
         """
         Initialize lockfile handler
+        home: Viki's home directory, defaults to ~/.viki
         """
+        self.pidfile_name: str = pidfile_name
+        self.pid_file_abs_path: str = "{home_dir}/{filename}".format(home_dir=home or _conf.home_dir,
+                                                                      filename=self.pidfile_name)
+        self.pid: int = os.getpid()
+        self._lock: FileLock = FileLock(self.pid_file_abs_path)
 
-        application = App()
 
-        self.pidfile_name = "vikid.pid"
-        self.pid_file_abs_path = "{home_dir}/{filename}".format(home_dir=application.home, filename=self.pidfile_name)
+    def acquire(self) -> bool:
+        """
+        Take the lock and write our pid into the PID file
+        Returns False if another process holds it
+        """
+        if not self._lock.acquire(blocking=False):
+            return False
+
+        # Written through the locked descriptor, nobody else can be writing
         self.pid = os.getpid()
+        fd = self._lock.fileno()
+        os.ftruncate(fd, 0)
+        os.pwrite(fd, str(self.pid).encode('ascii'), 0)
+
+        return True
 
 
-    def pid_file_exists(self):
+    def release(self) -> None:
         """
-        Check if a current Vikid PID file exists
+        Drop the lock, the PID file stays behind for the next daemon
         """
-        if os.path.exists(self.pid_file_abs_path):
-            return True
+        self._lock.release()
+
 
-        return False
+    def owner(self) -> Optional[int]:
+        """
+        Process id written in the PID file, None if there is none
+        """
+        try:
+            with open(self.pid_file_abs_path, 'r') as pid_file_obj:
+                return int(pid_file_obj.read().strip())
+        except (OSError, ValueError):
+            return None
 
 
-    def pid_file_create(self):
+    def pid_file_exists(self) -> bool:
         """
-        Create a new PID file
+        Check if a current Vikid PID file exists
         """
-        with open(self.pid_file_abs_path, mode='w') as pid_file_obj:
-            pid_file_obj.write(self.pid)
-            pid_file_obj.close()
+        return os.path.exists(self.pid_file_abs_path)
 
 
-    def pid_file_match(self):
+    def pid_file_match(self) -> int:
         """
         Checks the PID file to make sure the written process id
         matches the current process id.
@@ -58,11 +92,7 @@ class Lock():
         if not self.pid_file_exists():
             return 0
 
-        with open(self.pid_file_abs_path, 'r') as pid_file_obj:
-            process_id = pid_file_obj.read()
-            pid_file_obj.close()
-
-        if str(self.pid) == process_id:
+        if self.owner() == self.pid:
             return 1
-        else:
-            return -1
+
+        return -1
@@ -0,0 +1,144 @@
+# coding: utf-8
+
+"""
+profiling.py
+~~~~~~~~~~~~
+
+Step profiling library - internal to Viki
+
+Runs started with ?profile=1 are sampled while they execute. Every
+interval the sampler reads /proc once and notes what each process in each
+step's process group is doing: running on a CPU, waiting on disk or
+sleeping (waiting on the network, a child or a timer). Combined with the
+step's spawn latency, time spent waiting for a free step slot and its CPU
+accounting this gives a per step breakdown of where the time went.
+Sampling is only available where /proc is, elsewhere the breakdown is
+built from the timings alone.
+:license: Apache2, see LICENSE for more details
+"""
+
+import os
+import threading
+from typing import Any, Dict, List, Optional, Set
+
+proc_path = "/proc"
+
+# /proc/<pid>/stat states, everything else counts as other
+_states: Dict[str, str] = {"R": "running", "D": "disk_wait", "S": "sleeping"}
+
+
+def _read_groups(pgids: Set[int]) -> Dict[int, List[str]]:
+    """ The state of every process in the given process groups """
+    states: Dict[int, List[str]] = {}
+
+    try:
+        entries = os.listdir(proc_path)
+    except OSError:
+        return states
+
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+
+        try:
+            with open('{}/{}/stat'.format(proc_path, entry), 'rb') as stat_file:
+                stat = stat_file.read().decode('utf-8', 'replace')
+        except OSError:
+            continue
+
+        # The command name may hold spaces and parens, fields restart after the last ')'
+        fields = stat[stat.rfind(')') + 2:].split()
+        if len(fields) < 3:
+            continue
+
+        pgid = int(fields[2])
+        if pgid in pgids:
+            states.setdefault(pgid, []).append(fields[0])
+
+    return states
+
+
+class Sampler:
+    """ Samples the process groups of a run's steps on a background thread """
+
+    def __init__(self, interval: float = 0.05):
+        self.interval: float = interval
+
+        self._lock = threading.Lock()
+        self._groups: Dict[int, str] = {}
+        self._counts: Dict[str, Dict[str, int]] = {}
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+
+    def _loop(self) -> None:
+        while not self._stop.wait(self.interval):
+            with self._lock:
+                groups = dict(self._groups)
+
+            if not groups:
+                continue
+
+            for pgid, states in _read_groups(set(groups)).items():
+                with self._lock:
+                    counts = self._counts.setdefault(groups[pgid], {"samples": 0})
+                    for state in states:
+                        name = _states.get(state, "other")
+                        counts[name] = counts.get(name, 0) + 1
+                    counts["samples"] += 1
+
+
+    def watch(self, name: str, pgid: int) -> None:
+        """ Start sampling a step's process group """
+        with self._lock:
+            self._groups[pgid] = name
+
+            if self._thread is None and os.path.isdir(proc_path):
+                self._thread = threading.Thread(target=self._loop, name='viki-profiler', daemon=True)
+                self._thread.start()
+
+
+    def forget(self, pgid: int) -> None:
+        """ Stop sampling a step's process group """
+        with self._lock:
+            self._groups.pop(pgid, None)
+
+
+    def stop(self) -> None:
+        self._stop.set()
+
+
+    def samples(self, name: str) -> Dict[str, int]:
+        """ How often the step's processes were seen in each state """
+        with self._lock:
+            return dict(self._counts.get(name, {"samples": 0}))
+
+
+def breakdown(steps: List[Dict[str, Any]], sampler: Optional[Sampler] = None) -> List[Dict[str, Any]]:
+    """ Where each step's time went """
+    profile: List[Dict[str, Any]] = []
+
+    for step in steps:
+        if step.get("state") == "skipped":
+            continue
+
+        wall = step.get("wall_time") or 0.0
+        cpu = (step.get("user_time") or 0.0) + (step.get("system_time") or 0.0)
+
+        entry: Dict[str, Any] = {
+            "name": step["name"],
+            "slot_wait": step.get("slot_wait"),
+            "spawn": step.get("spawn_time"),
+            "wall": wall,
+            "user": step.get("user_time"),
+            "system": step.get("system_time"),
+            # Wall time not spent on a CPU by the step or its children
+            "off_cpu": max(0.0, wall - cpu),
+        }
+
+        if sampler is not None:
+            entry["samples"] = sampler.samples(step["name"])
+
+        profile.append(entry)
+
+    return profile
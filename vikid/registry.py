@@ -0,0 +1,210 @@
+# coding: utf-8
+
+"""
+registry.py
+~~~~~~~~~~~
+
+In-memory job registry - internal to Viki
+
+Keeps every job's parsed config in memory so listing and looking up jobs
+doesn't walk the jobs directory or re-read config files on each request.
+Entries are invalidated by mtime checks: one stat of the jobs directory
+tells us whether jobs were added or removed, one stat of a config file
+tells us whether that job changed. Writes made through viki invalidate
+their entry directly so they are seen even within one mtime tick.
+:license: Apache2, see LICENSE for more details
+"""
+
+import bisect
+import json
+import logging
+import os
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def file_stamp(path: str) -> Tuple[int, ...]:
+    """ State of a config file that changes with every write
+    Configs are replaced by rename, so a new inode means a new config
+    Raises OSError if the file is missing
+    """
+    stat = os.stat(path)
+
+    return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+
+def stamp_etag(stamp: Tuple[int, ...]) -> str:
+    return '-'.join('{:x}'.format(part) for part in stamp)
+
+
+def file_etag(path: str) -> str:
+    """ Entity tag of a config file as it is on disk now, the same one its registry entry gives """
+    return stamp_etag(file_stamp(path))
+
+
+class JobEntry:
+    """ A cached job config and the file state it was read from """
+
+    def __init__(self, stamp: Tuple[int, ...], text: str):
+        self.stamp: Tuple[int, ...] = stamp
+        self.text: str = text
+
+        try:
+            config = json.loads(text)
+        except ValueError:
+            config = None
+
+        self.config: Dict[str, Any] = config if isinstance(config, dict) else {}
+
+
+    def etag(self) -> str:
+        """ Entity tag for this version of the config """
+        return stamp_etag(self.stamp)
+
+
+class JobRegistry:
+    """ Cache of job configs keyed by job name """
+
+    def __init__(self, jobs_path: str, config_filename: str = 'config.json'):
+        self.jobs_path: str = jobs_path
+        self.config_filename: str = config_filename
+
+        self._lock = threading.RLock()
+        self._names: List[str] = []
+        self._entries: Dict[str, JobEntry] = {}
+        self._dir_stamp: Optional[Tuple[int, int]] = None
+        self._listeners: List[Callable[[str, Optional[Dict[str, Any]]], None]] = []
+
+
+    # --- Registry internals
+
+
+    def _config_file(self, name: str) -> str:
+        return self.jobs_path + "/" + name + "/" + self.config_filename
+
+
+    def _notify(self, name: str, config: Optional[Dict[str, Any]]) -> None:
+        """ Tell listeners a job changed, config is None once it is gone """
+        for listener in self._listeners:
+            try:
+                listener(name, config)
+            except Exception:  # The change happened all the same, the other listeners still hear of it
+                logger.exception('Job registry listener failed for %s', name)
+
+
+    def _refresh_names(self) -> None:
+        """ Rescan the jobs directory if entries were added or removed
+        Must be called with self._lock held
+        Raises OSError if the jobs directory is missing
+        """
+        # A directory's link count changes with its number of subdirectories
+        stat = os.stat(self.jobs_path)
+        stamp = (stat.st_mtime_ns, stat.st_nlink)
+        if stamp == self._dir_stamp:
+            return
+
+        with os.scandir(self.jobs_path) as entries:
+            names = sorted(entry.name for entry in entries if entry.is_dir())
+
+        for name in set(self._entries) - set(names):
+            del self._entries[name]
+            self._notify(name, None)
+
+        self._names = names
+        self._dir_stamp = stamp
+
+
+    def _load(self, name: str) -> Optional[JobEntry]:
+        """ Return the cached entry for name, re-reading the config if it changed
+        Must be called with self._lock held
+        """
+        try:
+            stamp = file_stamp(self._config_file(name))
+        except OSError:
+            if self._entries.pop(name, None) is not None:
+                self._notify(name, None)
+            return None
+
+        entry = self._entries.get(name)
+        if entry is not None and entry.stamp == stamp:
+            return entry
+
+        try:
+            with open(self._config_file(name), 'r') as file_obj:
+                entry = JobEntry(stamp, file_obj.read())
+        except OSError:
+            return None
+
+        self._entries[name] = entry
+        self._notify(name, entry.config)
+
+        return entry
+
+
+    # --- Registry functions
+
+
+    def load(self) -> None:
+        """ Read every job's config, called once at startup """
+        with self._lock:
+            self._refresh_names()
+            for name in self._names:
+                self._load(name)
+
+
+    def add_listener(self, listener: Callable[[str, Optional[Dict[str, Any]]], None]) -> None:
+        """ Call listener(name, config) whenever a job's config is (re)loaded
+        or listener(name, None) when a job disappears
+        """
+        with self._lock:
+            self._listeners.append(listener)
+
+
+    def names(self, prefix: str = '') -> List[str]:
+        """ Sorted names of every job, optionally only those starting with prefix """
+        with self._lock:
+            self._refresh_names()
+
+            if not prefix:
+                return list(self._names)
+
+            start = bisect.bisect_left(self._names, prefix)
+            end = start
+            while end < len(self._names) and self._names[end].startswith(prefix):
+                end += 1
+
+            return self._names[start:end]
+
+
+    def get(self, name: str) -> Optional[JobEntry]:
+        """ Return the entry for a job, or None if it does not exist """
+        if not name or '/' in name:
+            return None
+
+        with self._lock:
+            return self._load(name)
+
+
+    def invalidate(self, name: Optional[str] = None) -> None:
+        """ Force one job, or every job, to be re-read
+        A single job is reloaded straight away so listeners hear about the change
+        """
+        with self._lock:
+            self._dir_stamp = None
+            for entry_name, entry in self._entries.items():
+                if name is None or entry_name == name:
+                    entry.stamp = ()
+
+            if name is not None:
+                self._load(name)
+
+
+    def etag(self) -> str:
+        """ Entity tag for the list of jobs, it changes whenever jobs are added or removed
+        Built from the jobs directory's state so every worker process agrees on it
+        """
+        with self._lock:
+            self._refresh_names()
+            return '{:x}-{:x}'.format(*self._dir_stamp)
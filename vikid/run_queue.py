@@ -0,0 +1,683 @@
+# coding: utf-8
+
+"""
+run_queue.py
+~~~~~~~~~~~~
+
+Asynchronous run queue - internal to Viki
+
+Runs are accepted immediately and executed later on a bounded pool of
+worker threads. The pool size comes from "max_parallel_runs" in viki.json
+and each job may cap its own parallel runs with "concurrency" in its config,
+and its queued plus running runs with "max_pending".
+
+Both limits hold for the whole host rather than for each worker process:
+a run only starts once it holds one of the max_parallel_runs run slots
+under <state_path>/slots/, and a job's pending runs are counted across
+every process's published runs while holding <state_path>/admit/<job>.lock.
+
+The daemon runs several worker processes and a request about a run may
+land on any of them. Each queue publishes a summary of the runs it knows
+under <state_path>/queue/<pid>/ and holds <pid>.lock while it lives, so
+every process can answer for runs queued by the others, and the
+directories of processes that died are ignored and cleared away. A run
+is cancelled from another process by leaving a request in
+<state_path>/cancel/<run id>, the process that has the run picks it up.
+A run coalesced into one another process has queued leaves the new args
+and env in <state_path>/queue/<pid>/<run id>.coalesced, which that
+process takes over as the run starts.
+:license: Apache2, see LICENSE for more details
+"""
+
+import collections
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+from contextlib import nullcontext
+from typing import Any, Callable, ContextManager, Deque, Dict, List, Optional, Tuple
+
+from vikid import metrics
+from vikid.application import app
+from vikid.locks import FileLock, acquire_slot
+from vikid.steps import RunControl
+
+logger = logging.getLogger(__name__)
+
+# Under state_path, each process publishes its runs in queue/<pid>/
+queue_dirname = "queue"
+
+# Under state_path, cancel/<run id> asks the process that has the run to cancel it
+cancel_dirname = "cancel"
+
+# Under state_path, slots/run.<n> are the host's max_parallel_runs run slots
+slots_dirname = "slots"
+
+# Under state_path, admit/<job>.lock is held while a run of the job is admitted
+admit_dirname = "admit"
+
+# How often a queue looks for cancel requests
+cancel_poll_interval = 0.25
+
+# Seconds before a cancel request nobody picked up is cleared away
+cancel_request_max_age = 3600
+
+
+def _process_alive(queue_path: str, pid: str) -> bool:
+    """ True while the process that published queue_path/<pid>/ holds its lock """
+    lock = FileLock("{}/{}.lock".format(queue_path, pid))
+
+    if lock.acquire(blocking=False):
+        lock.release()
+        return False
+
+    return True
+
+
+def _read_coalesced(path: str) -> Dict[str, Any]:
+    """ Args, env and count of the runs folded into a queued run, {} if there are none """
+    try:
+        with open(path, 'r') as file_obj:
+            return json.loads(file_obj.read())
+    except (OSError, ValueError):
+        return {}
+
+
+def request_cancel(state_path: str, run_id: str) -> None:
+    """ Ask whichever viki process has run_id to cancel it """
+    cancel_path = state_path + "/" + cancel_dirname
+    os.makedirs(cancel_path, exist_ok=True)
+
+    with open(cancel_path + "/" + run_id, 'w'):
+        pass
+
+
+def run_args(value: Any) -> Optional[List[str]]:
+    """ Check the args a run is asked for with, numbers are passed on as strings
+    Raises ValueError unless value is None or a list of strings or numbers
+    """
+    if value is None:
+        return None
+
+    if not isinstance(value, list) or not all(
+            isinstance(arg, (str, int, float)) and not isinstance(arg, bool) for arg in value):
+        raise ValueError('args must be a list of strings or numbers')
+
+    return [str(arg) for arg in value]
+
+
+def take_cancel_request(state_path: str, run_id: str) -> bool:
+    """ Remove the request to cancel run_id, returns True if there was one """
+    try:
+        os.remove("{}/{}/{}".format(state_path, cancel_dirname, run_id))
+    except OSError:
+        return False
+
+    return True
+
+
+class QueueFull(Exception):
+    """ A job already has as many queued and running runs as it allows """
+
+
+class Run:
+    """ A single request to run a job """
+
+    def __init__(self, job_name: str, job_args: Optional[List[str]] = None,
+                 trigger: str = 'api', concurrency: int = 1, env: Optional[Dict[str, str]] = None,
+                 pipeline_id: Optional[str] = None, depth: int = 0, join_group: Optional[str] = None,
+                 profile: bool = False):
+        self.id: str = uuid.uuid4().hex
+        self.job_name: str = job_name
+        self.job_args: Optional[List[str]] = job_args
+        self.trigger: str = trigger
+        self.concurrency: int = concurrency
+
+        # Extra environment for the run's steps
+        self.env: Optional[Dict[str, str]] = env
+
+        # Runs started by other runs share the pipeline id of the run that began the chain
+        self.pipeline_id: str = pipeline_id or self.id
+        self.depth: int = depth
+        self.join_group: Optional[str] = join_group
+
+        # Sample the run's steps and keep a timing breakdown
+        self.profile: bool = profile
+
+        # Later triggers folded into this run while it was still queued
+        self.coalesced: int = 0
+
+        # Stops the run's steps when it is cancelled
+        self.control: RunControl = RunControl()
+
+        # One of queued, running, succeeded, failed, timed_out, cancelled
+        self.state: str = 'queued'
+        self.queued_at: float = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.result: Optional[Dict[str, Any]] = None
+
+
+    def to_dict(self) -> Dict[str, Any]:
+        """ Return a json friendly summary of this run """
+        return {
+            "run_id": self.id,
+            "name": self.job_name,
+            "args": self.job_args,
+            "trigger": self.trigger,
+            "pipeline_id": self.pipeline_id,
+            "coalesced": self.coalesced,
+            "state": self.state,
+            "queued_at": self.queued_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "result": self.result,
+        }
+
+
+class RunQueue:
+    """ Queue of pending runs and the worker pool that executes them """
+
+    # How many finished runs are remembered for status lookups
+    history_size = 1000
+
+    def __init__(self, job: Any, workers: Optional[int] = None, state_path: Optional[str] = None):
+        """ Initialize the run queue
+        job: The Job instance used to execute runs
+        workers: Size of the worker pool, defaults to max_parallel_runs
+        state_path: Directory shared with the other viki processes to publish runs in,
+                    None keeps runs known to this process only
+        """
+        self.job = job
+        self.workers: int = int(workers or app.get_setting('max_parallel_runs'))
+        self.state_path: Optional[str] = state_path
+
+        self._cond = threading.Condition()
+        self._queued: Deque[Run] = collections.deque()
+        self._running: Dict[str, int] = collections.defaultdict(int)
+        self._runs: 'collections.OrderedDict[str, Run]' = collections.OrderedDict()
+        self._threads: List[threading.Thread] = []
+        self._listeners: List[Callable[[Run], None]] = []
+
+        # This process's directory under state_path/queue and the lock that says it is alive
+        self._state_dir: Optional[str] = None
+        self._state_lock: Optional[FileLock] = None
+
+        # Metrics
+        self._completed: int = 0
+        self._wait_total: float = 0.0
+        self._wait_max: float = 0.0
+        self._wait_last: float = 0.0
+
+
+    # --- Queue internals
+
+
+    def _claim_state_dir(self) -> None:
+        """ Take this process's directory under state_path/queue and clear away those of dead processes
+        Must be called with self._cond held
+        """
+        queue_path = self.state_path + "/" + queue_dirname
+        os.makedirs(queue_path, exist_ok=True)
+
+        pid = str(os.getpid())
+        lock = FileLock("{}/{}.lock".format(queue_path, pid))
+        lock.acquire()
+
+        for entry in os.listdir(queue_path):
+            if entry.endswith('.lock') or entry == pid or _process_alive(queue_path, entry):
+                continue
+
+            shutil.rmtree(queue_path + "/" + entry, ignore_errors=True)
+            try:
+                os.remove("{}/{}.lock".format(queue_path, entry))
+            except OSError:
+                pass
+
+        # Left behind by a dead process that had our pid
+        self._state_dir = queue_path + "/" + pid
+        shutil.rmtree(self._state_dir, ignore_errors=True)
+        os.makedirs(self._state_dir)
+        self._state_lock = lock
+
+        for dirname in (slots_dirname, admit_dirname):
+            os.makedirs(self.state_path + "/" + dirname, exist_ok=True)
+
+        # Requests for runs that were gone before anyone could cancel them
+        cancel_path = self.state_path + "/" + cancel_dirname
+        try:
+            requests = os.listdir(cancel_path)
+        except OSError:
+            requests = []
+
+        for run_id in requests:
+            try:
+                if os.stat(cancel_path + "/" + run_id).st_mtime < time.time() - cancel_request_max_age:
+                    os.remove(cancel_path + "/" + run_id)
+            except OSError:
+                pass
+
+
+    def _watch_cancels(self) -> None:
+        """ Cancel this process's runs that other processes asked to cancel """
+        cancel_path = self.state_path + "/" + cancel_dirname
+
+        while True:
+            time.sleep(cancel_poll_interval)
+
+            try:
+                requests = os.listdir(cancel_path)
+            except OSError:
+                continue
+
+            for run_id in requests:
+                with self._cond:
+                    run = self._runs.get(run_id)
+
+                if run is not None and take_cancel_request(self.state_path, run_id):
+                    self.cancel(run_id)
+
+
+    def _publish(self, run: Run) -> None:
+        """ Write run's summary where the other viki processes find it
+        Must be called with self._cond held, so a run's summaries are written in order
+        """
+        if self._state_dir is None:
+            return
+
+        path = self._state_dir + "/" + run.id
+
+        try:
+            with open(path + ".tmp", 'w') as file_obj:
+                file_obj.write(json.dumps(run.to_dict()))
+            os.replace(path + ".tmp", path)
+        except (OSError, TypeError, ValueError) as error:
+            logger.warning('Could not publish run %s of %s: %s', run.id, run.job_name, error)
+
+
+    def _unpublish(self, run: Run) -> None:
+        """ Remove run's summary once this process forgets it """
+        if self._state_dir is None:
+            return
+
+        for path in (self._state_dir + "/" + run.id, self._state_dir + "/" + run.id + ".coalesced"):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+    def _published_runs(self) -> List[Tuple[str, Dict[str, Any]]]:
+        """ Runs the other live viki processes published
+        Returns List of Tuple (the process's directory, the run's summary as Run.to_dict())
+        """
+        if self._state_dir is None:
+            return []
+
+        queue_path = self.state_path + "/" + queue_dirname
+        summaries: List[Tuple[str, Dict[str, Any]]] = []
+
+        for entry in os.listdir(queue_path):
+            if entry.endswith('.lock') or entry == os.path.basename(self._state_dir):
+                continue
+
+            try:
+                run_ids = os.listdir(queue_path + "/" + entry)
+            except OSError:
+                continue
+
+            if not _process_alive(queue_path, entry):
+                continue
+
+            for run_id in run_ids:
+                if run_id.endswith(('.tmp', '.coalesced')):
+                    continue
+
+                try:
+                    with open("{}/{}/{}".format(queue_path, entry, run_id), 'r') as file_obj:
+                        summaries.append((queue_path + "/" + entry, json.loads(file_obj.read())))
+                except (OSError, ValueError):
+                    continue
+
+        return summaries
+
+
+    def _admitting(self, job_name: str) -> ContextManager[Any]:
+        """ Lock held while a run of job_name is admitted, so processes don't both
+        take the last of a job's pending runs. Must be called with self._cond held
+        """
+        if self._state_dir is None:
+            return nullcontext()
+
+        return FileLock("{}/{}/{}.lock".format(self.state_path, admit_dirname, job_name))
+
+
+    def _coalesce_elsewhere(self, run: Run) -> Optional[Run]:
+        """ Fold run into a run of the same job and trigger another process still has queued
+        Must be called holding the job's admission lock
+        Returns run standing in for the other process's run, None if there is none to fold into
+        """
+        for state_dir, summary in self._published_runs():
+            if summary.get("name") != run.job_name or summary.get("trigger") != run.trigger \
+                    or summary.get("state") != 'queued':
+                continue
+
+            path = "{}/{}.coalesced".format(state_dir, summary["run_id"])
+            coalesced = _read_coalesced(path)
+
+            try:
+                with open(path + ".tmp", 'w') as file_obj:
+                    file_obj.write(json.dumps({"args": run.job_args, "env": run.env,
+                                               "coalesced": coalesced.get("coalesced", 0) + 1}))
+                os.replace(path + ".tmp", path)
+            except OSError as error:
+                logger.warning('Could not fold a run of %s into run %s: %s', run.job_name, summary["run_id"], error)
+                continue
+
+            run.id = summary["run_id"]
+            run.pipeline_id = summary["pipeline_id"]
+            run.queued_at = summary["queued_at"]
+            run.coalesced = summary["coalesced"] + coalesced.get("coalesced", 0) + 1
+            return run
+
+        return None
+
+
+    def _take_coalesced(self, run: Run) -> None:
+        """ Take over the args and env other processes folded into run
+        Must be called with self._cond and the job's admission lock held
+        """
+        if self._state_dir is None:
+            return
+
+        path = "{}/{}.coalesced".format(self._state_dir, run.id)
+        coalesced = _read_coalesced(path)
+
+        if coalesced:
+            run.job_args = coalesced["args"]
+            run.env = coalesced["env"]
+            run.coalesced += coalesced["coalesced"]
+
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+    def _acquire_host_slot(self, run: Run) -> Optional[FileLock]:
+        """ Wait for one of the host's run slots, shared with the other viki processes
+        Returns the held slot, None if the run was cancelled while it waited
+        """
+        return acquire_slot("{}/{}/run".format(self.state_path, slots_dirname), self.workers,
+                            stop=lambda: run.control.reason is not None)
+
+
+    def _start_workers(self) -> None:
+        """ Start the worker pool, must be called with self._cond held """
+        if self._threads:
+            return
+
+        if self.state_path is not None:
+            try:
+                self._claim_state_dir()
+            except OSError as error:
+                logger.warning('Runs of process %d are not visible to other processes: %s', os.getpid(), error)
+            else:
+                thread = threading.Thread(target=self._watch_cancels, name='viki-cancel-watch', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+        for number in range(self.workers):
+            thread = threading.Thread(target=self._worker, name='viki-worker-{}'.format(number), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+
+    def _job_limits(self, job_name: str) -> Tuple[int, int]:
+        """ Read the per job concurrency and pending run limits from the job's config
+        Returns Tuple (concurrency, max pending or 0 for unlimited)
+        """
+        config = self.job.get_job_config(job_name)
+
+        if config is None:
+            raise ValueError('Job {} not found'.format(job_name))
+
+        return (max(1, int(config.get('concurrency', app.get_setting('job_concurrency')))),
+                max(0, int(config.get('max_pending', app.get_setting('job_max_pending')))))
+
+
+    def _next_run(self) -> Run:
+        """ Block until a queued run may start without breaking its job's limit
+        Must be called with self._cond held
+        """
+        while True:
+            for run in self._queued:
+                if self._running[run.job_name] < run.concurrency:
+                    self._queued.remove(run)
+                    return run
+
+            self._cond.wait()
+
+
+    def _forget_old_runs(self) -> None:
+        """ Drop the oldest finished runs once we remember too many """
+        while len(self._runs) > self.history_size:
+            oldest = next(iter(self._runs.values()))
+            if oldest.finished_at is None:
+                break
+            self._runs.popitem(last=False)
+            self._unpublish(oldest)
+
+
+    def _notify(self, run: Run) -> None:
+        """ Hand a finished run to every listener, must be called without self._cond held """
+        with self._cond:
+            listeners = list(self._listeners)
+
+        for listener in listeners:
+            try:
+                listener(run)
+            except Exception:  # A broken listener must not take the caller down
+                logger.exception('Run listener failed for run %s of %s', run.id, run.job_name)
+
+
+    def _worker(self) -> None:
+        """ Worker thread main loop """
+        while True:
+            with self._cond:
+                run = self._next_run()
+
+                # Other processes only fold runs into this one while it is published as queued
+                with self._admitting(run.job_name):
+                    self._take_coalesced(run)
+                    run.state = 'running'
+                    run.started_at = time.time()
+                    self._running[run.job_name] += 1
+
+                    wait = run.started_at - run.queued_at
+                    self._wait_last = wait
+                    self._wait_total += wait
+                    self._wait_max = max(self._wait_max, wait)
+                    self._publish(run)
+
+            metrics.queue_wait.observe(wait)
+
+            # Without a state directory this queue is on its own and its pool is the only limit
+            shared = self._state_dir is not None
+            slot = self._acquire_host_slot(run) if shared else None
+
+            try:
+                if shared and slot is None:
+                    result = {"success": 0, "status": "cancelled", "message": "Run cancelled", "return_code": -1}
+                else:
+                    result = self.job.run_job(run.job_name, run.job_args, trigger=run.trigger, run_id=run.id,
+                                              env=run.env, control=run.control, profile=run.profile)
+            except Exception as error:  # Keep the worker alive no matter what the run does
+                result = {"success": 0, "message": str(error), "return_code": -1}
+            finally:
+                if slot is not None:
+                    slot.release()
+
+            with self._cond:
+                run.result = result
+                run.state = result.get("status") or ('succeeded' if result.get("success") else 'failed')
+                run.finished_at = time.time()
+                self._running[run.job_name] -= 1
+                self._completed += 1
+                self._publish(run)
+                self._forget_old_runs()
+                self._cond.notify_all()
+
+            # A cancel asked for too late to matter
+            if self.state_path is not None:
+                take_cancel_request(self.state_path, run.id)
+
+            self._notify(run)
+
+
+    # --- Queue functions
+
+
+    def add_listener(self, listener: Callable[[Run], None]) -> None:
+        """ Call listener(run) as soon as each run finishes, on the worker thread
+        or, for a run cancelled while it was queued, on the thread cancelling it
+        """
+        with self._cond:
+            self._listeners.append(listener)
+
+
+    def submit(self, job_name: str, job_args: Optional[List[str]] = None, trigger: str = 'api',
+               coalesce: bool = False, **run_options: Any) -> Run:
+        """ Queue a run of job_name and return immediately
+        coalesce: If a run of the job from the same trigger is still queued, give it
+                  these args and env instead of queueing another run, and return it.
+                  A run another process has queued is returned as a Run standing in for it
+        run_options are handed to Run: env, pipeline_id, depth, join_group, profile
+        Raises ValueError if the job does not exist
+        Raises QueueFull if the job is at its max_pending limit
+        """
+        concurrency, max_pending = self._job_limits(job_name)
+        run = Run(job_name, job_args, trigger=trigger, concurrency=concurrency, **run_options)
+
+        with self._cond:
+            self._start_workers()
+
+            with self._admitting(job_name):
+                if coalesce:
+                    for queued in self._queued:
+                        if queued.job_name == job_name and queued.trigger == trigger:
+                            self._take_coalesced(queued)
+                            queued.job_args = run.job_args
+                            queued.env = run.env
+                            queued.coalesced += 1
+                            self._publish(queued)
+                            return queued
+
+                    elsewhere = self._coalesce_elsewhere(run)
+                    if elsewhere is not None:
+                        return elsewhere
+
+                if max_pending and self.pending(job_name) >= max_pending:
+                    raise QueueFull('Job {} already has {} pending runs'.format(job_name, max_pending))
+
+                self._queued.append(run)
+                self._runs[run.id] = run
+                self._publish(run)
+                self._cond.notify_all()
+
+        return run
+
+
+    def pending(self, job_name: str) -> int:
+        """ Queued plus running runs of job_name, in this and every other live viki process """
+        elsewhere = sum(1 for _, summary in self._published_runs()
+                        if summary.get("name") == job_name and summary.get("state") in ('queued', 'running'))
+
+        with self._cond:
+            return elsewhere + self._running[job_name] + sum(1 for run in self._queued if run.job_name == job_name)
+
+
+    def cancel(self, run_id: str) -> Optional[Run]:
+        """ Cancel a queued or running run
+        A queued run is dropped and the listeners are told it was cancelled,
+        a running one has its steps killed and finishes as cancelled shortly after
+        Returns the run, or None if it isn't known
+        """
+        with self._cond:
+            run = self._runs.get(run_id)
+            if run is None:
+                return None
+
+            dropped = run.state == 'queued'
+            if dropped:
+                self._queued.remove(run)
+                run.state = 'cancelled'
+                run.finished_at = time.time()
+                run.control.stop('cancelled')
+                self._publish(run)
+                self._cond.notify_all()
+
+        if dropped:
+            self._notify(run)
+        elif run.state == 'running':
+            run.control.stop('cancelled')
+
+        return run
+
+
+    def get(self, run_id: str) -> Optional[Run]:
+        """ Look up a queued, running or recently finished run by id """
+        with self._cond:
+            return self._runs.get(run_id)
+
+
+    def find(self, run_id: str) -> Optional[Dict[str, Any]]:
+        """ Summary of a run known to this or another live viki process, as Run.to_dict()
+        Returns None if no live process knows it
+        """
+        run = self.get(run_id)
+        if run is not None:
+            return run.to_dict()
+
+        if self.state_path is None:
+            return None
+
+        queue_path = self.state_path + "/" + queue_dirname
+
+        try:
+            entries = os.listdir(queue_path)
+        except OSError:
+            return None
+
+        for entry in entries:
+            if entry.endswith('.lock'):
+                continue
+
+            try:
+                with open("{}/{}/{}".format(queue_path, entry, run_id), 'r') as file_obj:
+                    summary = json.loads(file_obj.read())
+            except (OSError, ValueError):
+                continue
+
+            if _process_alive(queue_path, entry):
+                return summary
+
+        return None
+
+
+    def metrics(self) -> Dict[str, Any]:
+        """ Queue depth and latency numbers """
+        with self._cond:
+            started = self._completed + sum(self._running.values())
+            return {
+                "workers": self.workers,
+                "queued": len(self._queued),
+                "running": sum(self._running.values()),
+                "completed": self._completed,
+                "wait_last": self._wait_last,
+                "wait_max": self._wait_max,
+                "wait_average": self._wait_total / started if started else 0.0,
+            }
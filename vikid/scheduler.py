@@ -0,0 +1,436 @@
+# coding: utf-8
+
+"""
+scheduler.py
+~~~~~~~~~~~~
+
+Cron scheduler - internal to Viki
+
+Honours "trigger": {"cron": "..."} in job configs. Every cron trigger sits
+in a min-heap keyed by its next fire time and a single thread sleeps until
+the earliest deadline, so there is no per-second tick no matter how many
+triggers exist. When a job's config changes only that job's entry is
+recomputed; superseded heap entries are dropped lazily when they surface.
+
+Trigger options:
+    cron     Five field cron expression or @hourly, @daily, ...
+    jitter   Fire up to this many seconds late to spread out jobs sharing a schedule
+    catchup  What to do with fires missed by more than the misfire grace:
+             "skip" them, run "once" for all of them, or run "all" of them
+:license: Apache2, see LICENSE for more details
+"""
+
+import datetime
+import heapq
+import logging
+import random
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Most missed fires replayed for a single job with "catchup": "all"
+max_catchup = 100
+
+_aliases = {
+    '@yearly': '0 0 1 1 *',
+    '@annually': '0 0 1 1 *',
+    '@monthly': '0 0 1 * *',
+    '@weekly': '0 0 * * 0',
+    '@daily': '0 0 * * *',
+    '@midnight': '0 0 * * *',
+    '@hourly': '0 * * * *',
+}
+
+_month_names = {name: number + 1 for number, name in enumerate(
+    ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec'])}
+
+_weekday_names = {name: number for number, name in enumerate(
+    ['sun', 'mon', 'tue', 'wed', 'thu', 'fri', 'sat'])}
+
+# (low, high, names) for minute, hour, day of month, month, day of week
+_fields = [
+    (0, 59, {}),
+    (0, 23, {}),
+    (1, 31, {}),
+    (1, 12, _month_names),
+    (0, 7, _weekday_names),
+]
+
+
+def _parse_field(text: str, low: int, high: int, names: Dict[str, int]) -> Set[int]:
+    """ Parse one cron field into the set of values it matches
+    Raises ValueError on anything malformed or out of range
+    """
+
+    def value(part: str) -> int:
+        return names[part.lower()] if part.lower() in names else int(part)
+
+    values: Set[int] = set()
+
+    for part in text.split(','):
+        step = 1
+        stepped = '/' in part
+        if stepped:
+            part, step_text = part.split('/', 1)
+            step = int(step_text)
+            if step < 1:
+                raise ValueError('Bad step in cron field {}'.format(text))
+
+        if part == '*':
+            start, end = low, high
+        elif '-' in part:
+            start_text, end_text = part.split('-', 1)
+            start, end = value(start_text), value(end_text)
+        else:
+            start = value(part)
+            end = high if stepped else start
+
+        if start < low or end > high or start > end:
+            raise ValueError('Cron field {} out of range'.format(text))
+
+        values.update(range(start, end + 1, step))
+
+    return values
+
+
+class CronExpression:
+    """ A parsed five field cron expression """
+
+    def __init__(self, expression: str):
+        self.expression: str = expression
+        fields = _aliases.get(expression.strip(), expression).split()
+
+        if len(fields) != 5:
+            raise ValueError('Cron expression needs 5 fields: {}'.format(expression))
+
+        parsed = [_parse_field(text, low, high, names) for text, (low, high, names) in zip(fields, _fields)]
+
+        self.minutes: List[int] = sorted(parsed[0])
+        self.hours: Set[int] = parsed[1]
+        self.days: Set[int] = parsed[2]
+        self.months: Set[int] = parsed[3]
+        # Both 0 and 7 mean Sunday
+        self.weekdays: Set[int] = {day % 7 for day in parsed[4]}
+
+        # Classic cron: if both day fields are restricted a day matching either one fires
+        self._days_restricted: bool = fields[2] != '*'
+        self._weekdays_restricted: bool = fields[4] != '*'
+
+
+    def _day_matches(self, moment: datetime.datetime) -> bool:
+        day_ok = moment.day in self.days
+        weekday_ok = (moment.weekday() + 1) % 7 in self.weekdays
+
+        if self._days_restricted and self._weekdays_restricted:
+            return day_ok or weekday_ok
+
+        return day_ok and weekday_ok
+
+
+    def next_after(self, timestamp: float) -> float:
+        """ First fire time strictly after timestamp, in local time
+        Raises ValueError for expressions that can never fire (e.g. 30 February)
+        """
+        moment = datetime.datetime.fromtimestamp(timestamp).replace(second=0, microsecond=0)
+        moment += datetime.timedelta(minutes=1)
+        last_year = moment.year + 5
+
+        while moment.year <= last_year:
+            if moment.month not in self.months:
+                moment = (moment.replace(day=1, hour=0, minute=0) + datetime.timedelta(days=32)).replace(day=1)
+                continue
+
+            if not self._day_matches(moment):
+                moment = moment.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+                continue
+
+            if moment.hour not in self.hours:
+                moment = moment.replace(minute=0) + datetime.timedelta(hours=1)
+                continue
+
+            later = [minute for minute in self.minutes if minute >= moment.minute]
+            if not later:
+                moment = moment.replace(minute=0) + datetime.timedelta(hours=1)
+                continue
+
+            return time.mktime(moment.replace(minute=later[0]).timetuple())
+
+        raise ValueError('Cron expression never fires: {}'.format(self.expression))
+
+
+# What a trigger may do with the fires it missed
+catchup_modes = ('skip', 'once', 'all')
+
+
+def trigger_options(config: Any) -> Dict[str, Any]:
+    """ Check a job's "trigger" block
+    Raises ValueError unless it is an object with a cron expression that fires,
+    a jitter of zero or more seconds and a known catchup mode. Returns {} if the job has none
+    """
+    if config is None:
+        return {}
+
+    if not isinstance(config, dict):
+        raise ValueError('trigger must be an object')
+
+    expression = config.get('cron')
+    if expression is not None:
+        if not isinstance(expression, str):
+            raise ValueError('trigger cron must be a string')
+        CronExpression(expression).next_after(time.time())
+
+    jitter = config.get('jitter', 0)
+    if isinstance(jitter, bool) or not isinstance(jitter, (int, float)) or jitter < 0:
+        raise ValueError('trigger jitter must be a number of zero or more')
+
+    if config.get('catchup', 'once') not in catchup_modes:
+        raise ValueError('trigger catchup must be one of {}'.format(', '.join(catchup_modes)))
+
+    return config
+
+
+class _Entry:
+    """ Scheduling state of one job's cron trigger """
+
+    def __init__(self, name: str, spec: Tuple[Any, ...], cron: CronExpression,
+                 jitter: float, catchup: str, generation: int):
+        self.name: str = name
+        self.spec: Tuple[Any, ...] = spec
+        self.cron: CronExpression = cron
+        self.jitter: float = jitter
+        self.catchup: str = catchup
+        self.generation: int = generation
+
+        # Nominal fire time and the jittered moment we actually wake for it
+        self.scheduled: float = 0.0
+        self.deadline: float = 0.0
+
+
+class Scheduler:
+    """ Fires cron triggers, sleeping until the earliest one is due """
+
+    def __init__(self, dispatch: Callable[[str], Any],
+                 last_fired: Optional[Callable[[str], Optional[float]]] = None,
+                 rescan: Optional[Callable[[], Any]] = None, rescan_interval: float = 60.0,
+                 jitter: float = 0.0, catchup: str = 'once', misfire_grace: float = 60.0):
+        """ Initialize the scheduler
+        dispatch: Called with a job name each time that job's trigger fires
+        last_fired: Returns when a job last ran, used to catch up on fires missed while down
+        rescan: Called every rescan_interval seconds to pick up configs edited by hand
+        jitter, catchup: Defaults for triggers that don't set their own
+        misfire_grace: Fires later than this many seconds count as missed
+        """
+        self.dispatch = dispatch
+        self.last_fired = last_fired
+        self.rescan = rescan
+        self.rescan_interval: float = rescan_interval
+        self.jitter: float = jitter
+        self.catchup: str = catchup
+        self.misfire_grace: float = misfire_grace
+
+        self._cond = threading.Condition()
+        self._heap: List[Tuple[float, int, str]] = []
+        self._entries: Dict[str, _Entry] = {}
+        self._generation: int = 0
+        self._thread: Optional[threading.Thread] = None
+        self._stopped: bool = False
+
+
+    # --- Scheduler internals
+
+
+    def _push(self, entry: _Entry, scheduled: float) -> None:
+        """ Queue entry's next fire, must be called with self._cond held """
+        entry.scheduled = scheduled
+        entry.deadline = scheduled + (random.uniform(0, entry.jitter) if entry.jitter > 0 else 0)
+        heapq.heappush(self._heap, (entry.deadline, entry.generation, entry.name))
+
+        # Superseded entries are skipped lazily, compact once they dominate the heap
+        if len(self._heap) > 2 * len(self._entries) + 64:
+            self._heap = [(entry.deadline, entry.generation, entry.name) for entry in self._entries.values()]
+            heapq.heapify(self._heap)
+
+        self._cond.notify()
+
+
+    def _fire(self, entry: _Entry, now: float) -> int:
+        """ Work out how many runs a due entry starts and schedule its next fire
+        Must be called with self._cond held
+        """
+        runs = 1
+        after = entry.scheduled
+
+        if now - entry.scheduled > self.misfire_grace:
+            after = now
+
+            if entry.catchup == 'skip':
+                runs = 0
+            elif entry.catchup == 'all':
+                missed = entry.cron.next_after(entry.scheduled)
+                while missed <= now and runs < max_catchup:
+                    runs += 1
+                    missed = entry.cron.next_after(missed)
+
+            logger.info('Cron trigger for %s fired %.0fs late, starting %d run(s)',
+                        entry.name, now - entry.scheduled, runs)
+
+        self._push(entry, entry.cron.next_after(after))
+
+        return runs
+
+
+    def _first_fire(self, name: str, cron: CronExpression, catchup: str) -> float:
+        """ When a trigger that is (re)starting fires first
+        Fires missed since the job last ran are due straight away unless catchup is "skip"
+        """
+        first = cron.next_after(time.time())
+
+        if catchup != 'skip' and self.last_fired is not None:
+            last = self.last_fired(name)
+            if last is not None:
+                first = min(first, cron.next_after(last))
+
+        return first
+
+
+    def _due(self, now: float) -> List[str]:
+        """ Pop every entry that is due, must be called with self._cond held """
+        due: List[str] = []
+
+        while self._heap and self._heap[0][0] <= now:
+            _, generation, name = heapq.heappop(self._heap)
+            entry = self._entries.get(name)
+
+            if entry is None or entry.generation != generation:
+                continue
+
+            due.extend([name] * self._fire(entry, now))
+
+        return due
+
+
+    def _loop(self) -> None:
+        """ Scheduler thread main loop """
+        next_rescan = time.time() + self.rescan_interval
+
+        while True:
+            with self._cond:
+                if self._stopped:
+                    return
+
+                now = time.time()
+                due = self._due(now)
+
+                if not due and now < next_rescan:
+                    timeout = next_rescan - now
+                    if self._heap:
+                        timeout = min(timeout, self._heap[0][0] - now)
+                    self._cond.wait(timeout)
+                    continue
+
+            for name in due:
+                try:
+                    self.dispatch(name)
+                except Exception as error:  # One bad job must not stop the scheduler
+                    logger.warning('Cron trigger for %s failed: %s', name, error)
+
+            if self.rescan is not None and time.time() >= next_rescan:
+                next_rescan = time.time() + self.rescan_interval
+                self.rescan()
+
+
+    # --- Scheduler functions
+
+
+    def update_job(self, name: str, config: Optional[Dict[str, Any]]) -> None:
+        """ (Re)schedule one job from its config, or unschedule it if config is None
+        Matches the JobRegistry listener signature. Configs whose trigger did not
+        change keep their current schedule.
+        """
+        try:
+            trigger = trigger_options((config or {}).get('trigger'))
+        except ValueError as error:  # Configs edited by hand are not checked when written
+            logger.warning('Ignoring cron trigger for %s: %s', name, error)
+            trigger = {}
+
+        expression = trigger.get('cron')
+
+        if not expression:
+            with self._cond:
+                self._entries.pop(name, None)
+            return
+
+        jitter = float(trigger.get('jitter', self.jitter))
+        catchup = trigger.get('catchup', self.catchup)
+        spec = (expression, jitter, catchup)
+
+        with self._cond:
+            current = self._entries.get(name)
+            if current is not None and current.spec == spec:
+                return
+
+        try:
+            cron = CronExpression(expression)
+            # Catch up on fires missed while the daemon was down, only for jobs we haven't seen yet
+            first = self._first_fire(name, cron, catchup) if current is None else cron.next_after(time.time())
+        except ValueError as error:
+            logger.warning('Ignoring cron trigger for %s: %s', name, error)
+            with self._cond:
+                self._entries.pop(name, None)
+            return
+
+        with self._cond:
+            self._generation += 1
+            entry = _Entry(name, spec, cron, jitter, catchup, self._generation)
+            self._entries[name] = entry
+            self._push(entry, first)
+
+
+    def schedule(self) -> List[Dict[str, Any]]:
+        """ Every scheduled job with its cron expression and next fire time, soonest first """
+        with self._cond:
+            entries = sorted(self._entries.values(), key=lambda entry: entry.deadline)
+            return [{"name": entry.name, "cron": entry.cron.expression, "next_fire": entry.deadline}
+                    for entry in entries]
+
+
+    def start(self) -> None:
+        """ Start the scheduler thread
+        Every trigger is rescheduled from when its job last ran first, so a process
+        that takes over from another one's scheduler does not replay the fires
+        that came due while it waited for the lock and the other one already ran
+        """
+        with self._cond:
+            if self._thread is not None:
+                return
+            entries = list(self._entries.values())
+
+        firsts = {entry.name: self._first_fire(entry.name, entry.cron, entry.catchup) for entry in entries}
+
+        with self._cond:
+            if self._thread is not None:
+                return
+
+            for entry in entries:
+                # Entries changed meanwhile were already scheduled afresh
+                if self._entries.get(entry.name) is entry:
+                    self._generation += 1
+                    entry.generation = self._generation
+                    self._push(entry, firsts[entry.name])
+
+            self._stopped = False
+            self._thread = threading.Thread(target=self._loop, name='viki-scheduler', daemon=True)
+            self._thread.start()
+
+
+    def stop(self) -> None:
+        """ Stop the scheduler thread """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+            thread, self._thread = self._thread, None
+
+        if thread is not None:
+            thread.join()
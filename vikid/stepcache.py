@@ -0,0 +1,396 @@
+# coding: utf-8
+
+"""
+stepcache.py
+~~~~~~~~~~~~
+
+Step cache library - internal to Viki
+
+A named step opts into caching by declaring what it depends on and what
+it produces:
+
+    {"name": "deps", "run": "pip install -r requirements.txt -t vendor",
+     "cache": {"inputs": ["requirements.txt"], "env": ["PYTHON"], "outputs": ["vendor/**"]}}
+
+Its cache key is a sha256 over the job name, the step's command, the
+run's job_args, the values of the listed environment variables and the
+contents of the workspace files matching the input globs. When a step
+with the same key has succeeded before it is not run again: the files
+that matched its output globs are copied back into the workspace and the
+output it printed is replayed into the build log. Otherwise the step runs
+as usual and, if it succeeds, its outputs and output are kept under the
+key.
+
+Output files are kept in the artifact store so a file produced by many
+runs is stored once. Entries live under stepcache/entries/ and are
+evicted least recently used first once they take more than
+step_cache_max_bytes. Hits and misses are counted per job and step.
+:license: Apache2, see LICENSE for more details
+"""
+
+import glob
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
+
+from vikid import artifacts
+from vikid.artifacts import ArtifactStore
+from vikid.locks import FileLock
+
+logger = logging.getLogger(__name__)
+
+entry_filename = "entry.json"
+log_filename = "log.jsonl"
+
+# Bumped whenever what goes into a key changes, so old entries are never hit
+key_version = 1
+
+
+def spec(config: Any, step_name: str) -> Optional[Dict[str, List[str]]]:
+    """ Check a step's "cache" block
+    Returns it with every field filled in, None if the step isn't cached
+    Raises ValueError if it is malformed
+    """
+    if config is None:
+        return None
+
+    label = 'Step {} cache'.format(step_name)
+
+    if not isinstance(config, dict):
+        raise ValueError('{} must be an object'.format(label))
+
+    unknown = set(config) - {'inputs', 'env', 'outputs'}
+    if unknown:
+        raise ValueError('{} has unknown field(s): {}'.format(label, ', '.join(sorted(unknown))))
+
+    env = config.get('env') or []
+    if not isinstance(env, list) or not all(isinstance(name, str) and name for name in env):
+        raise ValueError('{} env must be a list of variable names'.format(label))
+
+    return {"inputs": artifacts.patterns(config.get('inputs'), label + ' inputs'),
+            "env": env,
+            "outputs": artifacts.patterns(config.get('outputs'), label + ' outputs')}
+
+
+def _input_files(workspace: str, globs: List[str]) -> List[Tuple[str, str]]:
+    """ Path and sha256 of every file in workspace matching globs """
+    files: Dict[str, str] = {}
+
+    for pattern in globs:
+        for match in glob.glob(workspace + "/" + pattern, recursive=True):
+            path = os.path.relpath(match, workspace)
+            if path not in files and os.path.isfile(match):
+                files[path] = artifacts.file_hash(match)
+
+    return sorted(files.items())
+
+
+class CachedStep:
+    """ Stands in for the process of a step restored from the cache
+    Behaves like a StepProcess that has already succeeded
+    """
+
+    pid = None
+
+    def __init__(self, command: str, key: str, job_name: Optional[str] = None,
+                 run_id: Optional[str] = None, wall_time: float = 0.0):
+        self.command: str = command
+        self.key: str = key
+        self.job_name: Optional[str] = job_name
+        self.run_id: Optional[str] = run_id
+        self.started: float = time.time()
+        self.return_code: int = 0
+        self.wall_time: float = wall_time
+
+
+    def wait(self, timeout: Optional[float] = None) -> int:
+        return self.return_code
+
+
+    def finished(self) -> bool:
+        return True
+
+
+    def on_exit(self, callback) -> None:
+        callback(self)
+
+
+    def kill(self, grace: float = 10.0) -> None:
+        pass
+
+
+    def to_dict(self) -> Dict[str, Any]:
+        """ Return a json friendly summary, shaped like a StepProcess's """
+        return {
+            "pid": None,
+            "command": self.command,
+            "job": self.job_name,
+            "run_id": self.run_id,
+            "started": self.started,
+            "running": False,
+            "return_code": self.return_code,
+            "wall_time": self.wall_time,
+            "user_time": None,
+            "system_time": None,
+            "max_rss": None,
+            "read_blocks": None,
+            "write_blocks": None,
+            "spawn_time": None,
+            "cached": True,
+            "cache_key": self.key,
+        }
+
+
+class StepCache:
+    """ Outputs of cacheable steps, kept within a disk budget """
+
+    def __init__(self, root: str, artifact_store: ArtifactStore, max_bytes: int = 0):
+        """ Initialize the cache
+        root: Directory holding entries/, pending/ and stats/
+        artifact_store: Artifact store output files are kept in
+        max_bytes: Disk budget for entries, 0 means unlimited
+        """
+        self.entries_path: str = root + "/entries"
+        self.pending_path: str = root + "/pending"
+        self.stats_path: str = root + "/stats"
+        self.artifacts: ArtifactStore = artifact_store
+        self.max_bytes: int = max_bytes
+
+        # Size of every entry seen on disk, entries written by other processes are picked up as they appear
+        self._lock = threading.Lock()
+        self._sizes: Dict[str, int] = {}
+
+
+    # --- Cache internals
+
+
+    def _entry_path(self, key: str) -> str:
+        return self.entries_path + "/" + key
+
+
+    def _read_entry(self, path: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(path + "/" + entry_filename, 'r') as file_obj:
+                return json.loads(file_obj.read())
+        except (OSError, ValueError):
+            return None
+
+
+    def _remove(self, path: str) -> None:
+        """ Take an entry out of use at once, then delete it """
+        os.makedirs(self.pending_path, exist_ok=True)
+        trash = self.pending_path + "/" + uuid.uuid4().hex
+
+        try:
+            os.rename(path, trash)
+        except OSError:
+            return
+
+        shutil.rmtree(trash, ignore_errors=True)
+
+
+    def _evict(self) -> None:
+        """ Remove least recently used entries until the cache fits its budget """
+        if not self.max_bytes:
+            return
+
+        evicted = False
+
+        with self._lock:
+            try:
+                keys = set(os.listdir(self.entries_path))
+            except OSError:
+                return
+
+            for key in set(self._sizes) - keys:
+                del self._sizes[key]
+            for key in keys - set(self._sizes):
+                entry = self._read_entry(self._entry_path(key))
+                self._sizes[key] = entry["size"] if entry is not None else 0
+
+            total = sum(self._sizes.values())
+            if total <= self.max_bytes:
+                return
+
+            def last_used(key: str) -> float:
+                try:
+                    return os.stat(self._entry_path(key)).st_mtime
+                except OSError:
+                    return 0.0
+
+            for key in sorted(self._sizes, key=last_used):
+                if total <= self.max_bytes:
+                    break
+
+                self._remove(self._entry_path(key))
+                logger.info('Evicted step cache entry %s (%d bytes)', key, self._sizes[key])
+                total -= self._sizes.pop(key)
+                evicted = True
+
+        # Drop the output files only the evicted entries kept
+        if evicted:
+            self.artifacts.collect_garbage()
+
+
+    # --- Cache functions
+
+
+    def key(self, job_name: str, step: Dict[str, Any], job_args: Optional[List[str]],
+            env: Dict[str, str], workspace: str) -> str:
+        """ Cache key of a step about to run in workspace
+        env: The environment the step would run with
+        Raises OSError if an input file can't be read
+        """
+        config: Dict[str, List[str]] = step['cache']
+
+        return hashlib.sha256(json.dumps({
+            "version": key_version,
+            "job": job_name,
+            "run": step['run'],
+            "args": [str(argument) for argument in job_args or []],
+            "env": {name: env.get(name) for name in config['env']},
+            "inputs": _input_files(workspace, config['inputs']),
+        }, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+    def restore(self, key: str, workspace: str) -> Optional[List[Tuple[str, bytes]]]:
+        """ Copy the outputs cached under key back into workspace
+        Returns the step's output as (stream, data) batches, None on a miss
+        """
+        path = self._entry_path(key)
+        if self._read_entry(path) is None:
+            return None
+
+        try:
+            with open(path + "/" + log_filename, 'r') as file_obj:
+                output = [(batch["stream"], batch["data"].encode('utf-8', 'surrogateescape'))
+                          for batch in map(json.loads, file_obj)]
+
+            artifacts.restore(path, workspace)
+
+            # The entry's mtime doubles as its last used time for eviction
+            os.utime(path)
+        except (OSError, ValueError) as error:
+            # Evicted or damaged underneath us, the step just runs
+            logger.warning('Could not restore step cache entry %s: %s', key, error)
+            return None
+
+        return output
+
+
+    def begin(self) -> str:
+        """ Directory a step's entry is put together in while it runs """
+        os.makedirs(self.pending_path, exist_ok=True)
+
+        return tempfile.mkdtemp(dir=self.pending_path)
+
+
+    def store(self, key: str, pending: str, workspace: str, job_name: str, step: Dict[str, Any]) -> None:
+        """ Keep the outputs of a step that succeeded under key
+        pending: Directory from begin(), holding the step's recorded output
+        Raises OSError if the outputs could not be kept
+        """
+        try:
+            manifest = self.artifacts.collect(workspace, pending, step['cache']['outputs'])
+
+            size = sum(artifact["size"] for artifact in manifest)
+            if os.path.exists(pending + "/" + log_filename):
+                size += os.path.getsize(pending + "/" + log_filename)
+
+            with open(pending + "/" + entry_filename, 'w') as file_obj:
+                file_obj.write(json.dumps({"key": key, "job": job_name, "step": step['name'],
+                                           "created": time.time(), "size": size}))
+
+            os.makedirs(self.entries_path, exist_ok=True)
+            try:
+                os.rename(pending, self._entry_path(key))
+            except OSError:
+                # Another run of the same step got there first
+                self.discard(pending)
+        except BaseException:
+            self.discard(pending)
+            raise
+
+        self._evict()
+
+
+    def discard(self, pending: str) -> None:
+        """ Drop an entry that will not be kept """
+        shutil.rmtree(pending, ignore_errors=True)
+
+
+    def count(self, job_name: str, step_name: str, hit: bool) -> None:
+        """ Record a hit or a miss of one of job_name's steps """
+        os.makedirs(self.stats_path, exist_ok=True)
+        stats_file = self.stats_path + "/" + job_name + ".json"
+        field = "hits" if hit else "misses"
+
+        try:
+            with FileLock(stats_file + ".lock"):
+                stats = self.stats(job_name)
+                stats[field] += 1
+                step = stats["steps"].setdefault(step_name, {"hits": 0, "misses": 0})
+                step[field] += 1
+
+                tmp_file = "{}.{}.tmp".format(stats_file, uuid.uuid4().hex[:8])
+                with open(tmp_file, 'w') as file_obj:
+                    file_obj.write(json.dumps(stats))
+                os.replace(tmp_file, stats_file)
+        except OSError as error:
+            logger.warning('Could not count a step cache %s for %s: %s', field[:-1], job_name, error)
+
+
+    def stats(self, job_name: str) -> Dict[str, Any]:
+        """ Hits and misses of job_name's steps, in total and by step """
+        try:
+            with open(self.stats_path + "/" + job_name + ".json", 'r') as file_obj:
+                return json.loads(file_obj.read())
+        except (OSError, ValueError):
+            return {"hits": 0, "misses": 0, "steps": {}}
+
+
+    def usage(self, job_name: Optional[str] = None) -> Dict[str, int]:
+        """ Number of entries and bytes they take, for one job or the whole cache """
+        entries = 0
+        size = 0
+
+        try:
+            keys = os.listdir(self.entries_path)
+        except OSError:
+            keys = []
+
+        for key in keys:
+            entry = self._read_entry(self._entry_path(key))
+            if entry is not None and (job_name is None or entry["job"] == job_name):
+                entries += 1
+                size += entry["size"]
+
+        return {"entries": entries, "bytes": size}
+
+
+    def forget(self, job_name: str) -> None:
+        """ Drop everything cached for a job that has been deleted """
+        try:
+            keys = os.listdir(self.entries_path)
+        except OSError:
+            keys = []
+
+        for key in keys:
+            entry = self._read_entry(self._entry_path(key))
+            if entry is not None and entry["job"] == job_name:
+                self._remove(self._entry_path(key))
+
+        for filename in (job_name + ".json", job_name + ".json.lock"):
+            try:
+                os.remove(self.stats_path + "/" + filename)
+            except OSError:
+                pass
+
+        self.artifacts.collect_garbage()
@@ -0,0 +1,338 @@
+# coding: utf-8
+
+"""
+steps.py
+~~~~~~~~
+
+Step graph library - internal to Viki
+
+A job's "steps" array can mix plain shell strings with named steps:
+
+    "steps": [
+        {"name": "checkout", "run": "git pull"},
+        {"name": "lint", "run": "make lint", "needs": ["checkout"]},
+        {"name": "test", "run": "make test", "needs": ["checkout"]},
+        {"name": "deploy", "run": "make deploy", "needs": ["lint", "test"]}
+    ]
+
+A plain string needs the step before it, so a list of strings still runs
+strictly in order. A named step needs exactly what it lists. Steps whose
+needs have all succeeded run at once, up to max_parallel_steps at a time.
+The first failure stops the run: nothing new starts and running siblings
+are killed. Named steps may set a "timeout" in seconds and opt into the
+step cache with a "cache" block, see stepcache.py.
+:license: Apache2, see LICENSE for more details
+"""
+
+import threading
+import time
+from concurrent import futures
+from typing import Any, Callable, Dict, List, Optional, Set
+
+from vikid import stepcache
+from vikid.supervisor import StepProcess
+
+
+def timeout_seconds(value: Any, field: str = 'timeout') -> Optional[float]:
+    """ Check a timeout named field, None if it is not set
+    Raises ValueError unless it is a number of seconds above zero
+    """
+    if value is None:
+        return None
+
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0:
+        raise ValueError('{} must be a number of seconds above zero'.format(field))
+
+    return float(value)
+
+
+class StepGraph:
+    """ A job's steps and the order they may run in """
+
+    def __init__(self, steps: List[Any]):
+        """ Parse a job's "steps" array
+        Raises ValueError if a step is malformed, a name is repeated,
+        a step needs an unknown step or the needs form a cycle
+        """
+        self.steps: List[Dict[str, Any]] = []
+        self._by_name: Dict[str, Dict[str, Any]] = {}
+
+        if not isinstance(steps, list):
+            raise ValueError('Steps must be a list')
+
+        previous: Optional[str] = None
+
+        for index, step in enumerate(steps, 1):
+
+            if isinstance(step, str):
+                step = {"name": "step-{}".format(index), "run": step,
+                        "needs": [previous] if previous is not None else []}
+            elif isinstance(step, dict):
+                if not isinstance(step.get('run'), str):
+                    raise ValueError('Step {} has nothing to run'.format(index))
+                step_name = str(step.get('name', "step-{}".format(index)))
+                step = {"name": step_name, "run": step['run'],
+                        "needs": [str(need) for need in step.get('needs', [])],
+                        "timeout": timeout_seconds(step.get('timeout'), 'Step {} timeout'.format(step_name)),
+                        "cache": stepcache.spec(step.get('cache'), step_name)}
+            else:
+                raise ValueError('Step {} must be a string or an object'.format(index))
+
+            if step['name'] in self._by_name:
+                raise ValueError('Step name {} is used twice'.format(step['name']))
+
+            self.steps.append(step)
+            self._by_name[step['name']] = step
+            previous = step['name']
+
+        for step in self.steps:
+            for need in step['needs']:
+                if need not in self._by_name:
+                    raise ValueError('Step {} needs unknown step {}'.format(step['name'], need))
+
+        self.order: List[str] = self._topological_order()
+
+
+    # --- Graph internals
+
+
+    def _topological_order(self) -> List[str]:
+        """ Kahn's algorithm, ties keep config order """
+        waiting: Dict[str, int] = {step['name']: len(step['needs']) for step in self.steps}
+        dependents: Dict[str, List[str]] = {step['name']: [] for step in self.steps}
+
+        for step in self.steps:
+            for need in step['needs']:
+                dependents[need].append(step['name'])
+
+        ready: List[str] = [step['name'] for step in self.steps if not step['needs']]
+        order: List[str] = []
+
+        while ready:
+            name = ready.pop(0)
+            order.append(name)
+
+            for dependent in dependents[name]:
+                waiting[dependent] -= 1
+                if not waiting[dependent]:
+                    ready.append(dependent)
+
+        if len(order) != len(self.steps):
+            raise ValueError('Step needs form a cycle: {}'.format(
+                ', '.join(name for name in waiting if name not in order)))
+
+        return order
+
+
+    # --- Graph functions
+
+
+    def critical_path(self, durations: Dict[str, float]) -> Dict[str, Any]:
+        """ The chain of steps that bounded the run's wall time
+        durations: Wall time of every step that ran
+        """
+        finish: Dict[str, float] = {}
+        via: Dict[str, Optional[str]] = {}
+
+        for name in self.order:
+            if name not in durations:
+                continue
+
+            before: Optional[str] = None
+            for need in self._by_name[name]['needs']:
+                if need in finish and (before is None or finish[need] > finish[before]):
+                    before = need
+
+            finish[name] = durations[name] + (finish[before] if before is not None else 0.0)
+            via[name] = before
+
+        if not finish:
+            return {"steps": [], "duration": 0.0}
+
+        name: Optional[str] = max(finish, key=lambda step_name: finish[step_name])
+        total: float = finish[name]
+        path: List[str] = []
+
+        while name is not None:
+            path.append(name)
+            name = via[name]
+
+        return {"steps": path[::-1], "duration": total}
+
+
+    def run(self, start: Callable[[Dict[str, Any]], StepProcess], max_parallel: int = 1,
+            control: Optional['RunControl'] = None, timeout: Optional[float] = None,
+            step_timeout: Optional[float] = None,
+            finish: Optional[Callable[[Dict[str, Any], StepProcess], None]] = None) -> List[Dict[str, Any]]:
+        """ Run every step once its needs have succeeded
+        start: Spawns a step and returns its running StepProcess
+        max_parallel: Most steps running at once
+        control: Lets the run be stopped from another thread
+        timeout: Seconds the whole run may take
+        step_timeout: Seconds a step may take unless it sets its own "timeout"
+        finish: Called with each step and its process once it has exited,
+        before any step that needs it starts
+        Returns every step's result in config order, each with a state of succeeded,
+        failed, timed_out, cancelled (stopped before it finished) or skipped
+        Raises OSError if a step could not be started
+        """
+        control = control or RunControl()
+        processes: Dict[str, StepProcess] = {}
+        timed_out: Set[str] = set()
+
+        ready_at: Dict[str, float] = {}
+        slot_waits: Dict[str, float] = {}
+
+        def run_one(step: Dict[str, Any]) -> Optional[StepProcess]:
+            # Time between the step becoming ready and a pool thread picking it up
+            slot_waits[step['name']] = time.monotonic() - ready_at[step['name']]
+
+            process = control.start(lambda: start(step))
+            if process is None:
+                return None
+
+            processes[step['name']] = process
+            limit = step.get('timeout') or step_timeout
+
+            if process.wait(float(limit) if limit else None) is None:
+                timed_out.add(step['name'])
+                process.kill(control.grace)
+                process.wait()
+
+            control.forget(process)
+
+            if finish is not None:
+                finish(step, process)
+
+            return process
+
+        deadline: Optional[float] = time.monotonic() + float(timeout) if timeout else None
+        waiting: Dict[str, Set[str]] = {step['name']: set(step['needs']) for step in self.steps}
+        pending: Dict[futures.Future, str] = {}
+        start_error: Optional[OSError] = None
+
+        with futures.ThreadPoolExecutor(max_workers=max(1, max_parallel), thread_name_prefix='viki-step') as pool:
+
+            def submit_ready() -> None:
+                for name in [name for name in self.order if name in waiting and not waiting[name]]:
+                    del waiting[name]
+                    ready_at[name] = time.monotonic()
+                    pending[pool.submit(run_one, self._by_name[name])] = name
+
+            submit_ready()
+
+            while pending:
+                wait: Optional[float] = None
+                if deadline is not None and control.reason is None:
+                    wait = max(0.0, deadline - time.monotonic())
+
+                done, _ = futures.wait(pending, timeout=wait, return_when=futures.FIRST_COMPLETED)
+
+                if not done:
+                    # Out of time, stop what is running and wait for it to go
+                    control.stop('timed_out')
+                    continue
+
+                for future in done:
+                    name = pending.pop(future)
+
+                    try:
+                        process = future.result()
+                    except OSError as error:
+                        # The step could not be started, stop the rest and report it below
+                        start_error = start_error or error
+                        control.stop('failed')
+                        continue
+
+                    if process is None or control.reason is not None:
+                        continue
+
+                    if process.return_code != 0:
+                        control.stop('timed_out' if name in timed_out else 'failed')
+                        continue
+
+                    for needs in waiting.values():
+                        needs.discard(name)
+
+                if control.reason is None:
+                    submit_ready()
+
+        if start_error is not None:
+            raise start_error
+
+        results: List[Dict[str, Any]] = []
+
+        for step in self.steps:
+            result: Dict[str, Any] = {"name": step['name'], "needs": step['needs']}
+            process = processes.get(step['name'])
+
+            if process is None:
+                result.update({"command": step['run'], "state": "skipped"})
+            else:
+                result.update(process.to_dict())
+                result['slot_wait'] = slot_waits.get(step['name'])
+                if step['name'] in timed_out:
+                    result['state'] = "timed_out"
+                elif process in control.stopped:
+                    result['state'] = "timed_out" if control.reason == 'timed_out' else "cancelled"
+                else:
+                    result['state'] = "succeeded" if process.return_code == 0 else "failed"
+
+            results.append(result)
+
+        return results
+
+
+class RunControl:
+    """ Stops a run's steps on request: a user cancelling it, the run
+    timing out or one of its steps failing
+    """
+
+    def __init__(self, grace: float = 10.0):
+        """ grace: Seconds steps get to exit after SIGTERM before they are killed """
+        self.grace: float = grace
+
+        # Why the run was stopped: cancelled, timed_out or failed, None while it isn't
+        self.reason: Optional[str] = None
+
+        # Processes that were still running when the run was stopped
+        self.stopped: Set[StepProcess] = set()
+
+        self._lock = threading.Lock()
+        self._running: Set[StepProcess] = set()
+
+
+    def start(self, spawn: Callable[[], StepProcess]) -> Optional[StepProcess]:
+        """ Spawn a step unless the run has been stopped, returns None if it has """
+        with self._lock:
+            if self.reason is not None:
+                return None
+
+            process = spawn()
+            self._running.add(process)
+
+        return process
+
+
+    def forget(self, process: StepProcess) -> None:
+        """ A step has finished """
+        with self._lock:
+            self._running.discard(process)
+
+
+    def stop(self, reason: str) -> bool:
+        """ Stop the run and kill the process groups of its running steps
+        Returns False if it had already been stopped
+        """
+        with self._lock:
+            if self.reason is not None:
+                return False
+
+            self.reason = reason
+
+            for process in self._running:
+                if not process.finished():
+                    self.stopped.add(process)
+                    process.kill(self.grace)
+
+        return True
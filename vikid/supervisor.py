@@ -0,0 +1,356 @@
+# coding: utf-8
+
+"""
+supervisor.py
+~~~~~~~~~~~~~
+
+Child process supervisor - internal to Viki
+
+Every step process viki starts is registered here so there is one place
+that knows what is running. Children are reaped without polling: on Linux
+each child gets a pidfd that a single reaper thread blocks on, everywhere
+else a thread blocks in wait4() for that child. Either way an idle daemon
+uses no CPU no matter how many steps are running.
+
+Steps started by a viki process that has since died are nobody's
+children any more. They are found by the environment they inherited and
+stopped a process group at a time.
+:license: Apache2, see LICENSE for more details
+"""
+
+import os
+import selectors
+import signal
+import subprocess
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Set
+
+from vikid import metrics
+
+
+def _exit_code(status: int) -> int:
+    """ Convert a raw wait status into a Popen style return code
+    Negative numbers mean the child was killed by that signal
+    """
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+
+    if os.WIFEXITED(status):
+        return os.WEXITSTATUS(status)
+
+    return status
+
+
+class StepProcess:
+    """ A single supervised step process """
+
+    def __init__(self, popen: subprocess.Popen, command: str,
+                 job_name: Optional[str] = None, run_id: Optional[str] = None):
+        self.popen: subprocess.Popen = popen
+        self.pid: int = popen.pid
+        self.command: str = command
+        self.job_name: Optional[str] = job_name
+        self.run_id: Optional[str] = run_id
+
+        # Wall clock start for display, monotonic start for measuring
+        self.started: float = time.time()
+        self._started_monotonic: float = time.monotonic()
+
+        self.return_code: Optional[int] = None
+        self.wall_time: Optional[float] = None
+        self.user_time: Optional[float] = None
+        self.system_time: Optional[float] = None
+        self.max_rss: Optional[int] = None
+        self.read_blocks: Optional[int] = None
+        self.write_blocks: Optional[int] = None
+
+        # How long fork and exec took
+        self.spawn_time: Optional[float] = None
+
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._exit_callbacks: List[Callable[['StepProcess'], Any]] = []
+
+
+    def wait(self, timeout: Optional[float] = None) -> Optional[int]:
+        """ Block until the process has been reaped
+        Returns the return code, or None if timeout expired first
+        """
+        if not self._done.wait(timeout):
+            return None
+
+        return self.return_code
+
+
+    def finished(self) -> bool:
+        """ True once the process has exited and been reaped """
+        return self._done.is_set()
+
+
+    def on_exit(self, callback: Callable[['StepProcess'], Any]) -> None:
+        """ Call callback(process) once the process has been reaped, straight away if it has """
+        with self._lock:
+            if not self._done.is_set():
+                self._exit_callbacks.append(callback)
+                return
+
+        callback(self)
+
+
+    def kill(self, grace: float = 10.0) -> None:
+        """ Stop the process and everything it started
+        Sends SIGTERM to the process group, then SIGKILL to whatever is left
+        grace seconds later. Only for processes started as a group leader
+        (start_new_session=True)
+        """
+        def signal_group(signum: int) -> None:
+            try:
+                os.killpg(self.pid, signum)
+            except (ProcessLookupError, PermissionError):
+                pass
+
+        signal_group(signal.SIGTERM)
+
+        def escalate() -> None:
+            # Children may outlive the leader, so the group is killed either way
+            self._done.wait(grace)
+            signal_group(signal.SIGKILL)
+
+        threading.Thread(target=escalate, name='viki-kill-{}'.format(self.pid), daemon=True).start()
+
+
+    def _finish(self, return_code: int, rusage: Any = None) -> None:
+        """ Record the exit of the process and wake any waiters """
+        self.wall_time = time.monotonic() - self._started_monotonic
+        self.return_code = return_code
+
+        if rusage is not None:
+            self.user_time = rusage.ru_utime
+            self.system_time = rusage.ru_stime
+            self.max_rss = rusage.ru_maxrss
+            self.read_blocks = rusage.ru_inblock
+            self.write_blocks = rusage.ru_oublock
+
+        # Let Popen know the child is gone so it never tries to reap it again
+        self.popen.returncode = return_code
+
+        with self._lock:
+            self._done.set()
+            callbacks, self._exit_callbacks = self._exit_callbacks, []
+
+        for callback in callbacks:
+            callback(self)
+
+
+    def to_dict(self) -> Dict[str, Any]:
+        """ Return a json friendly summary of this step process """
+        wall_time = self.wall_time
+        if wall_time is None:
+            wall_time = time.monotonic() - self._started_monotonic
+
+        return {
+            "pid": self.pid,
+            "command": self.command,
+            "job": self.job_name,
+            "run_id": self.run_id,
+            "started": self.started,
+            "running": not self.finished(),
+            "return_code": self.return_code,
+            "wall_time": wall_time,
+            "user_time": self.user_time,
+            "system_time": self.system_time,
+            "max_rss": self.max_rss,
+            "read_blocks": self.read_blocks,
+            "write_blocks": self.write_blocks,
+            "spawn_time": self.spawn_time,
+            "cached": False,
+        }
+
+
+class Supervisor:
+    """ Starts, tracks and reaps step processes """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._processes: Dict[int, StepProcess] = {}
+
+        # pidfd reaper state, created lazily on first spawn
+        self._reaper: Optional[threading.Thread] = None
+        self._selector: Optional[selectors.BaseSelector] = None
+        self._wakeup_r: int = -1
+        self._wakeup_w: int = -1
+        self._pending: List[Any] = []
+
+
+    # --- Supervisor internals
+
+
+    def _start_reaper(self) -> None:
+        """ Start the pidfd reaper thread if it is not already running
+        Must be called with self._lock held
+        """
+        if self._reaper is not None:
+            return
+
+        self._selector = selectors.DefaultSelector()
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ)
+
+        self._reaper = threading.Thread(target=self._reap_loop, name='viki-reaper', daemon=True)
+        self._reaper.start()
+
+
+    def _reap_loop(self) -> None:
+        """ Block on every child's pidfd and reap each one as it exits """
+        while True:
+            for key, _ in self._selector.select():
+
+                if key.fd == self._wakeup_r:
+                    # New children were handed to us, start watching them
+                    os.read(self._wakeup_r, 4096)
+                    with self._lock:
+                        pending, self._pending = self._pending, []
+                    for pidfd, process in pending:
+                        self._selector.register(pidfd, selectors.EVENT_READ, process)
+                    continue
+
+                self._selector.unregister(key.fd)
+                os.close(key.fd)
+                self._reap(key.data)
+
+
+    def _reap(self, process: StepProcess) -> None:
+        """ Collect the exit status and resource usage of a finished child """
+        try:
+            _, status, rusage = os.wait4(process.pid, 0)
+            return_code = _exit_code(status)
+        except ChildProcessError:
+            # Somebody else already reaped it, nothing left to measure
+            rusage = None
+            return_code = process.popen.returncode if process.popen.returncode is not None else 0
+
+        with self._lock:
+            self._processes.pop(process.pid, None)
+
+        process._finish(return_code, rusage)
+
+
+    def _watch(self, process: StepProcess) -> None:
+        """ Arrange for process to be reaped as soon as it exits """
+        pidfd_open = getattr(os, 'pidfd_open', None)
+        pidfd: int = -1
+
+        if pidfd_open is not None:
+            try:
+                pidfd = pidfd_open(process.pid)
+            except OSError:
+                # Kernel too old for pidfds
+                pidfd = -1
+
+        if pidfd < 0:
+            # No pidfd support, block in wait4() on a thread of its own instead
+            threading.Thread(target=self._reap, args=(process,),
+                             name='viki-wait-{}'.format(process.pid), daemon=True).start()
+            return
+
+        with self._lock:
+            self._start_reaper()
+            self._pending.append((pidfd, process))
+
+        os.write(self._wakeup_w, b'\0')
+
+
+    # --- Supervisor functions
+
+
+    def spawn(self, args: List[str], command: Optional[str] = None, job_name: Optional[str] = None,
+              run_id: Optional[str] = None, **popen_kwargs: Any) -> StepProcess:
+        """ Start a step process and begin supervising it
+        Extra keyword arguments are handed to subprocess.Popen
+        """
+        began = time.monotonic()
+        popen = subprocess.Popen(args, **popen_kwargs)
+        spawn_time = time.monotonic() - began
+
+        process = StepProcess(popen, command if command is not None else ' '.join(args),
+                              job_name=job_name, run_id=run_id)
+        process.spawn_time = spawn_time
+        metrics.spawn_latency.observe(spawn_time)
+
+        with self._lock:
+            self._processes[process.pid] = process
+
+        self._watch(process)
+
+        return process
+
+
+    def processes(self) -> List[StepProcess]:
+        """ Return every step process that is currently running """
+        with self._lock:
+            return list(self._processes.values())
+
+
+supervisor = Supervisor()
+
+
+def _group_alive(group: int) -> bool:
+    try:
+        os.killpg(group, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return True
+
+
+def orphaned_groups(variable: str, value: str) -> Set[int]:
+    """ Process groups of every process whose environment holds variable=value
+    Empty where /proc is not available
+    """
+    wanted = '{}={}'.format(variable, value).encode('utf-8')
+    own = os.getpgrp()
+    groups: Set[int] = set()
+
+    try:
+        pids = [int(entry) for entry in os.listdir('/proc') if entry.isdigit()]
+    except OSError:
+        return groups
+
+    for pid in pids:
+        try:
+            with open('/proc/{}/environ'.format(pid), 'rb') as environ:
+                if wanted not in environ.read().split(b'\0'):
+                    continue
+            group = os.getpgid(pid)
+        except OSError:
+            # Gone already, or not ours to look at
+            continue
+
+        if group != own:
+            groups.add(group)
+
+    return groups
+
+
+def kill_groups(groups: Set[int], grace: float = 10.0) -> None:
+    """ SIGTERM process groups, then SIGKILL the ones still there grace seconds later """
+    for group in groups:
+        try:
+            os.killpg(group, signal.SIGTERM)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+    deadline = time.monotonic() + grace
+
+    while groups and time.monotonic() < deadline:
+        time.sleep(0.1)
+        groups = set(group for group in groups if _group_alive(group))
+
+    for group in groups:
+        try:
+            os.killpg(group, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
@@ -1,12 +1,16 @@
 # coding: utf-8
 
 import json
+import os
+
+
+def read_config(filepath='~/.viki/viki.json'):
+    with open(os.path.expanduser(filepath), 'r') as file_obj:
+        return json.loads(file_obj.read())
 
-def read_config(filepath='~/.vikid/config.json'):
-    with open(filepath, 'r') as file_obj:
-        return json.loads(file_ojb.read())
 
 def run_system_setup():
-    # Make vikid home dir
-    # Make all required JSON config files
-    # Make example job
+    # Make vikid home dir, its jobs and logs dirs and the viki.json config file
+    from vikid.application import app
+
+    app.create_system_setup()
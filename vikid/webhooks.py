@@ -0,0 +1,278 @@
+# coding: utf-8
+
+"""
+webhooks.py
+~~~~~~~~~~~
+
+Webhook trigger library - internal to Viki
+
+Jobs with a "webhook" block in their config can be started with
+POST /api/v1/webhook/<job name>:
+
+    "webhook": {
+        "secret": "shared secret",
+        "debounce": 30,
+        "args": ["ref"],
+        "env": {"GIT_SHA": "head_commit.id"}
+    }
+
+When a secret is set (or read from the environment variable named by
+"secret_env") every delivery must be signed the way GitHub signs them,
+an X-Hub-Signature-256: sha256=<hex hmac of the body> header.
+
+Deliveries inside a debounce window become one run, started when the
+window closes with the latest payload. A webhook run still waiting in
+the queue takes over the payload of later deliveries instead of queueing
+another run behind it. Payload fields are picked with dotted paths and
+passed to the steps as arguments ($1, $2...) and environment variables.
+
+Deliveries land on whichever worker process gets the request, so a
+window lives in <state_path>/webhooks/<job>.json. The process that opened
+it holds <job>.window until it starts the window's run, and every read or
+write of a window happens under <job>.lock. A window whose process died
+is taken over by the next delivery.
+:license: Apache2, see LICENSE for more details
+"""
+
+import hashlib
+import hmac
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from vikid.locks import FileLock
+from vikid.run_queue import run_args
+
+logger = logging.getLogger(__name__)
+
+signature_header = "X-Hub-Signature-256"
+
+# Under state_path, the debounce windows still open
+windows_dirname = "webhooks"
+
+
+def webhook_options(config: Any) -> Dict[str, Any]:
+    """ Check a job's "webhook" block
+    Raises ValueError unless it is an object whose args are a list of payload paths,
+    env maps variable names to payload paths and debounce is zero or more seconds.
+    Returns {} if the job has none
+    """
+    if config is None:
+        return {}
+
+    if not isinstance(config, dict):
+        raise ValueError('webhook must be an object')
+
+    try:
+        run_args(config.get('args'))
+    except ValueError as error:
+        raise ValueError('webhook {}'.format(error))
+
+    env = config.get('env', {})
+    if not isinstance(env, dict) or not all(isinstance(path, str) for path in env.values()):
+        raise ValueError('webhook env must map variable names to payload paths')
+
+    debounce = config.get('debounce', 0)
+    if isinstance(debounce, bool) or not isinstance(debounce, (int, float)) or debounce < 0:
+        raise ValueError('webhook debounce must be a number of zero or more')
+
+    for field in ('secret', 'secret_env'):
+        if config.get(field) is not None and not isinstance(config[field], str):
+            raise ValueError('webhook {} must be a string'.format(field))
+
+    return config
+
+
+def secret(config: Dict[str, Any]) -> Optional[str]:
+    """ The job's webhook secret, None if deliveries need not be signed """
+    if config.get('secret_env'):
+        return os.environ.get(config['secret_env']) or None
+
+    return config.get('secret') or None
+
+
+def verify_signature(key: str, body: bytes, signature: Optional[str]) -> bool:
+    """ Check a sha256=<hex> HMAC signature of body """
+    if not signature or not signature.startswith('sha256='):
+        return False
+
+    expected = hmac.new(key.encode('utf-8'), body, hashlib.sha256).hexdigest()
+
+    return hmac.compare_digest(expected, signature[len('sha256='):])
+
+
+def payload_value(payload: Any, path: str) -> str:
+    """ Pick a field out of a payload by dotted path, "" if it isn't there
+    Lists are indexed by number, objects and lists come back as JSON
+    """
+    value: Any = payload
+
+    for key in path.split('.'):
+        if isinstance(value, dict):
+            value = value.get(key)
+        elif isinstance(value, list) and key.isdigit() and int(key) < len(value):
+            value = value[int(key)]
+        else:
+            value = None
+
+        if value is None:
+            return ""
+
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+
+    return str(value)
+
+
+def run_inputs(config: Dict[str, Any], payload: Any) -> Dict[str, Any]:
+    """ The job args and env a webhook run gets from its payload
+    Raises ValueError if config is not a usable "webhook" block
+    """
+    config = webhook_options(config)
+
+    job_args: List[str] = [payload_value(payload, path) for path in run_args(config.get('args')) or []]
+    env: Dict[str, str] = {str(name): payload_value(payload, path) for name, path in config.get('env', {}).items()}
+
+    return {"job_args": job_args, "env": env}
+
+
+class WebhookReceiver:
+    """ Turns webhook deliveries into runs, holding back the ones being debounced """
+
+    def __init__(self, submit: Callable[..., Any], state_path: str):
+        """ Initialize the receiver
+        submit: RunQueue.submit
+        state_path: Directory shared with the other viki processes to keep debounce windows in
+        """
+        self.submit = submit
+        self.windows_path: str = state_path + "/" + windows_dirname
+
+        self._cond = threading.Condition()
+
+        # Debounce windows this process opened: job name -> {"deadline", "lock"}
+        self._windows: Dict[str, Dict[str, Any]] = {}
+        self._thread: Optional[threading.Thread] = None
+
+
+    # --- Receiver internals
+
+
+    def _path(self, job_name: str, suffix: str) -> str:
+        return "{}/{}.{}".format(self.windows_path, job_name, suffix)
+
+
+    def _write_window(self, job_name: str, window: Dict[str, Any]) -> None:
+        """ Must be called holding the window's <job>.lock """
+        path = self._path(job_name, 'json')
+
+        with open(path + ".tmp", 'w') as file_obj:
+            file_obj.write(json.dumps(window))
+        os.replace(path + ".tmp", path)
+
+
+    def _read_window(self, job_name: str) -> Optional[Dict[str, Any]]:
+        """ Must be called holding the window's <job>.lock """
+        try:
+            with open(self._path(job_name, 'json'), 'r') as file_obj:
+                return json.loads(file_obj.read())
+        except (OSError, ValueError):
+            return None
+
+
+    def _start(self, job_name: str, inputs: Dict[str, Any]) -> Any:
+        """ Queue a webhook run, folding it into one that is still queued """
+        return self.submit(job_name, inputs["job_args"], trigger='webhook', coalesce=True, env=inputs["env"])
+
+
+    def _close(self, job_name: str, lock: FileLock) -> Optional[Dict[str, Any]]:
+        """ Take a window this process opened out of the shared state, returns it """
+        with FileLock(self._path(job_name, 'lock')):
+            window = self._read_window(job_name)
+
+            try:
+                os.remove(self._path(job_name, 'json'))
+            except OSError:
+                pass
+
+            lock.release()
+
+        return window
+
+
+    def _window_loop(self) -> None:
+        """ Start a run for each debounce window as it closes """
+        while True:
+            with self._cond:
+                now = time.time()
+                closed: List[str] = [name for name, window in self._windows.items() if window["deadline"] <= now]
+
+                if not closed:
+                    timeout = min((window["deadline"] for window in self._windows.values()), default=None)
+                    self._cond.wait(timeout - now if timeout is not None else None)
+                    continue
+
+                locks = [(name, self._windows.pop(name)["lock"]) for name in closed]
+
+            for name, lock in locks:
+                try:
+                    window = self._close(name, lock)
+                    if window is None:
+                        continue
+                    run = self._start(name, window["inputs"])
+                    logger.info('Webhook run %s of %s started for %d deliveries', run.id, name, window["deliveries"])
+                except Exception as error:  # One bad job must not stop the other windows
+                    logger.warning('Webhook run of %s could not be started: %s', name, error)
+
+
+    # --- Receiver functions
+
+
+    def receive(self, job_name: str, config: Dict[str, Any], payload: Any) -> Optional[Any]:
+        """ Accept a delivery for job_name
+        config: The job's "webhook" block
+        Returns the Run it was queued as, or None while its debounce window is open
+        Raises ValueError or run_queue.QueueFull if a run can't be queued right away
+        """
+        inputs = run_inputs(config, payload)
+        debounce = float(config.get('debounce', 0))
+
+        if debounce <= 0:
+            return self._start(job_name, inputs)
+
+        os.makedirs(self.windows_path, exist_ok=True)
+
+        with FileLock(self._path(job_name, 'lock')):
+            window = self._read_window(job_name)
+            owner = FileLock(self._path(job_name, 'window'))
+
+            # Free unless a live process has the window open, then it is ours to close
+            opened = owner.acquire(blocking=False)
+
+            if window is None:
+                window = {"deadline": time.time() + debounce, "inputs": inputs, "deliveries": 1}
+            else:
+                window["inputs"] = inputs
+                window["deliveries"] += 1
+
+            try:
+                self._write_window(job_name, window)
+            except OSError:
+                owner.release()
+                raise
+
+        if not opened:
+            return None
+
+        with self._cond:
+            self._windows[job_name] = {"deadline": window["deadline"], "lock": owner}
+
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._window_loop, name='viki-webhooks', daemon=True)
+                self._thread.start()
+
+            self._cond.notify()
+
+        return None
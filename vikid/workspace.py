@@ -0,0 +1,191 @@
+# coding: utf-8
+
+"""
+workspace.py
+~~~~~~~~~~~~
+
+Run workspace library - internal to Viki
+
+Steps run inside a workspace directory. By default every run gets a
+fresh one under workspaces/runs/ that is removed when the run ends.
+Jobs with "workspace": {"persistent": true} instead reuse
+workspaces/cache/<job>/ between runs so checkouts and build artifacts
+survive. Cached workspaces are evicted least recently used first once
+they use more than workspace_cache_max_bytes of disk.
+:license: Apache2, see LICENSE for more details
+"""
+
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from typing import Any, Dict, Optional, Set
+
+from vikid.locks import FileLock
+
+logger = logging.getLogger(__name__)
+
+
+def _disk_usage(path: str) -> int:
+    """ Bytes used by every file under path """
+    total = 0
+
+    for root, _, files in os.walk(path):
+        for filename in files:
+            try:
+                total += os.lstat(os.path.join(root, filename)).st_size
+            except OSError:
+                pass
+
+    return total
+
+
+def workspace_options(config: Any) -> Dict[str, Any]:
+    """ Check a job's "workspace" settings
+    Raises ValueError unless it is an object, {} if the job has none
+    """
+    if config is None:
+        return {}
+
+    if not isinstance(config, dict):
+        raise ValueError('workspace must be an object')
+
+    return config
+
+
+class Workspace:
+    """ A directory a run's steps execute in """
+
+    def __init__(self, path: str, job_name: str, persistent: bool = False,
+                 lock: Optional[FileLock] = None):
+        self.path: str = path
+        self.job_name: str = job_name
+        self.persistent: bool = persistent
+        self._lock: Optional[FileLock] = lock
+
+
+class WorkspacePool:
+    """ Hands out run workspaces and keeps the persistent cache within its size limit """
+
+    def __init__(self, root: str, max_cache_bytes: int = 0):
+        """ Initialize the pool
+        root: Directory holding runs/ and cache/
+        max_cache_bytes: Disk budget for persistent workspaces, 0 means unlimited
+        """
+        self.runs_path: str = root + "/runs"
+        self.cache_path: str = root + "/cache"
+        self.max_cache_bytes: int = max_cache_bytes
+
+        self._cond = threading.Condition()
+        self._sizes: Optional[Dict[str, int]] = None
+        self._to_measure: Set[str] = set()
+        self._thread: Optional[threading.Thread] = None
+
+
+    # --- Pool internals
+
+
+    def _cache_lock(self, job_name: str) -> FileLock:
+        return FileLock("{}/{}.lock".format(self.cache_path, job_name))
+
+
+    def _schedule_eviction(self, job_name: str) -> None:
+        """ Re-measure job_name's cached workspace and evict on a background thread """
+        if not self.max_cache_bytes:
+            return
+
+        with self._cond:
+            self._to_measure.add(job_name)
+
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._evict_loop, name='viki-workspace-evict', daemon=True)
+                self._thread.start()
+
+            self._cond.notify()
+
+
+    def _evict_loop(self) -> None:
+        """ Eviction thread main loop """
+        while True:
+            with self._cond:
+                while not self._to_measure:
+                    self._cond.wait()
+                to_measure, self._to_measure = self._to_measure, set()
+
+            self._evict(to_measure)
+
+
+    def _evict(self, to_measure: Set[str]) -> None:
+        """ Remove least recently used cached workspaces until the cache fits its budget """
+        if self._sizes is None:
+            # First pass since startup, measure everything already on disk
+            to_measure = set(entry.name for entry in os.scandir(self.cache_path) if entry.is_dir())
+            self._sizes = {}
+
+        for job_name in to_measure:
+            self._sizes[job_name] = _disk_usage(self.cache_path + "/" + job_name)
+
+        total = sum(self._sizes.values())
+        if total <= self.max_cache_bytes:
+            return
+
+        def last_used(job_name: str) -> float:
+            try:
+                return os.stat(self.cache_path + "/" + job_name).st_mtime
+            except OSError:
+                return 0.0
+
+        for job_name in sorted(self._sizes, key=last_used):
+            if total <= self.max_cache_bytes:
+                break
+
+            # Never pull a workspace out from under a run that is using it
+            lock = self._cache_lock(job_name)
+            if not lock.acquire(blocking=False):
+                continue
+
+            try:
+                shutil.rmtree(self.cache_path + "/" + job_name, ignore_errors=True)
+            finally:
+                lock.release()
+
+            logger.info('Evicted cached workspace of %s (%d bytes)', job_name, self._sizes[job_name])
+            total -= self._sizes.pop(job_name)
+
+
+    # --- Pool functions
+
+
+    def acquire(self, job_name: str, persistent: bool = False) -> Workspace:
+        """ Get a workspace for a run of job_name
+        A persistent workspace already in use by another run of the same job
+        can't be shared, that run gets a fresh workspace instead
+        """
+        if persistent:
+            os.makedirs(self.cache_path, exist_ok=True)
+            lock = self._cache_lock(job_name)
+
+            if lock.acquire(blocking=False):
+                path = self.cache_path + "/" + job_name
+                os.makedirs(path, exist_ok=True)
+                return Workspace(path, job_name, persistent=True, lock=lock)
+
+            logger.info('Cached workspace of %s is busy, using a fresh one', job_name)
+
+        os.makedirs(self.runs_path, exist_ok=True)
+
+        return Workspace(tempfile.mkdtemp(prefix=job_name + '-', dir=self.runs_path), job_name)
+
+
+    def release(self, workspace: Workspace) -> None:
+        """ Give a workspace back once its run has finished """
+        if not workspace.persistent:
+            shutil.rmtree(workspace.path, ignore_errors=True)
+            return
+
+        # The directory's mtime doubles as its last used time for eviction
+        os.utime(workspace.path)
+        workspace._lock.release()
+
+        self._schedule_eviction(workspace.job_name)